@@ -3,12 +3,30 @@ import subprocess as sp
 import os
 import glob
 import shutil
+import numpy as np
+import nibabel as nib
+import pydicom
+from pycurt.utils.filemanip import save_nifti
+from pycurt.utils.index import dicom_headers
 
 
 class DicomConverter(BaseConverter):
     
     def convert(self, convert_to='nifti_gz', method='dcm2niix', force=False,
-                rename_dicom=False):
+                rename_dicom=False, compression=6):
+
+        if method == 'native' and convert_to in ['nifti_gz', 'nifti']:
+            ext = '.nii.gz' if convert_to == 'nifti_gz' else '.nii'
+            try:
+                outname = dicom_to_nifti(
+                    self.toConvert, os.path.join(self.basedir, self.filename)+ext,
+                    compresslevel=compression)
+                print('\nImage successfully converted!')
+                return outname
+            except Exception as e:
+                print('Native conversion of {0} not possible ({1}), dcm2niix will '
+                      'be used.'.format(self.toConvert, e))
+                method = 'dcm2niix'
 
         if convert_to == 'nrrd':
             print('\nConversion from DICOM to NRRD...')
@@ -59,11 +77,12 @@ class DicomConverter(BaseConverter):
                 self.clean_dir()
             if rename_dicom:
                 # needed for MRCLASS
-                file = [item for item in os.listdir(self.basedir) if '.nii.gz' in item]
+                file = [item for item in os.listdir(self.basedir) if ext in item]
                 for f in file:
                     if self.filename in f:
                         outname = os.path.join(self.basedir, f)
-                        shutil.move(self.toConvert, outname[0:-7])
+                        if outname[0:-len(ext)] != self.toConvert:
+                            shutil.move(self.toConvert, outname[0:-len(ext)])
                         break
             else:
                 outname = os.path.join(self.basedir, self.filename)+ext
@@ -90,3 +109,99 @@ class DicomConverter(BaseConverter):
                 os.remove(f)
         else:
             print('No DICOM files to delete found in {}'.format(basedir))
+
+
+def convert_series(dicom_dir, method='dcm2niix', compression=6):
+    """Function to convert one DICOM series for MRClass (see FolderSorting).
+    It returns the converted image or None if the conversion failed.
+    """
+    converter = DicomConverter(dicom_dir)
+    return converter.convert(rename_dicom=True, method=method,
+                             compression=compression)
+
+
+def dicom_to_nifti(dicom_dir, out_file, compresslevel=6):
+    """Function to convert a single DICOM series to NIfTI without calling any
+    external tool. The geometry is taken from the header index, so only the
+    pixel data are read here. The image is stored as dcm2niix does, i.e. with
+    the columns along the first axis, the rows flipped and the slices sorted
+    along the slice normal. Series that cannot be represented as a single
+    equally spaced volume (multi-frame files, multiple echoes or volumes, tilted
+    or irregular slices) raise an exception, so that they can be converted with
+    dcm2niix.
+    Parameters
+    ----------
+    dicom_dir : str
+        folder with the DICOM files of the series
+    out_file : str
+        output NIfTI file (.nii or .nii.gz)
+    compresslevel : int
+        gzip compression level (0-9), used for .nii.gz files
+    Returns
+    -------
+    out_file : str
+        path to the converted image
+    """
+    dcms = sorted(glob.glob(os.path.join(dicom_dir, '*.dcm')))
+    if not dcms:
+        dcms = sorted(glob.glob(os.path.join(dicom_dir, '*.IMA')))
+    if not dcms:
+        raise Exception('no DICOM files found')
+    headers = dicom_headers(dcms)
+    if any(hd is None for hd in headers):
+        raise Exception('unreadable DICOM header')
+    for tag in ['SeriesInstanceUID', 'ImageOrientationPatient', 'PixelSpacing',
+                'Rows', 'Columns', 'RescaleSlope', 'RescaleIntercept']:
+        if len(set(hd.get(tag) for hd in headers)) > 1:
+            raise Exception('{} is not the same for all the files'.format(tag))
+    hd = headers[0]
+    if int(hd.get('NumberOfFrames', 1)) > 1 or int(hd.get('SamplesPerPixel', 1)) > 1:
+        raise Exception('multi-frame or color images are not supported')
+    try:
+        orientation = np.array([float(x) for x in hd['ImageOrientationPatient']])
+        spacing = [float(x) for x in hd['PixelSpacing']]
+        positions = np.array([[float(x) for x in h['ImagePositionPatient']]
+                              for h in headers])
+        rows, columns = int(hd['Rows']), int(hd['Columns'])
+    except (KeyError, ValueError):
+        raise Exception('missing geometry information')
+    row_dir, col_dir = orientation[:3], orientation[3:]
+    normal = np.cross(row_dir, col_dir)
+
+    distances = positions.dot(normal)
+    order = np.argsort(distances, kind='mergesort')
+    if len(dcms) > 1:
+        steps = np.diff(distances[order])
+        if np.min(steps) < 1e-3:
+            raise Exception('more than one image per slice position')
+        if np.max(steps)-np.min(steps) > 0.01*np.mean(steps):
+            raise Exception('slices are not equally spaced')
+        slice_vec = (positions[order[-1]]-positions[order[0]])/(len(dcms)-1)
+        if abs(np.dot(slice_vec/np.linalg.norm(slice_vec), normal)) < 0.999:
+            raise Exception('tilted slices')
+    else:
+        slice_vec = normal*float(hd.get('SliceThickness', 1))
+
+    data = np.stack([pydicom.dcmread(dcms[i]).pixel_array.T for i in order],
+                    axis=2)[:, ::-1, :]
+    slope = float(hd.get('RescaleSlope', 1))
+    intercept = float(hd.get('RescaleIntercept', 0))
+    if slope != 1 or intercept != 0:
+        data = (data*slope+intercept).astype(np.float32)
+
+    # DICOM (LPS) affine of the flipped image, converted to RAS
+    affine = np.eye(4)
+    affine[:3, 0] = row_dir*spacing[1]
+    affine[:3, 1] = -col_dir*spacing[0]
+    affine[:3, 2] = slice_vec
+    affine[:3, 3] = positions[order[0]]+col_dir*spacing[0]*(rows-1)
+    affine[:2, :] *= -1
+    if data.shape[:2] != (columns, rows):
+        raise Exception('pixel data do not match the image size')
+
+    img = nib.Nifti1Image(np.ascontiguousarray(data), affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+
+    return save_nifti(img, out_file, compresslevel=compresslevel)
@@ -1,10 +1,10 @@
 import os
-import glob
 import nipype
 from nipype.interfaces.utility import Split
 from pycurt.utils.utils import check_dcm_dose
 from pycurt.database.local import LocalDatabase
 from pycurt.database.utils import check_cache
+from pycurt.database.layout import SubjectLayout
 
 
 POSSIBLE_SEQUENCES = ['t1', 'ct1', 't1km', 't2', 'flair', 'adc', 'swi']
@@ -31,34 +31,63 @@ class BaseDatabase():
                 project_id=local_project_id, 
                 local_basedir=local_basedir)
     
+    def subject_layout(self, refresh=False):
+        """Return the SubjectLayout of the subject folder. With refresh=True
+        (as in database) the folder is checked again, otherwise the layout of
+        the last call is returned. The layout is reused from the on-disk cache
+        if none of the directories changed.
+        """
+        if refresh or getattr(self, '_layout', None) is None:
+            self._layout = SubjectLayout(os.path.join(self.base_dir, self.sub_id))
+
+        return self._layout
+
+    def check_doses(self, layout, dcms):
+        """Same as check_dcm_dose, with the result stored in the layout.
+        The directory modification times do not change when a file is
+        rewritten in place, so the result is reused only if the modification
+        time and size of each file are the same as when it was computed.
+        """
+        key = '|'.join(sorted(dcms))
+        stats = []
+        for dcm in sorted(dcms):
+            try:
+                st = os.stat(dcm)
+                stats.append([dcm, st.st_mtime_ns, st.st_size])
+            except OSError:
+                stats.append([dcm, None, None])
+        doses = layout.derived.setdefault('doses', {})
+        cached = doses.get(key)
+        if not isinstance(cached, dict) or cached.get('stats') != stats:
+            doses[key] = {'stats': stats, 'result': check_dcm_dose(dcms)}
+            layout.save()
+
+        return doses[key]['result']
+
     def database(self):
         
-        base_dir = self.base_dir
         sub_id = self.sub_id
         sequences = []
+        # all the information come from one walk of the subject folder
+        layout = self.subject_layout(refresh=True)
+        subject_dirs = layout.dirs()
 
-        sessions = [x for x in os.listdir(os.path.join(base_dir, sub_id))
+        sessions = [x for x in subject_dirs
                     if 'REF' not in x and 'T10' not in x and 'RT_' not in x
-                    and 'CT_' not in x
-                    and os.path.isdir(os.path.join(base_dir, sub_id, x))]
-        ref_session = [x for x in os.listdir(os.path.join(base_dir, sub_id))
-                       if x == 'REF' and os.path.isdir(os.path.join(base_dir, sub_id, x))]
-        t10_session = [x for x in os.listdir(os.path.join(base_dir, sub_id))
-                       if x == 'T10' and os.path.isdir(os.path.join(base_dir, sub_id, x))]
-        rt_sessions = [x for x in os.listdir(os.path.join(base_dir, sub_id))
-                       if 'RT_' in x and os.path.isdir(os.path.join(base_dir, sub_id, x))]
-        ct_sessions = [x for x in os.listdir(os.path.join(base_dir, sub_id))
-                       if 'CT_' in x and os.path.isdir(os.path.join(base_dir, sub_id, x))
-                       and glob.glob(os.path.join(base_dir, sub_id, x, 'CT/1-*'))]
+                    and 'CT_' not in x]
+        ref_session = [x for x in subject_dirs if x == 'REF']
+        t10_session = [x for x in subject_dirs if x == 'T10']
+        rt_sessions = [x for x in subject_dirs if 'RT_' in x]
+        ct_sessions = [x for x in subject_dirs
+                       if 'CT_' in x and layout.glob(x, 'CT', '1-*')]
 
         if sessions:
             sequences = list(set([y.split('.nii.gz')[0].lower() for x in sessions
-                                  for y in os.listdir(os.path.join(base_dir, sub_id, x))
+                                  for y in layout.listdir(x)
                                   if y.endswith('.nii.gz')]))
             if not sequences:
                 sequences = list(set([y.lower() for x in sessions
-                                  for y in os.listdir(os.path.join(base_dir, sub_id, x))
-                                  if os.path.isdir(os.path.join(base_dir, sub_id, x, y))]))
+                                  for y in layout.dirs(x)]))
                 ext = ''
             else:
                 ext = '.nii.gz'
@@ -69,7 +98,7 @@ class BaseDatabase():
         self.session_names = {}
         for seq in sequences:
             sess = [x for x in sessions
-                    for y in sorted(os.listdir(os.path.join(base_dir, sub_id, x)))
+                    for y in sorted(layout.listdir(x))
                     if y.lower() == seq+ext]
             self.session_names[seq] = sess
 
@@ -88,11 +117,11 @@ class BaseDatabase():
 #                             'in order to perform registration.'.format(sub_id))
         self.add_subfolder = False
         if ext == '' and sessions:
-            dcms = [y for x in sessions for y in glob.glob(os.path.join(base_dir, sub_id, x, '*/*.dcm'))
+            dcms = [y for x in sessions for y in layout.glob(x, '*', '*.dcm')
                     if 'CT_' not in y]
             if not dcms:
-                dcms = [y for x in sessions for y in glob.glob(
-                    os.path.join(base_dir, sub_id, x, '*/1-*', '*.dcm'))]
+                dcms = [y for x in sessions for y in layout.glob(
+                    x, '*', '1-*', '*.dcm')]
                 if dcms:
                     self.add_subfolder = True
 #                 else:
@@ -120,35 +149,34 @@ class BaseDatabase():
             rt['session'] = []
 #             rt['labels'] = []
             for rt_session in rt_sessions:
-                if os.path.isdir(os.path.join(base_dir, sub_id, rt_session, 'RTDOSE')):
-                    physical = [x for x in os.listdir(os.path.join(
-                        base_dir, sub_id, rt_session, 'RTDOSE')) if '1-PHY' in x]
+                if layout.isdir(rt_session, 'RTDOSE'):
+                    physical = [x for x in layout.listdir(rt_session, 'RTDOSE')
+                                if '1-PHY' in x]
                     if physical:
-                        dcms = [x for y in physical for x in glob.glob(os.path.join(
-                                base_dir, sub_id, rt_session, 'RTDOSE', y, '*.dcm'))]
-                        right_dcm = check_dcm_dose(dcms)
+                        dcms = [x for y in physical for x in layout.glob(
+                                rt_session, 'RTDOSE', y, '*.dcm')]
+                        right_dcm = self.check_doses(layout, dcms)
                         if not right_dcm:
                             physical = []
                         else:
                             physical = ['PHYS']
-                    rbe = [x for x in os.listdir(os.path.join(
-                        base_dir, sub_id, rt_session, 'RTDOSE')) if '1-RBE' in x]
+                    rbe = [x for x in layout.listdir(rt_session, 'RTDOSE')
+                           if '1-RBE' in x]
                     if rbe:
-                        dcms = [x for y in rbe for x in glob.glob(os.path.join(
-                                base_dir, sub_id, rt_session, 'RTDOSE', y, '*.dcm'))]
-                        right_dcm = check_dcm_dose(dcms)
+                        dcms = [x for y in rbe for x in layout.glob(
+                                rt_session, 'RTDOSE', y, '*.dcm')]
+                        right_dcm = self.check_doses(layout, dcms)
                         if not right_dcm:
                             rbe = []
                         else:
                             rbe = ['RBE']
 #                     if not physical and not rbe:
-                    doses = [x for x in os.listdir(os.path.join(
-                        base_dir, sub_id, rt_session, 'RTDOSE')) if '1-RBE' not in x
-                        and '1-PHY' not in x]
+                    doses = [x for x in layout.listdir(rt_session, 'RTDOSE')
+                             if '1-RBE' not in x and '1-PHY' not in x]
                     if doses:
-                        dcms = [x for y in doses for x in glob.glob(os.path.join(
-                            base_dir, sub_id, rt_session, 'RTDOSE', y, '*.dcm'))]
-                        right_dcm = check_dcm_dose(dcms)
+                        dcms = [x for y in doses for x in layout.glob(
+                            rt_session, 'RTDOSE', y, '*.dcm')]
+                        right_dcm = self.check_doses(layout, dcms)
                         if not right_dcm:
                             doses = []
                         else:
@@ -158,13 +186,13 @@ class BaseDatabase():
                     rt['physical'] = rt['physical']+physical
                     rt['rbe'] = rt['rbe'] + rbe
                     rt['doses'] = rt['doses'] + doses
-                if os.path.isdir(os.path.join(base_dir, sub_id, rt_session, 'RTSTRUCT')):
-                    rtstruct = [x for x in os.listdir(os.path.join(
-                        base_dir, sub_id, rt_session, 'RTSTRUCT')) if '1-' in x]
+                if layout.isdir(rt_session, 'RTSTRUCT'):
+                    rtstruct = [x for x in layout.listdir(rt_session, 'RTSTRUCT')
+                                if '1-' in x]
                     rt['rtstruct'] = rt['rtstruct'] + rtstruct
-                if os.path.isdir(os.path.join(base_dir, sub_id, rt_session, 'RTCT')):
-                    rtct = [x for x in os.listdir(os.path.join(
-                        base_dir, sub_id, rt_session, 'RTCT')) if '1-' in x]
+                if layout.isdir(rt_session, 'RTCT'):
+                    rtct = [x for x in layout.listdir(rt_session, 'RTCT')
+                            if '1-' in x]
                     rt['rtct'] = rt['rtct'] + rtct
                 if [rt[x] for x in rt if rt[x]]:
 #                     rt['labels'].append(rt_session)
@@ -306,8 +334,8 @@ class BaseDatabase():
         split_ds_nodes = []
         for i in range(len(sequences1)):
             sessions_wit_seq = [
-                x for y in self.sessions for x in glob.glob(os.path.join(
-                    self.base_dir, self.sub_id, y, sequences1[i].upper()+'.nii.gz'))]
+                x for y in self.sessions for x in self.subject_layout().glob(
+                    y, sequences1[i].upper()+'.nii.gz')]
             split_ds = nipype.Node(interface=Split(), name='split_ds{}'.format(i))
             split_ds.inputs.splits = [1]*len(sessions_wit_seq)
             split_ds_nodes.append(split_ds)
@@ -0,0 +1,190 @@
+import os
+import stat
+import time
+import hashlib
+import threading
+from pycurt.utils.index import SQLiteStore
+from pycurt.utils.filemanip import materialise
+from pycurt.utils.parallel import parallel_map
+
+
+class BlobStore(SQLiteStore):
+    """Content-addressed store of files, shared by all the projects of a
+    local database. Each file is stored once, read-only, as
+    objects/<sha1[:2]>/<sha1>, and the refs table maps every (project,
+    subject, session, scan, relative path) to its object. Objects are
+    retrieved with reflinks (copies where not supported), so retrieved files
+    can be modified without affecting the store. Objects that are not
+    referenced anymore are removed by collect_garbage.
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS blobs (sha1 TEXT PRIMARY KEY, size INTEGER, '
+        'added REAL)',
+        'CREATE TABLE IF NOT EXISTS refs (project TEXT, subject TEXT, '
+        'session TEXT, scan TEXT, path TEXT, sha1 TEXT, '
+        'PRIMARY KEY (project, subject, session, scan, path))',
+        'CREATE INDEX IF NOT EXISTS refs_sha1 ON refs (sha1)']
+
+    def __init__(self, store_dir, n_workers=4):
+
+        self.store_dir = os.path.abspath(store_dir)
+        self.n_workers = n_workers
+        os.makedirs(self.store_dir, exist_ok=True)
+        super().__init__(os.path.join(self.store_dir, 'objects.sqlite'))
+
+    def object_path(self, sha1):
+
+        return os.path.join(self.store_dir, sha1[:2], sha1)
+
+    def add_file(self, path, strategy='reflink'):
+        """Function to add a file to the store, if its content is not already
+        there, materialising it with strategy (see filemanip.materialise).
+        Returns (sha1, size, stored), where stored is False if the object
+        already existed.
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha1.update(chunk)
+        sha1 = sha1.hexdigest()
+        size = os.path.getsize(path)
+        obj = self.object_path(sha1)
+        conn = self.connection()
+        with conn:
+            # refreshing the added time of an existing object protects it from
+            # collect_garbage (for grace_period seconds) until its refs are
+            # written. If the garbage collection is running, this waits for it
+            reused = conn.execute('UPDATE blobs SET added=? WHERE sha1=?',
+                                  (time.time(), sha1)).rowcount == 1
+        if reused and os.path.isfile(obj):
+            return sha1, size, False
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = '{0}.{1}.{2}.part'.format(obj, os.getpid(), threading.get_ident())
+        materialise(path, tmp, strategy=strategy)
+        # only the objects with their own data are made read-only: a
+        # hardlink (or symlink) shares the permissions of the original file
+        if not os.path.samefile(path, tmp):
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp, obj)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                         (sha1, size, time.time()))
+
+        return sha1, size, True
+
+    def put(self, project, scans, base_dir, strategy='reflink'):
+        """Function to store scans, a list of (subject, session, scan, path)
+        with path (a file or a folder) relative to base_dir, and to replace
+        their refs. New objects are materialised with strategy. With
+        "hardlink", the files in base_dir become the objects (keeping their
+        permissions), so they must not be modified in place afterwards.
+        Returns
+        -------
+        checksums : dict
+            SHA1 of each file (for folders, SHA1 of the list of their files)
+        """
+        files = []
+        for subject, session, scan, path in scans:
+            full_path = os.path.join(base_dir, path)
+            if os.path.isdir(full_path):
+                for root, _, names in os.walk(full_path):
+                    files += [((subject, session, scan, path), os.path.relpath(
+                        os.path.join(root, x), base_dir)) for x in sorted(names)]
+            else:
+                files.append(((subject, session, scan, path), path))
+        start = time.time()
+        added = parallel_map(lambda x: self.add_file(os.path.join(base_dir, x[1]),
+                                                     strategy=strategy),
+                             files, self.n_workers, executor='thread')
+        with self.connection() as conn:
+            for subject, session, scan, _ in scans:
+                conn.execute('DELETE FROM refs WHERE project=? AND subject=? AND '
+                             'session=? AND scan=?', (project, subject, session, scan))
+            conn.executemany('INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?, ?)',
+                             [(project, )+key[:3]+(path, x[0])
+                              for (key, path), x in zip(files, added)])
+        new = [x for x in added if x[2]]
+        print('{0} files stored in {1:.1f} s: {2} new objects ({3:.1f} MB), {4} '
+              'already stored'.format(len(added), time.time()-start, len(new),
+                                      sum(x[1] for x in new)/1024.0**2,
+                                      len(added)-len(new)))
+        contents = {}
+        for (key, path), x in zip(files, added):
+            contents.setdefault(key[3], []).append((path, x[0]))
+        checksums = {}
+        for path, content in contents.items():
+            if content[0][0] == path:
+                checksums[path] = content[0][1]
+            else:
+                checksums[path] = hashlib.sha1(repr(content).encode()).hexdigest()
+
+        return checksums
+
+    def refs(self, project, subject, session=None, scan=None):
+        """Return the (path, sha1) refs of a project and subject, optionally
+        restricted to one session and scan.
+        """
+        query = 'SELECT path, sha1 FROM refs WHERE project=? AND subject=?'
+        args = [project, subject]
+        if session is not None:
+            query += ' AND session=?'
+            args.append(session)
+        if scan is not None:
+            query += ' AND scan=?'
+            args.append(scan)
+
+        return self.connection().execute(query, args).fetchall()
+
+    def get(self, refs, dst_dir):
+        """Function to check out the objects of refs (a list of (path, sha1))
+        to dst_dir/path, with reflinks (copies where not supported), so that
+        writing to the checked out files does not change the objects. The
+        files keep the modification time of their object, and existing files
+        with the same size and modification time are skipped.
+        """
+        def checkout(ref):
+            path, sha1 = ref
+            obj = self.object_path(sha1)
+            dst = os.path.join(dst_dir, path)
+            if os.path.isfile(dst) and not os.path.samefile(obj, dst):
+                obj_stat = os.stat(obj)
+                dst_stat = os.stat(dst)
+                if (dst_stat.st_size == obj_stat.st_size
+                        and dst_stat.st_mtime_ns == obj_stat.st_mtime_ns):
+                    return 0
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            materialise(obj, dst, strategy='reflink')
+            # the objects are read-only, their checked out copies are not
+            os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+            return 1
+
+        return sum(parallel_map(checkout, refs, self.n_workers, executor='thread'))
+
+    def collect_garbage(self, grace_period=3600):
+        """Function to remove the objects that are not referenced anymore.
+        Objects added (or reused by add_file) in the last grace_period seconds
+        are kept, since their refs may still be being written by another
+        process.
+        Returns
+        -------
+        removed : int
+            number of objects removed
+        freed : int
+            number of bytes freed
+        """
+        conn = self.connection()
+        with conn:
+            # the write lock is held until the files are removed, so add_file
+            # cannot reuse an object while it is being removed
+            conn.execute('BEGIN IMMEDIATE')
+            orphans = conn.execute(
+                'SELECT sha1, size FROM blobs WHERE added < ? AND sha1 NOT IN '
+                '(SELECT sha1 FROM refs)', (time.time()-grace_period, )).fetchall()
+            conn.executemany('DELETE FROM blobs WHERE sha1=?', [(x[0], ) for x in orphans])
+            for sha1, _ in orphans:
+                if os.path.isfile(self.object_path(sha1)):
+                    os.remove(self.object_path(sha1))
+        print('Garbage collection: {0} objects removed ({1:.1f} MB freed)'.format(
+            len(orphans), sum(x[1] for x in orphans)/1024.0**2))
+
+        return len(orphans), sum(x[1] for x in orphans)
@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+from fnmatch import fnmatch
+
+
+DEFAULT_LAYOUT_CACHE = os.path.join(os.path.expanduser('~'), '.pycurt', 'layouts')
+LAYOUT_VERSION = 1
+
+
+class SubjectLayout(object):
+    """In-memory model of the folder of one subject, built with one
+    os.scandir per directory down to depth levels (subject/session/scan/
+    sub-folder). Each directory is stored with its modification time, so
+    the model can be saved on disk and reused as long as none of the
+    directories changed (a directory modification time changes when an
+    entry is added, removed or renamed). Derived results (e.g. the checks on
+    the RT doses) can be stored in the derived dictionary and are saved with
+    the model.
+    """
+    def __init__(self, subject_dir, depth=3, cache_dir=None):
+
+        self.subject_dir = os.path.abspath(subject_dir)
+        self.depth = depth
+        if cache_dir is None:
+            cache_dir = os.environ.get('PYCURT_LAYOUT_CACHE', DEFAULT_LAYOUT_CACHE)
+        self.cache_file = None
+        if cache_dir:
+            self.cache_file = os.path.join(cache_dir, '{}.json'.format(
+                hashlib.sha1(self.subject_dir.encode()).hexdigest()))
+        self.tree = None
+        self.derived = {}
+        cached = self._load()
+        if cached is not None and self._unchanged(self.subject_dir, cached['tree']):
+            self.tree = cached['tree']
+            self.derived = cached['derived']
+        else:
+            self.tree = self._walk(self.subject_dir, depth)
+            self.save()
+
+    def _walk(self, path, depth):
+
+        node = {'mtime': os.stat(path).st_mtime_ns, 'dirs': [], 'files': [],
+                'children': {}}
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                node['dirs'].append(entry.name)
+                if depth > 0:
+                    node['children'][entry.name] = self._walk(entry.path, depth-1)
+            else:
+                node['files'].append(entry.name)
+
+        return node
+
+    def _unchanged(self, path, node):
+
+        try:
+            if os.stat(path).st_mtime_ns != node['mtime']:
+                return False
+        except OSError:
+            return False
+
+        return all(self._unchanged(os.path.join(path, name), child)
+                   for name, child in node['children'].items())
+
+    def _load(self):
+
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except ValueError:
+            return None
+        if (cached.get('version') != LAYOUT_VERSION or cached.get('depth') != self.depth
+                or cached.get('subject_dir') != self.subject_dir):
+            return None
+
+        return cached
+
+    def save(self):
+
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp = '{0}.{1}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': LAYOUT_VERSION, 'depth': self.depth,
+                       'subject_dir': self.subject_dir, 'tree': self.tree,
+                       'derived': self.derived}, f)
+        os.replace(tmp, self.cache_file)
+
+    def node(self, *parts):
+        """Return the node of the directory subject_dir/parts, or None if it
+        does not exist (or it is deeper than the walked levels).
+        """
+        node = self.tree
+        for part in parts:
+            node = node['children'].get(part)
+            if node is None:
+                return None
+
+        return node
+
+    def isdir(self, *parts):
+
+        return self.node(*parts) is not None
+
+    def dirs(self, *parts):
+        """Return the sub-directories of subject_dir/parts, in scandir order."""
+        node = self.node(*parts)
+
+        return list(node['dirs']) if node is not None else []
+
+    def files(self, *parts):
+        """Return the files in subject_dir/parts, in scandir order."""
+        node = self.node(*parts)
+
+        return list(node['files']) if node is not None else []
+
+    def listdir(self, *parts):
+        """Same as os.listdir(subject_dir/parts)."""
+        return self.dirs(*parts)+self.files(*parts)
+
+    def glob(self, *patterns):
+        """Same as glob.glob(os.path.join(subject_dir, *patterns)), but each
+        pattern has to be one path component. As in glob, names starting with
+        '.' are only matched by patterns starting with '.'.
+        """
+        found = [((), self.tree)]
+        for i, pattern in enumerate(patterns):
+            last = i == len(patterns)-1
+            matches = []
+            for parts, node in found:
+                names = node['dirs']+node['files'] if last else node['dirs']
+                for name in names:
+                    if name.startswith('.') and not pattern.startswith('.'):
+                        continue
+                    if fnmatch(name, pattern):
+                        child = node['children'].get(name)
+                        if child is not None or last:
+                            matches.append((parts+(name, ), child))
+            found = matches
+
+        return [os.path.join(self.subject_dir, *x[0]) for x in found]
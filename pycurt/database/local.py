@@ -1,13 +1,113 @@
 import os
-import subprocess as sp
-import collections
-import copy
+import time
+import hashlib
 import pickle
+from pycurt.utils.index import SQLiteStore
+from pycurt.database.transfer import TransferEngine
+from pycurt.database.blobs import BlobStore
+
+
+class LocalCatalogue(SQLiteStore):
+    """Catalogue of the scans saved in a local database project. There is
+    one row per (subject, session, scan), with the relative path of the
+    scan, its size and SHA1 checksum (for files), so updates from several
+    subjects at the same time are concurrent, atomic upserts of their own
+    rows instead of rewrites of the whole catalogue.
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS sessions (subject TEXT, session TEXT, '
+        'PRIMARY KEY (subject, session))',
+        'CREATE TABLE IF NOT EXISTS scans (subject TEXT, session TEXT, '
+        'scan TEXT, path TEXT, size INTEGER, checksum TEXT, updated REAL, '
+        'PRIMARY KEY (subject, session, scan))',
+        'CREATE INDEX IF NOT EXISTS scans_scan ON scans (scan)']
+
+    def upsert(self, entries):
+        """Insert or replace entries, a list of (subject, session, scan, path,
+        size, checksum) tuples, in one transaction.
+        """
+        now = time.time()
+        with self.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO sessions VALUES (?, ?)',
+                             set((x[0], x[1]) for x in entries))
+            conn.executemany('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [tuple(x)+(now, ) for x in entries])
+
+    def subjects(self):
+
+        return [x[0] for x in self.connection().execute(
+            'SELECT DISTINCT subject FROM sessions ORDER BY subject')]
+
+    def scans(self, subjects=None, scans=None, skip_sessions=None):
+        """Return the (subject, session, scan, path, size, checksum) rows of
+        the given subjects and scans (all if None), excluding skip_sessions.
+        """
+        query = 'SELECT subject, session, scan, path, size, checksum FROM scans'
+        conditions = []
+        args = []
+        if scans:
+            conditions.append('scan IN ({})'.format(','.join('?'*len(scans))))
+            args += list(scans)
+        if skip_sessions:
+            conditions.append('session NOT IN ({})'.format(
+                ','.join('?'*len(skip_sessions))))
+            args += list(skip_sessions)
+        if subjects is None:
+            if conditions:
+                query += ' WHERE '+' AND '.join(conditions)
+            return self.connection().execute(query, args).fetchall()
+        # the subjects can be many, so their IN clause is split by select_in
+        query += ' WHERE '+' AND '.join(['subject IN ({})']+conditions)
+
+        return self.select_in(query, subjects, args=args)
+
+    def sessions_without(self, scan, subject=None):
+        """Return the (subject, session) pairs that do not have scan."""
+        query = ('SELECT s.subject, s.session FROM sessions s LEFT JOIN scans c '
+                 'ON c.subject=s.subject AND c.session=s.session AND c.scan=? '
+                 'WHERE c.scan IS NULL')
+        args = [scan]
+        if subject is not None:
+            query += ' AND s.subject=?'
+            args.append(subject)
+
+        return self.connection().execute(query, args).fetchall()
+
+
+def scan_key(element):
+    "Return the (subject, session, scan) of element (subject/session/scan_file)"
+    sub, sess, scan = element.split('/')
+
+    return (sub, sess, scan.split('.')[0].lower())
+
+
+def scan_entry(basepath, element, checksum=None):
+    """Return the (subject, session, scan, path, size, checksum) row of the
+    scan at basepath/element (subject/session/scan_file). The checksum of
+    files is computed if not given, folders without checksum are stored
+    without it.
+    """
+    path = os.path.join(basepath, element)
+    if os.path.isdir(path):
+        size = sum(os.path.getsize(os.path.join(root, x))
+                   for root, _, files in os.walk(path) for x in files)
+    else:
+        size = os.path.getsize(path)
+    if checksum is None and not os.path.isdir(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha1.update(chunk)
+        checksum = sha1.hexdigest()
+
+    return scan_key(element)+(element, size, checksum)
 
 
 class LocalDatabase():
-    
-    def __init__(self, project_id=None, local_basedir=''):
+
+    def __init__(self, project_id=None, local_basedir='', transfer_backend='local',
+                 n_workers=4):
 
         self.local_basedir = local_basedir
 
@@ -18,87 +118,152 @@ class LocalDatabase():
             project_id = input("Please enter the project ID on the Local database"
                                " you want to use: ")
         self.project_id = project_id
-        
+
         print('Local database information:')
         print('Local path: {}'.format(local_basedir))
         print('Project ID: {}'.format(project_id))
 
         self.local_path = '{0}/{1}'.format(local_basedir, project_id)
-        
+        if not os.path.isdir(self.local_path):
+            os.makedirs(self.local_path)
+        self.catalogue = LocalCatalogue(os.path.join(self.local_path, 'database.sqlite'))
+        self.transfer = TransferEngine(backend=transfer_backend, n_workers=n_workers)
+        # the objects are shared by all the projects in local_basedir, so
+        # identical files are stored once. Not used with rsync, which keeps
+        # plain copies of the files
+        self.blobs = None
+        if transfer_backend == 'local':
+            self.blobs = BlobStore(os.path.join(local_basedir, '.objects'),
+                                   n_workers=n_workers)
+        db_path = self.pickle_to_import()
+        if db_path is not None:
+            print('{} was created by a previous version of the local database and '
+                  'has not been imported yet (see import_pickle).'.format(db_path))
+
+    def pickle_to_import(self):
+        "Return the database.pickle of the project, if it has not been imported"
+        db_path = os.path.join(self.local_path, 'database.pickle')
+        if not os.path.isfile(db_path) or self.catalogue.connection().execute(
+                "SELECT value FROM meta WHERE key='imported_pickle'").fetchone():
+            return None
+
+        return db_path
+
+    def import_pickle(self, db_path=None):
+        """Function to import the catalogue of a project created with the
+        previous version of the local database (database.pickle). It is a
+        one-off step, to be run before the subjects are processed (the command
+        line does it before starting them): only the first call imports the
+        catalogue, the following ones (also from other processes) return
+        without doing anything. The files of the project are hardlinked into
+        the object store, so they do not take more space. Their permissions
+        are not changed, but they must not be modified in place afterwards.
+        The pickle is left where it is.
+        """
+        if db_path is None:
+            db_path = os.path.join(self.local_path, 'database.pickle')
+        if not os.path.isfile(db_path):
+            return
+        conn = self.catalogue.connection()
+        with conn:
+            # the import is claimed atomically, so it runs only once
+            conn.execute('BEGIN IMMEDIATE')
+            claimed = conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('imported_pickle', ?)",
+                (db_path, )).rowcount == 1
+        if not claimed:
+            return
+        try:
+            database = self.load_database(db_path)
+            elements = [element for sub_id in database for session in database[sub_id]
+                        for element in database[sub_id][session].values()
+                        if os.path.exists(os.path.join(self.local_path, element))]
+            checksums = {}
+            if self.blobs is not None:
+                checksums = self.blobs.put(self.project_id, [
+                    scan_key(x)+(x, ) for x in elements], self.local_path,
+                    strategy='hardlink')
+            entries = [scan_entry(self.local_path, x, checksum=checksums.get(x))
+                       for x in elements]
+            self.catalogue.upsert(entries)
+        except Exception:
+            with conn:
+                conn.execute("DELETE FROM meta WHERE key='imported_pickle'")
+            raise
+        print('Imported {0} scans from {1}'.format(len(entries), db_path))
+
     def check_precomputed_outputs(self, outfields, sessions, sub_id):
-        
-        database = self.load_database(os.path.join(self.local_path, 'database.pickle'))
+
         to_process = []
-        if database is not None:
-            sub_db = database[sub_id]
-            for session in sessions:
-                session_db = sub_db[session]
-                not_processed_scans = [x for x in outfields if x not in session_db]
-                if not_processed_scans:
-                    to_process.append(session)
-        
+        known = set(x[1] for x in self.catalogue.scans(subjects=[sub_id]))
+        if known:
+            missing = set(x[1] for scan in outfields
+                          for x in self.catalogue.sessions_without(scan, sub_id))
+            to_process = [x for x in sessions if x not in known or x in missing]
+
         return to_process
 
     def put(self, sessions, sub_folder):
-        
-        basepath, folder_name = os.path.split(sub_folder)
 
-        cmd = 'rsync -rtvu {0}/database.pickle {1}'.format(self.local_path, basepath)
-        self.run_rsync(cmd, ignore_error=True)
+        basepath, folder_name = os.path.split(sub_folder)
 
-        database = dict()
-        database[folder_name] = collections.defaultdict(dict)
         scans = [os.path.join(folder_name, x, y) for x in sessions
                  for y in os.listdir(os.path.join(sub_folder, x))]
+        if self.blobs is not None:
+            # only the files whose content is not in the store yet are copied
+            checksums = self.blobs.put(self.project_id, [
+                scan_key(x)+(x, ) for x in scans], basepath)
+            entries = [scan_entry(basepath, x, checksum=checksums.get(x))
+                       for x in scans]
+        else:
+            entries = [scan_entry(basepath, x) for x in scans]
+            # files with the same checksum as the one in the catalogue are not copied
+            stored = {x[3]: x[5] for x in self.catalogue.scans(subjects=[folder_name])}
+            unchanged = set(x[3] for x in entries
+                            if x[5] is not None and stored.get(x[3]) == x[5])
+            self.transfer.transfer(scans, basepath, self.local_path, unchanged=unchanged)
+        # the catalogue is updated only once the files are in place
+        self.catalogue.upsert(entries)
 
-        for element in scans:
-            _, sess, scan = element.split('/')
-            scan_name = scan.split('.')[0].lower()
-            database[folder_name][sess][scan_name] = element
-
-        scan_file = os.path.join(sub_folder, 'files_to_save_local.txt')
-        with open(scan_file, 'w') as f:
-            for el in scans:
-                f.write(el+'\n')
-            f.write('database.pickle')
-
-        self.update_database(basepath, database, folder_name)
-
-        cmd = 'rsync -rtvu --files-from={0} {1} {2}'.format(
-            scan_file, basepath, self.local_path)
-        self.run_rsync(cmd)
-    
     def get(self, cache_dir, subjects=[], needed_scans=[], skip_sessions=[]):
 
         if not os.path.isdir(cache_dir):
             os.mkdir(cache_dir)
-        cmd = 'rsync -rtvu {0}/database.pickle {1}'.format(self.local_path, cache_dir)
-        self.run_rsync(cmd)
 
-        database = self.load_database(os.path.join(cache_dir, 'database.pickle'))
         to_get = []
+        to_link = []
         for sub_id in subjects:
-            if sub_id in database.keys():
+            rows = self.catalogue.scans(subjects=[sub_id])
+            if rows:
                 print('Subject {} found in the database'.format(sub_id))
-                sessions = list(database[sub_id])
-                print('Found {} session(s)'.format(len(sessions)))
-                if skip_sessions:
-                    sessions = [x for x in sessions if x not in skip_sessions]
-                for session in sessions:
-                    scans = list(database[sub_id][session])
-                    if needed_scans:
-                        scans = [x for x in scans if x in needed_scans]
-                    for scan in scans:
-                        to_get.append(database[sub_id][session][scan])
-
-        scan_file = os.path.join(cache_dir, 'files_to_get_from_local.txt')
-        with open(scan_file, 'w') as f:
-            for el in to_get:
-                f.write(el+'\n')
-        cmd = 'rsync -rtvu --files-from={0} {1} {2}'.format(
-            scan_file, self.local_path, cache_dir)
-        self.run_rsync(cmd)
-      
+                print('Found {} session(s)'.format(len(set(x[1] for x in rows))))
+                rows = self.catalogue.scans(
+                    subjects=[sub_id], scans=needed_scans, skip_sessions=skip_sessions)
+                for row in rows:
+                    refs = []
+                    if self.blobs is not None:
+                        refs = self.blobs.refs(self.project_id, *row[:3])
+                    if refs:
+                        to_link += refs
+                    else:
+                        # scans saved before the object store was introduced
+                        to_get.append(row[3])
+
+        if to_link:
+            linked = self.blobs.get(to_link, cache_dir)
+            print('{0} files retrieved from the object store ({1} already '
+                  'there)'.format(linked, len(to_link)-linked))
+        if to_get:
+            self.transfer.transfer(to_get, self.local_path, cache_dir)
+
+    def collect_garbage(self, grace_period=3600):
+        """Function to remove the objects, of all the projects in
+        local_basedir, that are not referenced anymore (see
+        BlobStore.collect_garbage).
+        """
+        if self.blobs is not None:
+            return self.blobs.collect_garbage(grace_period=grace_period)
+
     def load_database(self, db_path):
 
         if os.path.isfile(db_path):
@@ -106,45 +271,12 @@ class LocalDatabase():
                 database = pickle.load(f)
         else:
             database = None
-        
-        return database
-
-    def update_database(self, basepath, new_db, folder_name):
-
-        database = self.load_database(os.path.join(basepath, 'database.pickle'))
-
-        if database is not None:
-            if folder_name not in database.keys():
-                database[folder_name] = collections.defaultdict(dict)
-            for session_name in new_db[folder_name].keys():
-                database[folder_name][session_name].update(
-                    new_db[folder_name][session_name])
-        else:
-            database = copy.deepcopy(new_db)
-        
-        with open(os.path.join(basepath, 'database.pickle'), 'wb') as f:
-            pickle.dump(database, f)
-
-    def run_rsync(self, cmd, ignore_error=False):
 
-        try:
-            sp.check_output(cmd, shell=True)
-        except sp.CalledProcessError:
-            if not ignore_error:
-                raise Exception('rsync failed to perform the requested action. '
-                                'Please try again later.')
+        return database
 
     def get_subject_list(self, basepath):
 
         if not os.path.isdir(basepath):
             os.makedirs(basepath)
-        cmd = 'rsync -rtvu {0}/database.pickle {1}'.format(self.local_path, basepath)
-        self.run_rsync(cmd, ignore_error=True)
-        
-        database = self.load_database(os.path.join(basepath, 'database.pickle'))
-        if database is not None:
-            sub_list = list(database.keys())
-        else:
-            sub_list = []
 
-        return sub_list
+        return self.catalogue.subjects()
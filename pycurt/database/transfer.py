@@ -0,0 +1,138 @@
+import os
+import time
+import tempfile
+import subprocess as sp
+from pycurt.utils.filemanip import materialise
+from pycurt.utils.parallel import parallel_map
+
+
+class TransferReport(object):
+    """Summary of a transfer: number of files transferred and skipped, bytes
+    transferred and elapsed time.
+    """
+    def __init__(self, n_files=0, n_skipped=0, n_bytes=0, seconds=0.0):
+
+        self.n_files = n_files
+        self.n_skipped = n_skipped
+        self.n_bytes = n_bytes
+        self.seconds = seconds
+
+    def __repr__(self):
+
+        mb = self.n_bytes/1024.0**2
+
+        return ('{0} files ({1:.1f} MB) transferred in {2:.1f} s ({3:.1f} MB/s), '
+                '{4} unchanged files skipped'.format(
+                    self.n_files, mb, self.seconds,
+                    mb/self.seconds if self.seconds else 0.0, self.n_skipped))
+
+
+class TransferEngine(object):
+    """Engine to transfer files (or folders) between a working folder and the
+    local database. Two backends are available:
+    - "local": files are materialised (see filemanip.materialise) by a pool
+      of threads. Files with the same size and modification time at the
+      destination, or listed as unchanged by the caller (e.g. because the
+      checksum in the catalogue matches), are skipped, and the size of each
+      transferred file is verified;
+    - "rsync": rsync -rtu is run on the list of files, e.g. for network
+      filesystems where rsync is faster than the local backend. Both the
+      source and the destination have to be local paths (the local database
+      keeps its catalogue next to the files).
+    """
+    def __init__(self, backend='local', n_workers=4, strategy='reflink'):
+
+        if backend not in ['local', 'rsync']:
+            raise Exception('Not recognized transfer backend {}. Possible values '
+                            'are "local" or "rsync".'.format(backend))
+        self.backend = backend
+        self.n_workers = n_workers
+        self.strategy = strategy
+
+    def transfer(self, elements, src_dir, dst_dir, unchanged=None):
+        """Function to transfer elements, paths relative to src_dir, to the
+        same paths relative to dst_dir.
+        Parameters
+        ----------
+        elements : list
+            relative paths of files or folders
+        src_dir : str
+            source folder
+        dst_dir : str
+            destination folder
+        unchanged : set
+            elements known to be identical at the destination. They are
+            skipped if the destination has the same size
+        Returns
+        -------
+        report : TransferReport
+            summary of the transfer
+        """
+        start = time.time()
+        if self.backend == 'rsync':
+            report = self._rsync(elements, src_dir, dst_dir)
+        else:
+            unchanged = unchanged or set()
+            files = []
+            for element in elements:
+                src = os.path.join(src_dir, element)
+                if os.path.isdir(src):
+                    for root, _, names in os.walk(src):
+                        files += [os.path.relpath(os.path.join(root, x), src_dir)
+                                  for x in names]
+                else:
+                    files.append(element)
+            results = parallel_map(lambda x: self._transfer_file(
+                x, src_dir, dst_dir, x in unchanged), files, self.n_workers,
+                executor='thread')
+            report = TransferReport(
+                n_files=len([x for x in results if x is not None]),
+                n_skipped=len([x for x in results if x is None]),
+                n_bytes=sum(x for x in results if x is not None))
+        report.seconds = time.time()-start
+        print('Transfer to {0}: {1}'.format(dst_dir, report))
+
+        return report
+
+    def _transfer_file(self, element, src_dir, dst_dir, unchanged=False):
+        "Return the number of bytes transferred, or None if skipped"
+        src = os.path.join(src_dir, element)
+        dst = os.path.join(dst_dir, element)
+        st = os.stat(src)
+        if os.path.isfile(dst):
+            dst_st = os.stat(dst)
+            if dst_st.st_size == st.st_size and (
+                    unchanged or int(dst_st.st_mtime) == int(st.st_mtime)):
+                return None
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = '{0}.{1}.part'.format(dst, os.getpid())
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        materialise(src, tmp, strategy=self.strategy)
+        if os.path.getsize(tmp) != st.st_size:
+            os.remove(tmp)
+            raise Exception('Size mismatch transferring {0} to {1}'.format(src, dst))
+        os.replace(tmp, dst)
+
+        return st.st_size
+
+    def _rsync(self, elements, src_dir, dst_dir):
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(elements)+'\n')
+        try:
+            output = sp.check_output(['rsync', '-rtu', '--stats', '--files-from={}'.format(f.name),
+                                      src_dir, dst_dir], universal_newlines=True)
+        except (sp.CalledProcessError, OSError):
+            raise Exception('rsync failed to perform the requested action. '
+                            'Please try again later.')
+        finally:
+            os.remove(f.name)
+        report = TransferReport()
+        for line in output.split('\n'):
+            if line.startswith('Number of regular files transferred:'):
+                report.n_files = int(line.split(':')[1].replace(',', ''))
+            elif line.startswith('Total transferred file size:'):
+                report.n_bytes = int(line.split(':')[1].split()[0].replace(',', ''))
+
+        return report
@@ -1,8 +1,11 @@
+import csv
 import glob
-import pydicom
 import os
 import shutil
-import subprocess as sp
+import traceback
+import time
+import resource
+import multiprocessing
 from collections import defaultdict
 from nipype.interfaces.base import (
     BaseInterface, TraitedSpec, Directory,
@@ -14,7 +17,14 @@ from torch.utils.data import DataLoader
 from pycurt.utils.torch import (
     resize_2Dimage, ZscoreNormalization, ToTensor,
     load_checkpoint, MRClassifierDataset_test)
-from pycurt.utils.filemanip import create_move_toDir
+from pycurt.utils.filemanip import (
+    create_move_toDir, materialise, materialise_tree)
+from pycurt.utils.dicom import decompress_dicoms
+from pycurt.utils.index import dicom_headers
+from pycurt.utils.cache import FeatureCache
+from pycurt.utils.rt import TimepointGraph
+from pycurt.utils.parallel import parallel_map
+from functools import partial
 import json
 import pickle
 from datetime import datetime as dt
@@ -40,11 +50,20 @@ class RTDataSortingInputSpec(BaseInterfaceInputSpec):
     input_dir = Directory(exists=True, help='Input directory to sort.')
     out_folder = Directory('RT_sorted_dir', usedefault=True,
                            desc='RT data sorted folder.')
+    plan_table = File('plan_table.csv', usedefault=True,
+                      desc='CSV file with all the RT plans found and the one '
+                      'selected for each timepoint.')
+    summary = File('rt_sorting_summary.json', usedefault=True,
+                   desc='JSON file with the outcome of the sorting of each timepoint.')
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of timepoints sorted in parallel.')
 
 
 class RTDataSortingOutputSpec(TraitedSpec):
     
     out_folder = Directory(help='RT Sorted folder.')
+    plan_table = File(help='CSV file with the RT plans found.')
+    summary = File(help='JSON file with the outcome of the sorting of each timepoint.')
 
 
 class RTDataSorting(BaseInterface):
@@ -69,197 +88,176 @@ class RTDataSorting(BaseInterface):
 #         other_tps = [x for r in other_modalities
 #                      for x in glob.glob(input_dir+'/*/*/{}'.format(r))]
 
-        for tp_folder in input_tp_folder:
-            sub_name, tp = tp_folder.split('/')[-2:]
-#             out_basedir = os.path.join(out_dir, sub_name, 'RT_'+tp)
-            out_basedir = os.path.join(out_dir, sub_name, tp+'_RT')
-            print('Processing Sub: {0}, timepoint: {1}'.format(sub_name, tp))
-
-            plan_name, rtstruct_instance, dose_cubes_instance = self.extract_plan(
-                os.path.join(tp_folder, 'RTPLAN'), os.path.join(out_basedir, 'RTPLAN'))
-            if plan_name is None:
-#                 out_basedir = os.path.join(out_dir, sub_name, 'CT_'+tp)
-                out_basedir = os.path.join(out_dir, sub_name, tp+'_CT')
-                if not os.path.isdir(out_basedir+'/CT'):
-                    if os.path.isdir(tp_folder+'/CT'):
-                        shutil.copytree(tp_folder+'/CT', out_basedir+'/CT')
-#                 session_dict['CT'].append([out_basedir, dt.strptime(tp, '%Y%m%d')])
-                continue
-#             else:
-#                 session_dict['RT'].append([out_basedir, dt.strptime(tp, '%Y%m%d')])
-            if rtstruct_instance is not None:
-                ct_classInstance = self.extract_struct(os.path.join(tp_folder, 'RTSTRUCT'),
-                                                       rtstruct_instance,
-                                                       os.path.join(out_basedir, 'RTSTRUCT'))
-            else:
-                print('The RTSTRUCT was not found. With no RTSTRUCT, '
-                      'the planning CT instances cannot be extracted')
-                ct_classInstance = None
-            if ct_classInstance is not None:
-                self.extract_BPLCT(os.path.join(tp_folder, 'CT'), ct_classInstance,
-                                   os.path.join(out_basedir, 'RTCT'))
-            if dose_cubes_instance is not None:
-                self.extract_dose_cubes(os.path.join(tp_folder, 'RTDOSE'), dose_cubes_instance,
-                                        os.path.join(out_basedir, 'RTDOSE'))
+        # the timepoints are independent, a failure in one does not stop the others
+        results = parallel_map(partial(self.sort_timepoint, out_dir=out_dir),
+                               sorted(input_tp_folder),
+                               n_workers=self.inputs.num_workers, executor='thread')
+        plans = [x for r in results for x in r.pop('plans')]
+        failed = [r for r in results if r['status'] == 'failed']
+        print('RT sorting: {0} timepoints sorted, {1} failed'.format(
+            len(results)-len(failed), len(failed)))
+        for r in failed:
+            print('Sub: {0}, timepoint: {1} failed: {2}'.format(
+                r['subject'], r['timepoint'], r['error']))
+        with open(os.path.abspath(self.inputs.summary), 'w') as f:
+            json.dump(results, f, indent=2)
 #         for tp_folder in other_tps:
 #             sub_name, tp = tp_folder.split('/')[-3:-1]
 #             out_basedir = os.path.join(out_dir, sub_name, tp)
 #             if not os.path.isdir(out_basedir):
 #                 os.makedirs(out_basedir)
 #             scan_folders = [x for x in glob.glob(tp_folder+'/*') if os.path.isdir(x)]
-#             [shutil.copytree(x, os.path.join(out_basedir, x.split('/')[-1]))
+#             [materialise_tree(x, os.path.join(out_basedir, x.split('/')[-1]))
 #              for x in scan_folders]
 #             session_dict['MR'].append([out_basedir, dt.strptime(tp, '%Y%m%d')])
+        write_plan_table(plans, os.path.abspath(self.inputs.plan_table))
 
         return runtime
 
-    def extract_plan(self, dir_name, out_dir):
+    def sort_timepoint(self, tp_folder, out_dir):
+        """Function to sort the RT data of one timepoint. It returns a summary
+        dictionary with the outcome, the unresolved references and the plan table.
+        If the sorting fails, the error is recorded in the summary and the
+        partial outputs of the timepoint are removed.
+        """
+        sub_name, tp = tp_folder.split('/')[-2:]
+        summary = {'subject': sub_name, 'timepoint': tp, 'status': 'sorted',
+                   'plan': None, 'unresolved': [], 'error': None, 'plans': []}
+        try:
+            self._sort_timepoint(tp_folder, out_dir, summary)
+        except Exception:
+            summary['status'] = 'failed'
+            summary['error'] = traceback.format_exc()
+            for session in [tp+'_RT', tp+'_CT']:
+                if os.path.isdir(os.path.join(out_dir, sub_name, session)):
+                    shutil.rmtree(os.path.join(out_dir, sub_name, session))
+
+        return summary
+
+    def _sort_timepoint(self, tp_folder, out_dir, summary):
+
+        sub_name, tp = tp_folder.split('/')[-2:]
+#             out_basedir = os.path.join(out_dir, sub_name, 'RT_'+tp)
+        out_basedir = os.path.join(out_dir, sub_name, tp+'_RT')
+        print('Processing Sub: {0}, timepoint: {1}'.format(sub_name, tp))
+        graph = TimepointGraph(tp_folder)
+        summary['unresolved'] = graph.unresolved
+
+        plan_name, rtstruct_instance, dose_cubes_instance, table = self.extract_plan(
+            os.path.join(tp_folder, 'RTPLAN'), os.path.join(out_basedir, 'RTPLAN'),
+            graph)
+        summary['plans'] = [dict(x, subject=sub_name, timepoint=tp) for x in table]
+        summary['plan'] = plan_name
+        if plan_name is None:
+#                 out_basedir = os.path.join(out_dir, sub_name, 'CT_'+tp)
+            out_basedir = os.path.join(out_dir, sub_name, tp+'_CT')
+            if not os.path.isdir(out_basedir+'/CT'):
+                if os.path.isdir(tp_folder+'/CT'):
+                    materialise_tree(tp_folder+'/CT', out_basedir+'/CT')
+#                 session_dict['CT'].append([out_basedir, dt.strptime(tp, '%Y%m%d')])
+            summary['status'] = 'no_plan'
+            return
+#             else:
+#                 session_dict['RT'].append([out_basedir, dt.strptime(tp, '%Y%m%d')])
+        if rtstruct_instance is not None:
+            ct_classInstance, frame_of_reference = self.extract_struct(
+                os.path.join(tp_folder, 'RTSTRUCT'), rtstruct_instance,
+                os.path.join(out_basedir, 'RTSTRUCT'), graph)
+        else:
+            print('The RTSTRUCT was not found. With no RTSTRUCT, '
+                  'the planning CT instances cannot be extracted')
+            ct_classInstance, frame_of_reference = None, None
+        if ct_classInstance is not None:
+            self.extract_BPLCT(os.path.join(tp_folder, 'CT'), ct_classInstance,
+                               os.path.join(out_basedir, 'RTCT'), graph,
+                               frame_of_reference=frame_of_reference)
+        if dose_cubes_instance is not None:
+            self.extract_dose_cubes(os.path.join(tp_folder, 'RTDOSE'), dose_cubes_instance,
+                                    os.path.join(out_basedir, 'RTDOSE'), graph)
+
+    def extract_plan(self, dir_name, out_dir, graph):
     
         # FInding the RTplan which was used.( taking the last approved plan)
         # From the RTplan metadata, the structure and the doseCubes instance were taken
         if not os.path.isdir(dir_name):
             print('RT plan was not found. With no plan, the doseCubes, '
                   'struct, and planning CT instances cannot be extracted')
-            return None, None, None
-            
-        plan_date, plan_time = 0, 0
-        dose_cubes_instance = []
-        plan_name = None
-        radiation_type = defaultdict(list)
-
-        dcm_files = glob.glob(dir_name+'/*/*.dcm')
-    
-        # check if multiple radiation treatment has been given
-        for f in dcm_files:
-            try:
-                ds = pydicom.dcmread(f, force=True)
-            except:
-                continue
-            if hasattr(ds, 'BeamSequence'):
-                rt = ds.BeamSequence[0].RadiationType
-            elif hasattr(ds, 'IonBeamSequence'):
-                rt = ds.IonBeamSequence[0].RadiationType
-            radiation_type[rt].append(f)
-
-        for f in dcm_files:
-            try:
-                ds = pydicom.dcmread(f, force=True)
-            except:
-                continue
-            # check if RT plan has plan intent attribute and approval status
-                # .If no, default taken as curative and approved
-            if hasattr(ds, 'ApprovalStatus'):
-                status_check = ds.ApprovalStatus
-            else:
-                status_check = 'APPROVED'
-            if hasattr(ds, 'PlanIntent '):
-                plan_intent_check = ds.PlanIntent
-            else:
-                plan_intent_check = 'CURATIVE'
-            if status_check == 'APPROVED' and plan_intent_check == 'CURATIVE':
-                plan_curr_plan_date = float(ds.RTPlanDate)
-                plan_curr_plan_time = float(ds.RTPlanTime)
-                if plan_curr_plan_date > plan_date:
-                    plan_date = plan_curr_plan_date
-                    plan_time = plan_curr_plan_time
-                    plan_name = f
-                elif plan_curr_plan_date == plan_date:
-                    if plan_curr_plan_time > plan_time:
-                        plan_date = plan_curr_plan_date
-                        plan_time = plan_curr_plan_time
-                        plan_name = f
-        if plan_name is None:
-            return None,None,None
-
-        ds = pydicom.dcmread(plan_name, force=True)
-        try:
-            rtstruct_instance = (ds.ReferencedStructureSetSequence[0]
-                                 .ReferencedSOPInstanceUID)
-        except:
-            rtstruct_instance=None
-        try:
-            for i in range(0, len(ds.ReferencedDoseSequence)):
-                singleDose_instance = (ds.ReferencedDoseSequence[i]
-                                       .ReferencedSOPInstanceUID + '.dcm')
-                dose_cubes_instance.append(singleDose_instance)
-        except:
+            return None, None, None, []
+
+        dcm_files = [x for x in graph.headers if x.startswith(dir_name+'/')]
+        table = plan_table(dcm_files, [graph.headers[x] for x in dcm_files])
+        plan = select_plan(table)
+        if plan is None:
+            return None, None, None, table
+        plan_name = plan['file']
+        rtstruct_instance = plan['referenced_structure_set']
+        if plan['referenced_doses'] is not None:
+            dose_cubes_instance = [x + '.dcm' for x in plan['referenced_doses']]
+        else:
             dose_cubes_instance = None
 
         plan_dir_old = os.path.split(plan_name)[0]
         plan_dir = os.path.join(out_dir, '1-RTPLAN_Used')
         os.makedirs(plan_dir)
-        shutil.copy2(plan_name, plan_dir)
+        materialise(plan_name, plan_dir)
         other_plan = [x for x in glob.glob(dir_name+'/*') if x != plan_dir_old]
         if other_plan:
             other_dir = os.path.join(out_dir, 'Other_RTPLAN')
             os.makedirs(other_dir)
-            [shutil.copytree(x, os.path.join(other_dir, x.split('/')[-1]))
+            [materialise_tree(x, os.path.join(other_dir, x.split('/')[-1]))
              for x in other_plan]
 
-        return plan_name, rtstruct_instance, dose_cubes_instance
+        return plan_name, rtstruct_instance, dose_cubes_instance, table
 
-    def extract_struct(self, dir_name, rtstruct_instance, out_dir):
+    def extract_struct(self, dir_name, rtstruct_instance, out_dir, graph):
         # FInding the RTstruct which was used.( based on the RTsrtuct reference instance in
         # the RTplan metadata)
-        ct_class_instance = None
+        ct_class_instance, frame_of_reference = None, None
         if not os.path.exists(dir_name) and not os.path.isdir(dir_name):
             print('RTStruct was not found..')
-            return None
-        dcm_files=glob.glob(dir_name+'/*/*.dcm')
-        for f in dcm_files:
-            ds = pydicom.dcmread(f,force=True)
-            if ds.SOPInstanceUID == rtstruct_instance:
-                try:
-                    ct_class_instance = ds.ReferencedFrameOfReferenceSequence[0] \
-                    .RTReferencedStudySequence[0].RTReferencedSeriesSequence[0] \
-                    .SeriesInstanceUID
-                except:
-                    ct_class_instance = None          
-                struct_dir = os.path.join(out_dir, '1-RTSTRUCT_Used')
-                os.makedirs(struct_dir)
-                shutil.copy2(f, struct_dir)
-                break
-        struct_old_dir = os.path.split(f)[0]
+            return None, None
+        struct_old_dir = None
+        f = graph.file('RTSTRUCT', rtstruct_instance, 'RTSTRUCT referenced by the RTPLAN')
+        if f is not None:
+            ct_class_instance = graph.headers[f].get('ReferencedSeriesUID')
+            frame_of_reference = graph.headers[f].get('ReferencedFrameOfReferenceUID')
+            struct_dir = os.path.join(out_dir, '1-RTSTRUCT_Used')
+            os.makedirs(struct_dir)
+            materialise(f, struct_dir)
+            struct_old_dir = os.path.split(f)[0]
         other_rt = [x for x in glob.glob(dir_name+'/*') if x != struct_old_dir]
         if other_rt:
             other_dir = os.path.join(out_dir, 'Other_RTSTRUCT')
             os.makedirs(other_dir)
-            [shutil.copytree(x, os.path.join(other_dir, x.split('/')[-1]))
+            [materialise_tree(x, os.path.join(other_dir, x.split('/')[-1]))
              for x in other_rt]
 
-        return ct_class_instance
+        return ct_class_instance, frame_of_reference
 
-    def extract_BPLCT(self, dir_name, ct_class_instance, out_dir):
+    def extract_BPLCT(self, dir_name, ct_class_instance, out_dir, graph,
+                      frame_of_reference=None):
 
         if not os.path.exists(dir_name) and not os.path.isdir(dir_name):
             print('BPLCT was not found..')
             return None
 
-        dcm_folders = glob.glob(dir_name+'/*')
-        for image in dcm_folders:
-            img_name = image.split('/')[-1]
-            dcm_files=[os.path.join(image, item) for item in os.listdir(image)
-                       if ('.dcm' in item)]
-            try:
-                ds = pydicom.dcmread(dcm_files[0],force=True)
-                series_instance_uid = ds.SeriesInstanceUID
-            except:
-                series_instance_uid = ''
-            if  series_instance_uid == ct_class_instance:
-                BPLCT_dir = os.path.join(out_dir, '1-BPLCT_Used_'+img_name)
-                os.makedirs(BPLCT_dir)
-                for f in dcm_files:
-                    shutil.copy2(f, BPLCT_dir)
-                break
-        ct_old_dir = os.path.split(f)[0]
+        ct_old_dir = graph.folder('CT', ct_class_instance, 'CT referenced by the RTSTRUCT',
+                                  frame_of_reference=frame_of_reference)
+        if ct_old_dir is not None:
+            img_name = ct_old_dir.split('/')[-1]
+            BPLCT_dir = os.path.join(out_dir, '1-BPLCT_Used_'+img_name)
+            os.makedirs(BPLCT_dir)
+            for item in os.listdir(ct_old_dir):
+                if '.dcm' in item:
+                    materialise(os.path.join(ct_old_dir, item), BPLCT_dir)
         other_ct = [x for x in glob.glob(dir_name+'/*') if x != ct_old_dir]
         if other_ct:
             other_dir = os.path.join(out_dir, 'Other_CT')
             os.makedirs(other_dir)
-            [shutil.copytree(x, os.path.join(other_dir, x.split('/')[-1]))
+            [materialise_tree(x, os.path.join(other_dir, x.split('/')[-1]))
              for x in other_ct]
 
-    def extract_dose_cubes(self, dir_name, dose_cubes_instance, out_dir):
+    def extract_dose_cubes(self, dir_name, dose_cubes_instance, out_dir, graph):
 
         dose_physical_found = False
         dose_rbe_found = False
@@ -268,33 +266,44 @@ class RTDataSorting(BaseInterface):
             return None
 
         dcm_files = glob.glob(dir_name+'/*/*.dcm')
+        # the dose cubes are referenced by SOPInstanceUID (the file names are
+        # used when the header is not readable)
+        used = set()
+        for instance in dose_cubes_instance:
+            f = graph.file('RTDOSE', instance[:-4], 'RTDOSE referenced by the RTPLAN')
+            if f is not None:
+                used.add(f)
+        used.update(f for f in dcm_files if f.split('/')[-1] in dose_cubes_instance)
+        used = [f for f in dcm_files if f in used]
+        headers = {f: graph.headers.get(f) for f in used}
+        #check whether the doses are compressed, if yes decompress them all at once
+        compressed = [f for f in used if headers[f] is not None and headers[f].get(
+            'TransferSyntaxUID', ExplicitVRLittleEndian) not in NotCompressedPixelTransferSyntaxes]
+        if compressed:
+            decompress_dicoms(compressed, tool='dcmdjpeg',
+                              n_workers=self.inputs.num_workers)
 
         for f in dcm_files:
 #             indices = [i for i, x in enumerate(f) if x == "/"]
             folder_name, f_name = f.split('/')[-2:]
-            if all(f_name != dose_cubes_instance[i] \
-                   for i in range(0, len(dose_cubes_instance))) and dose_cubes_instance!="":
+            if f not in headers:
 #             if all(f[indices[-1]+1:] != dose_cubes_instance[i] \
 #                    for i in range(0, len(dose_cubes_instance))) and dose_cubes_instance!="":
 
                 other_dir = os.path.join(out_dir, 'Other_RTDOSE', folder_name)
                 if not os.path.isdir(other_dir):
                     os.makedirs(other_dir)
-                shutil.copy2(f, other_dir)
+                materialise(f, other_dir)
 #                 if not os.listdir(f[0:indices[-1]]):
 #                     os.rmdir(f[0:indices[-1]])
             else:
-                try:
-                    ds = pydicom.dcmread(f,force=True)
-                    dose_type = ds.DoseType
-                    dose_summation_type = ds.DoseSummationType
-                except:
+                hd = headers[f]
+                if hd is not None and 'DoseType' in hd and 'DoseSummationType' in hd:
+                    dose_type = hd['DoseType']
+                    dose_summation_type = hd['DoseSummationType']
+                else:
                     dose_type = ''
                     dose_summation_type = ''
-                #check whether the dose is compressed, if yes decompress
-                if ds.file_meta.TransferSyntaxUID not in \
-                        NotCompressedPixelTransferSyntaxes:
-                    self.decompress_dose(f)
                 if dose_type == 'EFFECTIVE':
                     if 'PLAN' in dose_summation_type:
                         rbe_name = '1-RBE_Used'
@@ -306,7 +315,7 @@ class RTDataSorting(BaseInterface):
                         rbe_dir = os.path.join(out_dir, rbe_name)
                         if not os.path.isdir(rbe_dir):
                             os.makedirs(rbe_dir)
-                        shutil.copy2(f, rbe_dir)
+                        materialise(f, rbe_dir)
                     else:
                         print('dose_RBE_Cube was not found.')
                 if dose_type == 'PHYSICAL':
@@ -320,24 +329,105 @@ class RTDataSorting(BaseInterface):
                         phy_dir = os.path.join(out_dir, phy_name)
                         if not os.path.isdir(phy_dir):
                             os.makedirs(phy_dir)
-                        shutil.copy2(f, phy_dir)
+                        materialise(f, phy_dir)
                     else:
                         print('dose_Physical_Cube was not found.')
 
-    def decompress_dose(self, i):
-
-        cmd = ("dcmdjpeg {0} {1} ".format(i, i))
-        sp.check_output(cmd, shell=True)
-
     def _list_outputs(self):
         outputs = self._outputs().get()
         if isdefined(self.inputs.out_folder):
             outputs['out_folder'] = os.path.abspath(
                 self.inputs.out_folder)
+        outputs['plan_table'] = os.path.abspath(self.inputs.plan_table)
+        outputs['summary'] = os.path.abspath(self.inputs.summary)
 
         return outputs
 
 
+PLAN_TABLE_COLUMNS = ['subject', 'timepoint', 'file', 'sop_instance_uid',
+                      'approval_status', 'plan_intent', 'plan_date', 'plan_time',
+                      'referenced_structure_set', 'referenced_doses',
+                      'radiation_type', 'selected']
+
+
+def plan_table(dcm_files, headers=None):
+    """Function to build the table of the RT plans of one timepoint. The
+    fields are taken from the header index, so each plan is parsed (header
+    only) at most once.
+    Parameters
+    ----------
+    dcm_files : list
+        list of RTPLAN files
+    headers : list
+        headers of the files, if already available
+    Returns
+    -------
+    table : list
+        list of dictionaries, one per readable plan, with the approval
+        status and plan intent (APPROVED and CURATIVE if missing), plan date
+        and time, referenced structure set and dose cubes UIDs and radiation type
+    """
+    if headers is None:
+        headers = dicom_headers(dcm_files)
+    table = []
+    for f, hd in zip(dcm_files, headers):
+        if hd is None:
+            continue
+        try:
+            plan_date = float(hd['RTPlanDate'])
+        except (KeyError, ValueError):
+            plan_date = None
+        try:
+            plan_time = float(hd.get('RTPlanTime', 0))
+        except ValueError:
+            plan_time = 0
+        table.append({
+            'file': f,
+            'sop_instance_uid': hd.get('SOPInstanceUID'),
+            'approval_status': hd.get('ApprovalStatus', 'APPROVED'),
+            'plan_intent': hd.get('PlanIntent', 'CURATIVE'),
+            'plan_date': plan_date,
+            'plan_time': plan_time,
+            'referenced_structure_set': hd.get('ReferencedStructureSetUID'),
+            'referenced_doses': hd.get('ReferencedDoseUIDs'),
+            'radiation_type': hd.get('RadiationType'),
+            'selected': False})
+
+    return table
+
+
+def select_plan(table):
+    """Function to select the plan used for the treatment, i.e. the last
+    (by plan date and then time) approved curative plan. The selected row
+    is marked in the table and returned (None if no plan can be selected).
+    """
+    selected = None
+    plan_date, plan_time = 0, 0
+    for plan in table:
+        if (plan['approval_status'] == 'APPROVED' and plan['plan_intent'] == 'CURATIVE'
+                and plan['plan_date'] is not None):
+            if plan['plan_date'] > plan_date or (
+                    plan['plan_date'] == plan_date and plan['plan_time'] > plan_time):
+                plan_date, plan_time = plan['plan_date'], plan['plan_time']
+                selected = plan
+    if selected is not None:
+        selected['selected'] = True
+
+    return selected
+
+
+def write_plan_table(table, out_file):
+
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PLAN_TABLE_COLUMNS)
+        writer.writeheader()
+        for plan in table:
+            row = dict(plan)
+            if row['referenced_doses'] is not None:
+                row['referenced_doses'] = ';'.join(row['referenced_doses'])
+            writer.writerow(row)
+
+
 class MRClassInputSpec(BaseInterfaceInputSpec):
     
     mr_images = traits.List(desc='List of MR images to be labelled.')
@@ -347,6 +437,16 @@ class MRClassInputSpec(BaseInterfaceInputSpec):
         '(i.e. for T1 vs T1KM classification).')
     out_folder = Directory('MR_sorted_dir', usedefault=True,
                            desc='MR data sorted folder.')
+    batch_size = traits.Int(16, usedefault=True,
+                            desc='Number of images classified at once.')
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of processes used to load the images.')
+    cache_dir = Directory(desc='Folder where the preprocessed images are cached. '
+                          'Default is ~/.pycurt/mrclass_cache (or the '
+                          'PYCURT_FEATURE_CACHE environment variable).')
+    cache_size = traits.Float(2.0, usedefault=True,
+                              desc='Maximum size of the cache, in GB. 0 disables '
+                              'the cache.')
 
 class MRClassOutputSpec(TraitedSpec):
 
@@ -375,27 +475,16 @@ class MRClass(BaseInterface):
    
         data_transforms = transforms.Compose(
             [resize_2Dimage(256), ZscoreNormalization(), ToTensor()])
+        # every image is decoded and preprocessed only once, then all the
+        # classifiers run on the cached tensors
+        start = time.time()
+        tensors = self.preprocess(for_inference, data_transforms)
         for m in modalities:
             model = load_checkpoint(checkpoints[m])
-            test_dataset = MRClassifierDataset_test(
-                images=for_inference, dummy=os.path.join(RESOURCES_PATH, 'random.nii.gz'),
-                transform=data_transforms)  
-            test_dataloader = DataLoader(
-                test_dataset, batch_size=1, shuffle=False, num_workers=1)
-             
-            for _, data in enumerate(test_dataloader):
-                 
-                inputs = data['image']
-                img_name = data['name']
-                     
-                inputs = inputs.to(device)
-                output = model(inputs)
-                prob = output.data.cpu().numpy()
-                actRange = abs(prob[0][0])+abs(prob[0][1])
-                index = output.data.cpu().numpy().argmax()
-                     
+            for img_name, index, actRange in self.infer(
+                    model, for_inference, tensors, device):
                 if index == 0 and actRange > th[m]:
-                    labeled[img_name[0]].append([m,actRange])
+                    labeled[img_name].append([m,actRange])
          
         for key in labeled.keys():
             if len(labeled[key])>1:
@@ -416,32 +505,24 @@ class MRClass(BaseInterface):
                 list_images = [i[0] for i in labeled_images['DIFF']]
             else:
                 list_images = [i[0] for i in labeled_images[m]]
-            test_dataset = MRClassifierDataset_test(
-                images=list_images, dummy=os.path.join(RESOURCES_PATH, 'random.nii.gz'),
-                transform=data_transforms)  
-            test_dataloader = DataLoader(
-                test_dataset, batch_size = 1, shuffle=False, num_workers=8)
-            for _, data in enumerate(test_dataloader):
-                 
-                inputs = data['image']
-                img_name = data['name']
-                     
-                inputs = inputs.to(device)
-                output = model(inputs)
-                prob = output.data.cpu().numpy()
-                actRange = abs(prob[0][0])+abs(prob[0][1])
-                index = output.data.cpu().numpy().argmax()
+            for img_name, index, actRange in self.infer(
+                    model, list_images, tensors, device):
                 if m =='ADC':
                     if index == 0 and actRange > th[m]:
-                        labeled_s[img_name[0]].append([m,actRange])
+                        labeled_s[img_name].append([m,actRange])
                     else:
-                        labeled_s[img_name[0]].append([m+'KM',actRange])
+                        labeled_s[img_name].append([m+'KM',actRange])
                     continue
                              
                 if index == 0:
-                    labeled_s[img_name[0]].append([m,labeled[img_name[0]][0][1]])
+                    labeled_s[img_name].append([m,labeled[img_name][0][1]])
                 else:
-                    labeled_s[img_name[0]].append([m+'KM',labeled[img_name[0]][0][1]])
+                    labeled_s[img_name].append([m+'KM',labeled[img_name][0][1]])
+        elapsed = time.time() - start
+        print('MRClass: classified {0} images in {1:.1f}s ({2:.2f} images/sec, '
+              'batch size {3})'.format(len(for_inference), elapsed,
+                                       len(for_inference)/max(elapsed, 1e-6),
+                                       self.inputs.batch_size))
                          
         for key in labeled_s.keys():
             if labeled_s[key][0][0] != 'ADCKM':
@@ -483,6 +564,63 @@ class MRClass(BaseInterface):
 
         return runtime
 
+    def preprocess(self, images, data_transforms):
+        """Function to load and preprocess all the images once. The images
+        already preprocessed in a previous run are taken from the cache.
+        Returns a dictionary with the preprocessed tensor for each image.
+        """
+        start = time.time()
+        tensors = {}
+        cache = None
+        if self.inputs.cache_size > 0:
+            cache_dir = self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None
+            cache = FeatureCache(cache_dir, max_size=int(self.inputs.cache_size*1024**3))
+            keys = cache.keys(images, 'read_middle_slice|{!r}'.format(data_transforms))
+            tensors = {x: torch.from_numpy(y) for x, y in cache.get(keys).items()}
+        missing = [x for x in images if x not in tensors]
+
+        num_workers = self.inputs.num_workers
+        if multiprocessing.current_process().daemon:
+            # nipype MultiProc workers cannot have children
+            num_workers = 0
+        test_dataset = MRClassifierDataset_test(
+            images=missing, dummy=os.path.join(RESOURCES_PATH, 'random.nii.gz'),
+            transform=data_transforms)
+        test_dataloader = DataLoader(
+            test_dataset, batch_size=self.inputs.batch_size, shuffle=False,
+            num_workers=num_workers)
+        for data in test_dataloader:
+            for img_name, image in zip(data['name'], data['image']):
+                tensors[img_name] = image
+        if cache is not None:
+            cache.put([(keys[x], tensors[x].numpy()) for x in missing])
+        elapsed = time.time() - start
+        # ru_maxrss is in KB (the DataLoader workers are children)
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        print('MRClass: loaded {0} images ({1} from cache) in {2:.1f}s '
+              '({3:.1f} ms/image), peak RSS {4:.0f} MB'.format(
+                  len(images), len(images)-len(missing), elapsed,
+                  1000*elapsed/max(len(images), 1), peak_rss/1024))
+
+        return tensors
+
+    def infer(self, model, images, tensors, device):
+        """Function to run one classifier over the preprocessed images,
+        in batches. Returns a list of (image, predicted class, activation range).
+        """
+        batch_size = self.inputs.batch_size
+        results = []
+        with torch.no_grad():
+            for i in range(0, len(images), batch_size):
+                names = images[i:i+batch_size]
+                inputs = torch.stack([tensors[x] for x in names]).to(device)
+                prob = model(inputs).data.cpu().numpy()
+                for img_name, p in zip(names, prob):
+                    results.append((img_name, p.argmax(), abs(p[0])+abs(p[1])))
+
+        return results
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         if isdefined(self.inputs.out_folder):
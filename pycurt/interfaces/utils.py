@@ -1,21 +1,32 @@
 from nipype.interfaces.base import (
     BaseInterface, TraitedSpec, Directory, File,
     traits, BaseInterfaceInputSpec, InputMultiPath)
-import pydicom
 import numpy as np
-from pycurt.utils.dicom import dcm_check, dcm_info
+from pycurt.utils.dicom import (
+    analyse_series, clean_series, check_pixel_data, dose_headers)
+from pycurt.utils.index import (
+    get_header_index, dicom_header, SortingManifest)
 from pathlib import Path
 import shutil
+import gzip
+import time
 import os
 import nibabel as nib
 import glob
-from pycurt.utils.filemanip import split_filename, label_move_image
-from skimage.transform import resize
+from pycurt.utils.filemanip import (
+    split_filename, label_move_image, merge_tree, materialise, materialise_tree,
+    detach)
 import pydicom as pd
 import re
+import json
+import csv
+import fcntl
 from collections import defaultdict
 from nipype.interfaces.base import isdefined
-from pycurt.converters.dicom import DicomConverter
+from pycurt.converters.dicom import convert_series
+from pycurt.utils.parallel import parallel_map
+from pycurt.utils.rt import roi_dose_scores, rasterise_rtstruct
+from functools import partial
 from . import logging
 import SimpleITK as sitk
 from datetime import datetime as dt
@@ -26,6 +37,9 @@ iflogger = logging.getLogger('nipype.interface')
 
 
 RT_NAMES = ['RTSTRUCT', 'RTDOSE', 'RTPLAN', 'RTCT']
+RT_MODALITIES = ['RTSTRUCT', 'RTSS', 'RTDOSE', 'RTPLAN']
+# folders of a sorted session that come from its CT session (see FolderMerge)
+CT_SESSION_FOLDERS = ['CT', 'RTSTRUCT', 'RTDOSE', 'RTPLAN']
 POSSIBLE_NAMES = ['RTSTRUCT', 'RTDOSE', 'RTPLAN', 'T1KM', 'FLAIR',
                   'CT', 'ADC', 'T1', 'SWI', 'T2', 'T2KM', 'CT1',
                   'RTCT']
@@ -51,6 +65,7 @@ class DicomCheckOutputSpec(TraitedSpec):
     scan_name = traits.Str(desc='Scan name')
     dose_file = File(desc='Dose file, if any')
     dose_output = File()
+    timings = traits.Dict(desc='Time, in seconds, spent in each preparation step')
 
 
 class DicomCheck(BaseInterface):
@@ -63,6 +78,7 @@ class DicomCheck(BaseInterface):
         dicom_dir = self.inputs.dicom_dir
         wd = os.path.abspath(self.inputs.working_dir)
         self.dose_file = None
+        self.timings = {}
 
         img_paths = dicom_dir.split('/')
         scan_name = list(set(POSSIBLE_NAMES).intersection(img_paths))[0]
@@ -72,31 +88,18 @@ class DicomCheck(BaseInterface):
         if scan_name in RT_NAMES:
             if scan_name == 'RTDOSE':
                 scan_name = scan_name+'_{}.nii.gz'.format(img_paths[-1])
-            dicoms = sorted(os.listdir(dicom_dir))
-            if not os.path.isdir(wd):
-                os.makedirs(wd)
-            for item in dicoms:
-                curr_item = os.path.join(dicom_dir, item)
-                if os.path.isdir(curr_item):
-                    shutil.copytree(curr_item, wd)
-                else:
-                    shutil.copy2(curr_item, os.path.join(wd, item))
-                if scan_name == 'RTSTRUCT':
-                    rt_dcm = glob.glob(wd+'/*.dcm')[0]
-                    ds = pd.read_file(rt_dcm)
-                    regex = re.compile('[^a-zA-Z]')
-                    for i in range(len(ds.StructureSetROISequence)):
-                        new_roiname=regex.sub('', ds.StructureSetROISequence[i].ROIName)
-                        ds.StructureSetROISequence[i].ROIName = new_roiname
-                    ds.save_as(rt_dcm)
+            self.prepare_rt(dicom_dir, wd, scan_name)
         else:
-            dicoms, im_types, series_nums = dcm_info(dicom_dir)
-            dicoms = dcm_check(dicoms, im_types, series_nums)
+            start = time.time()
+            analysis = analyse_series(dicom_dir)
+            self.timings['analyse'] = time.time()-start
+            iflogger.info('{0}: {1}'.format(dicom_dir, analysis))
+            dicoms = analysis.dicoms
             if dicoms:
                 if not os.path.isdir(wd):
                     os.makedirs(wd)
                     for d in dicoms:
-                        shutil.copy2(d, wd)
+                        materialise(d, wd)
         self.outdir = wd
         self.scan_name = scan_name
         if 'RTDOSE' in scan_name:
@@ -105,10 +108,52 @@ class DicomCheck(BaseInterface):
 
         return runtime
 
+    def prepare_rt(self, dicom_dir, wd, scan_name):
+        """Function to prepare the working copy of an RT object in a single
+        pass: the files are materialised once and, for the RTSTRUCT, the ROI
+        names are sanitised and the structure set is saved once. The time
+        spent in each step is logged and stored in self.timings.
+        """
+        start = time.time()
+        if not os.path.isdir(wd):
+            os.makedirs(wd)
+        copied = []
+        for item in sorted(os.listdir(dicom_dir)):
+            curr_item = os.path.join(dicom_dir, item)
+            if os.path.isdir(curr_item):
+                materialise_tree(curr_item, os.path.join(wd, item))
+            else:
+                materialise(curr_item, os.path.join(wd, item))
+                copied.append(os.path.join(wd, item))
+        self.timings['materialise'] = time.time()-start
+
+        if scan_name == 'RTSTRUCT':
+            rt_dcms = sorted(x for x in copied if x.endswith('.dcm'))
+            if rt_dcms:
+                start = time.time()
+                rt_dcm = rt_dcms[0]
+                ds = pd.read_file(rt_dcm)
+                regex = re.compile('[^a-zA-Z]')
+                changed = False
+                for roi in getattr(ds, 'StructureSetROISequence', []):
+                    new_roiname = regex.sub('', roi.ROIName)
+                    if new_roiname != roi.ROIName:
+                        roi.ROIName = new_roiname
+                        changed = True
+                if changed:
+                    # the working copy may be a link to the sorted file
+                    detach(rt_dcm)
+                    ds.save_as(rt_dcm)
+                self.timings['sanitise'] = time.time()-start
+        iflogger.info('{0} prepared in {1:.2f} s ({2})'.format(
+            scan_name, sum(self.timings.values()), ', '.join(
+                '{0}: {1:.2f} s'.format(k, v) for k, v in self.timings.items())))
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['outdir'] = self.outdir
         outputs['scan_name'] = self.scan_name
+        outputs['timings'] = self.timings
         if self.dose_file is not None:
             outputs['dose_file'] = self.dose_file
             outputs['dose_output'] = self.dose_output
@@ -125,11 +170,16 @@ class ConversionCheckInputSpec(BaseInterfaceInputSpec):
                              ' needs to be checked after DICOM to NIFTI conversion')
     file_name = traits.Str(desc='Name that the converted file has to match'
                            ' in order to be considered correct.')
+    manifest = traits.Str('conversion_check.jsonl', usedefault=True, desc=(
+        'JSON lines file where the wrong conversions are recorded. It can be '
+        'shared by several nodes, so it is not part of the node hash and each '
+        'conversion is recorded only once.'))
 
 
 class ConversionCheckOutputSpec(TraitedSpec):
 
     out_file = traits.Str()
+    manifest = File(desc='JSON lines file with the wrong conversions.')
 
 
 class ConversionCheck(BaseInterface):
@@ -144,6 +194,7 @@ class ConversionCheck(BaseInterface):
         
         converted_old = converted[:]
         to_remove = []
+        reason = None
         base_dir = os.path.dirname(converted[0])
         extra = [x for x in converted if x.split('/')[-1]!='{}.nii.gz'.format(scan_name)]
         if len(extra) == len(converted):
@@ -165,38 +216,75 @@ class ConversionCheck(BaseInterface):
         if converted_old:
             self.converted = converted_old[0]
             try:
+                # shape and type are taken from the header, the data are read
+                # only to extract the first volume of 4D images
                 ref = nib.load(self.converted)
-                data = ref.get_data()
-                if len(data.squeeze().shape) == 2 or len(data.squeeze().shape) > 4:
+                shape = [x for x in ref.shape if x != 1]
+                if len(shape) == 2 or len(shape) > 4:
+                    reason = '{}D image'.format(len(shape))
                     if os.path.isfile(self.converted):
                         self.converted = None
-                elif len(data.squeeze().shape) == 4:
-                    im2save = nib.Nifti1Image(data[:, :, :, 0], affine=ref.affine)
+                elif len(shape) == 4:
+                    first = (slice(None), )*3+(0, )*(len(ref.shape)-3)
+                    im2save = nib.Nifti1Image(np.asanyarray(ref.dataobj[first]),
+                                              affine=ref.affine)
                     nib.save(im2save, self.converted)
-                elif len(data.dtype) > 0:
+                elif len(ref.get_data_dtype()) > 0:
                     iflogger.info('{} is not a greyscale image. It will'
                                   ' be deleted.'.format(self.converted))
+                    reason = 'not a greyscale image'
                     if os.path.isfile(self.converted):
                         self.converted = None
             except:
                 iflogger.info('{} failed to save with nibabel. '
                               'It will be deleted.'.format(self.converted))
+                reason = 'not readable with nibabel'
                 if os.path.isfile(self.converted):
                     self.converted = None
         else:
             self.converted = None
+            reason = 'no file named {}.nii.gz'.format(scan_name)
 
         if self.inputs.in_file and self.converted is None:
             outfile = self.inputs.in_file[0].split('.nii')[0]+'_WRONG_CONVERTION.nii.gz'
-            shutil.copy2(self.inputs.in_file[0], outfile)
+            # the data are linked, not copied (see materialise)
+            if not os.path.isfile(outfile):
+                materialise(self.inputs.in_file[0], outfile)
             self.converted = outfile
+            self.record(outfile, scan_name, reason)
 
         return runtime
 
+    def record(self, outfile, scan_name, reason):
+        "Append the wrong conversion to the manifest, if not already there"
+        manifest = os.path.abspath(self.inputs.manifest)
+        os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        with open(manifest, 'a+') as f:
+            # the manifest is shared by all the ConversionCheck nodes, which
+            # can run at the same time, so the check and the append are done
+            # holding an exclusive lock
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                for line in f:
+                    try:
+                        if json.loads(line)['out_file'] == outfile:
+                            return
+                    except (ValueError, KeyError):
+                        continue
+                f.write(json.dumps({'file_name': scan_name,
+                                    'in_file': list(self.inputs.in_file),
+                                    'out_file': outfile, 'reason': reason})+'\n')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         if self.converted is not None:
             outputs['out_file'] = self.converted
+        if os.path.isfile(os.path.abspath(self.inputs.manifest)):
+            outputs['manifest'] = os.path.abspath(self.inputs.manifest)
 
         return outputs
 
@@ -284,11 +372,19 @@ class CheckRTStructuresInputSpec(BaseInterfaceInputSpec):
     
     rois = InputMultiPath(File(exists=True), desc='RT structures to check')
     dose_file = File(exists=True, desc='Dose file.')
+    percentile = traits.Float(99, usedefault=True, desc=(
+        'Percentile of the positive dose values used to define the high '
+        'dose region.'))
+    scores = File('roi_scores.csv', usedefault=True,
+                  desc='Table with the overlap score of each candidate ROI.')
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of threads used to score the ROIs.')
 
 
 class CheckRTStructuresOutputSpec(TraitedSpec):
     
     checked_roi = File(exists=True, desc='ROI with the maximum overlap with the dose file.')
+    scores = File(desc='Table with the overlap score of each candidate ROI.')
 
 
 class CheckRTStructures(BaseInterface):
@@ -305,38 +401,33 @@ class CheckRTStructures(BaseInterface):
             rois1 = [x for x in rois if 'ptv' in x.split('/')[-1].lower()]
         if not rois1:
             rois1 = [x for x in rois if 'ctv' in x.split('/')[-1].lower()]
-        if not rois:
+        if not rois1:
             raise Exception('No GTV, PTV or CTV found in the rois! Please check')
 
         if len(rois1) > 1:
-            roi_dict = {}
-            dose = nib.load(dose_nii).get_data()
-            dose_vector = dose[dose > 0]
-            dose_maxvalue = np.percentile(dose_vector, 99)
-            ref_roi = nib.load(rois1[0]).get_data()
-            if dose.shape != ref_roi.shape:
-                dose = resize(dose, ref_roi.shape, order=0, mode='edge',
-                                   cval=0, anti_aliasing=False)
-
-            dose_bool = dose >= dose_maxvalue
-            
-            for f in rois1:
-                roi = nib.load(f).get_data()
-                roi_bool = roi > 0
-                nr_andvoxel = np.logical_and(dose_bool, roi_bool)
-                roi_dict[f] = np.sum(nr_andvoxel)/np.sum(roi_bool)
-            roi_tokeep = max(roi_dict, key=lambda key: roi_dict[key])
-            for key in roi_dict.keys():
-                if key == roi_tokeep:
-                    self.checked_roi = key
-        elif len(rois1) == 1:
+            scores = roi_dose_scores(rois1, dose_nii,
+                                     percentile=self.inputs.percentile,
+                                     n_workers=self.inputs.num_workers)
+            # max returns the first of the ROIs with the highest score
+            self.checked_roi = max(scores, key=lambda x: x[3])[0]
+        else:
+            scores = [(rois1[0], '', '', '')]
             self.checked_roi = rois1[0]
 
+        with open(self.inputs.scores, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['roi', 'voxels', 'overlap_voxels', 'score',
+                             'selected'])
+            for roi, n, overlap, score in scores:
+                writer.writerow([roi, n, overlap, score,
+                                 int(roi == self.checked_roi)])
+
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['checked_roi'] = self.checked_roi
+        outputs['scores'] = os.path.abspath(self.inputs.scores)
 
         return outputs
 
@@ -369,14 +460,10 @@ class GetRefRTDose(BaseInterface):
         elif doses: 
             dcms = [x for y in doses for x in glob.glob(y+'/*/*.dcm')]
 
-        right_dcm = []
-        for dcm in dcms:
-            hd = pydicom.read_file(dcm)
-            try:
-                hd.GridFrameOffsetVector
-                right_dcm.append(dcm)
-            except:
-                continue
+        headers = dict(zip(dcms, dose_headers(dcms)))
+        right_dcm = [x for x in dcms if headers[x] is not None
+                     and 'GridFrameOffsetVector' in headers[x]
+                     and check_pixel_data(headers[x])]
 
         dcms = right_dcm[:]
         if dcms and len(dcms)==1: 
@@ -385,8 +472,7 @@ class GetRefRTDose(BaseInterface):
             iflogger.info('More than one dose file') 
             processed = False 
             for dcm in dcms: 
-                hd = pydicom.read_file(dcm) 
-                dose_tp = hd.DoseSummationType 
+                dose_tp = headers[dcm]['DoseSummationType']
                 if not 'BEAM' in dose_tp and not processed: 
                     dose_file = dcm
                     processed = True 
@@ -417,11 +503,20 @@ class FileCheckInputSpec(BaseInterfaceInputSpec):
         -3, usedefault=True, desc='The position of the subject name in the splitted '
         'file path (file_path.split("/")). Default is -3, so it assumes that the subject '
         'name is in the third position starting from the end of the file path.')
+    num_workers = traits.Int(
+        1, usedefault=True, desc='Number of processes used to read the DICOM '
+        'headers. Default is 1.')
+    manifest_file = File(desc='Manifest of the DICOM files sorted by previous runs. '
+                         'If provided, only the series with new or changed files '
+                         '(and all the RT and CT series of the timepoints with new '
+                         'RT data) will be returned.')
 
 
 class FileCheckOutputSpec(TraitedSpec):
     
     out_list = traits.List(desc='Prepared folder.')
+    new_files = File(desc='JSON file with the DICOM files in out_list, to be '
+                     'recorded in the manifest once they have been sorted.')
 
 
 class FileCheck(BaseInterface):
@@ -440,51 +535,58 @@ class FileCheck(BaseInterface):
         scans = defaultdict(list)
         patient_names = defaultdict(list)
         scan_dates = defaultdict(list)
-        z = 0
-        for path, _, files in os.walk(input_dir):
-            for f in files:
-                if '.dcm' in f:
-                    filename = os.path.join(path, f)
-                    iflogger.info('Process number: {}\n File: {}'.format(z, filename))
-                    try:
-                        ds = pydicom.dcmread(filename, force = True)
-                    except:
-                        iflogger.info('{} could not be read, dicom '
+        file_info = {}
+        dicoms = [os.path.join(path, f) for path, _, files in os.walk(input_dir)
+                  for f in files if '.dcm' in f]
+        headers = get_header_index().headers(
+            dicoms, n_workers=self.inputs.num_workers)
+        for filename, hd in zip(dicoms, headers):
+            if hd is None:
+                iflogger.info('{} could not be read, dicom '
                               'file may be corrupted'.format(filename))
-                    try:
-                        seriesDescription=ds.SeriesDescription.upper().replace('_','')
-                    except:
-                        try:
-                            seriesDescription=ds.Modality.upper().replace('_','')
-                        except:
-                            seriesDescription='NONE'
-                    try:
-                        studyInstance = ds.StudyInstanceUID
-                    except:
-                        studyInstance='NONE'
-                    try:
-                        seriesInstance = ds.SeriesInstanceUID
-                    except:
-                        seriesInstance='NONE'
-                    key = seriesDescription +'_' + seriesInstance + '_' + studyInstance
-                    key = self.strip_non_ascii(re.sub(r'[^\w]', '', key))
-                    key = key.replace('_','-')
-                    scans[key].append(filename)
-                    if renaming:
-                        try:
-                            patient_names[key].append(ds.PatientID)
-                        except AttributeError:
-                            iflogger.info('No patient ID for {}'.format(filename))
-                            patient_names[key].append('Corrupted')
-                    else:
-                        sub_name = filename.split('/')[sub_name_position]
-                        patient_names[key].append(sub_name)
-                    try:
-                        scan_dates[key].append(ds.StudyDate)
-                    except:
-                        iflogger.info('No study date for {}'.format(filename))
-                        scan_dates[key].append('Corrupted')
-                    z += 1
+                hd = {}
+            if 'SeriesDescription' in hd:
+                seriesDescription = hd['SeriesDescription'].upper().replace('_','')
+            elif 'Modality' in hd:
+                seriesDescription = hd['Modality'].upper().replace('_','')
+            else:
+                seriesDescription = 'NONE'
+            studyInstance = hd.get('StudyInstanceUID', 'NONE')
+            seriesInstance = hd.get('SeriesInstanceUID', 'NONE')
+            key = seriesDescription +'_' + seriesInstance + '_' + studyInstance
+            key = self.strip_non_ascii(re.sub(r'[^\w]', '', key))
+            key = key.replace('_','-')
+            scans[key].append(filename)
+            if renaming:
+                if 'PatientID' in hd:
+                    patient_names[key].append(hd['PatientID'])
+                else:
+                    iflogger.info('No patient ID for {}'.format(filename))
+                    patient_names[key].append('Corrupted')
+            else:
+                sub_name = filename.split('/')[sub_name_position]
+                patient_names[key].append(sub_name)
+            if 'StudyDate' in hd:
+                scan_dates[key].append(hd['StudyDate'])
+            else:
+                iflogger.info('No study date for {}'.format(filename))
+                scan_dates[key].append('Corrupted')
+            st = os.stat(filename)
+            file_info[filename] = [hd.get('SOPInstanceUID', 'path:'+filename),
+                                   st.st_mtime_ns, st.st_size, key,
+                                   hd.get('Modality', '')]
+
+        if isdefined(self.inputs.manifest_file):
+            keys = self.new_series(scans, file_info, patient_names, scan_dates)
+            scans = {x: scans[x] for x in keys}
+            patient_names = {x: patient_names[x] for x in keys}
+            scan_dates = {x: scan_dates[x] for x in keys}
+        new_files = [[file_info[f][0], f]+file_info[f][1:]
+                     +[patient_names[key][0], scan_dates[key][0]]
+                     for key in scans for f in scans[key]]
+        with open(os.path.abspath('new_files.json'), 'w') as f:
+            json.dump(new_files, f)
+
         names = [patient_names[x][0] for x in patient_names.keys()]
         for s in set(names):
             temp_scan = {}
@@ -501,6 +603,26 @@ class FileCheck(BaseInterface):
 
         return runtime
 
+    def new_series(self, scans, file_info, patient_names, scan_dates):
+        """Return the series that have at least one file not in the manifest
+        (or changed since it was sorted). RT objects can only be linked together
+        if the whole timepoint is sorted again, so all the RT and CT series of a
+        timepoint with new RT data are returned as well.
+        """
+        manifest = SortingManifest(self.inputs.manifest_file)
+        known = manifest.known([(x[0], f)+tuple(x[1:3]) for f, x in file_info.items()])
+        new_keys = set(key for key in scans
+                       if [f for f in scans[key] if f not in known])
+        rt_timepoints = set((patient_names[key][0], scan_dates[key][0]) for key in new_keys
+                            if file_info[scans[key][0]][4] in RT_MODALITIES)
+        new_keys.update(key for key in scans
+                        if file_info[scans[key][0]][4] in RT_MODALITIES+['CT']
+                        and (patient_names[key][0], scan_dates[key][0]) in rt_timepoints)
+        iflogger.info('{0} out of {1} series are new or changed since the last sorting.'
+                      .format(len(new_keys), len(scans)))
+
+        return [x for x in scans if x in new_keys]
+
     def strip_non_ascii(self, string):
         ''' Returns the string without non ASCII characters'''
         stripped = (c for c in string if 0 < ord(c) < 127)
@@ -509,6 +631,7 @@ class FileCheck(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['out_list'] = self.out_list
+        outputs['new_files'] = os.path.abspath('new_files.json')
 
         return outputs
 
@@ -540,6 +663,7 @@ class FolderPreparation(BaseInterface):
         scans = input_list[0]
         patient_names = input_list[1]
         scan_dates = input_list[2]
+        copied = []
         for key in scans.keys():
             for file in scans[key]:
                 out_basename = os.path.join(patient_names[key][0],
@@ -547,7 +671,10 @@ class FolderPreparation(BaseInterface):
                 dir_name= os.path.join(output_dir, out_basename, key)
                 if not os.path.isdir(dir_name):
                     os.makedirs(dir_name)
-                shutil.copy2(Path(file), dir_name)
+                materialise(Path(file), dir_name)
+                copied.append((file, os.path.join(dir_name, os.path.basename(file))))
+        # the materialised files keep the headers already indexed by FileCheck
+        get_header_index().alias(copied)
 
         return runtime
 
@@ -570,7 +697,15 @@ class FolderSortingInputSpec(BaseInterfaceInputSpec):
     input_dir = Directory(exists=True, help='Input directory to sort.')
     out_folder = Directory('sorted_dir', usedefault=True,
                            desc='Prepared folder.')
-    
+    converter = traits.Enum('dcm2niix', 'native', usedefault=True,
+                            desc='Method used to convert the MR images to NIfTI. '
+                            '"native" converts them in process and falls back to '
+                            'dcm2niix for the series it does not support.')
+    compression = traits.Range(0, 9, 6, usedefault=True,
+                               desc='Gzip compression level used by the native '
+                               'converter.')
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of MR images converted in parallel.')
 
 
 class FolderSortingOutputSpec(TraitedSpec):
@@ -593,6 +728,7 @@ class FolderSorting(BaseInterface):
         
         images=glob.glob(input_dir+'/*/*/*')
         for_inference=[]
+        mr_images = []
 
         for i in images:
             if os.path.isdir(i):
@@ -601,34 +737,41 @@ class FolderSorting(BaseInterface):
             else:
                 continue
             try:
-                ds = pydicom.dcmread(dcm_files[0], force=True)
-                modality_check = ds.Modality
-            except:
+                modality_check = dicom_header(dcm_files[0])['Modality']
+            except (IndexError, KeyError, TypeError):
                 modality_check = ''
             if modality_check == 'RTSS':
                 modality_check = 'RTSTRUCT'
             if modality_check in modality_List:
                 label_move_image(i, modality_check, out_dir)
             elif modality_check=='MR' or modality_check=='OT':
-                #checking for duplicates or localizer
                 new_image, i = label_move_image(i, '', out_dir,
                                                 renaming=False)
-                dicoms, im_types, series_nums = dcm_info(new_image)
-                dicoms_fl = dcm_check(dicoms, im_types, series_nums)
-#                 corrupted = [f for f in dicoms if str(f) not in dicoms_fl]
-                [os.remove(f) for f in dicoms if str(f) not in dicoms_fl]
-                good = [f for f in dicoms if str(f) in dicoms_fl]
-#                 [os.remove(f) for f in dicoms if str(f) not in dicoms_fl]
-                if good:
-                    converter = DicomConverter(new_image)
-                    nifti_image = converter.convert(rename_dicom=True)
-                    if nifti_image is not None:
-                        for_inference.append(nifti_image)
-                    else:
-                        label_move_image(i, 'error_converting', out_dir)
-                        iflogger.info('Error converting', str(new_image))
+                mr_images.append((new_image, i))
             else:
                 label_move_image(i, 'Unknown_modality', out_dir)
+
+        #checking for duplicates or localizer, decompressing the series in parallel
+        analyses = parallel_map(clean_series, [x[0] for x in mr_images],
+                                n_workers=self.inputs.num_workers)
+        to_convert = [x for x, analysis in zip(mr_images, analyses)
+                      if analysis.dicoms]
+        print('{0} MR series analysed: {1} DICOM files removed, {2} headers '
+              'parsed'.format(len(analyses), sum(len(x.removed) for x in analyses),
+                              sum(x.header_reads for x in analyses)))
+
+        # the conversions are independent, so they run in parallel
+        nifti_images = parallel_map(
+            partial(convert_series, method=self.inputs.converter,
+                    compression=self.inputs.compression),
+            [x[0] for x in to_convert], n_workers=self.inputs.num_workers,
+            executor='process' if self.inputs.converter == 'native' else 'thread')
+        for (new_image, i), nifti_image in zip(to_convert, nifti_images):
+            if nifti_image is not None:
+                for_inference.append(nifti_image)
+            else:
+                label_move_image(i, 'error_converting', out_dir)
+                iflogger.info('Error converting', str(new_image))
         self.for_inference = for_inference
 
         return runtime
@@ -648,6 +791,15 @@ class FolderMergeInputSpec(BaseInterfaceInputSpec):
     input_list = traits.List(help='Input directory to sort.')
     out_folder = Directory('Sorted_Data', usedefault=True,
                            desc='Prepared folder.')
+    sorted_dir = Directory(desc='Existing sorted folder, from previous runs, the '
+                           'results will be merged into. Sessions already there '
+                           'keep their name, unless a new RT timepoint is added to '
+                           'their subject, and RT sessions sorted again replace '
+                           'the old ones.')
+    new_files = File(desc='JSON file, generated by FileCheck, with the DICOM files '
+                     'sorted in this run.')
+    manifest_file = File(desc='Manifest where to record the DICOM files sorted '
+                         'in this run.')
 
 
 class FolderMergeOutputSpec(TraitedSpec):
@@ -669,10 +821,17 @@ class FolderMerge(BaseInterface):
         session_dict['RT'] = []
         session_dict['CT'] = []
         session_dict['MR'] = []
+        reference_rt = []
+        replaced = []
+        relabelled = []
 
         for directories in input_list:
-            mr_dir = directories[0]
-            rt_dir = directories[1]
+            if isinstance(directories, str):
+                # only RT sorting has been run
+                mr_dir, rt_dir = None, directories
+            else:
+                mr_dir = directories[0]
+                rt_dir = directories[1]
             if mr_dir is None or not os.path.isdir(mr_dir):
                 iflogger.info('No MRI data found')
                 mr_tocopy = []
@@ -701,45 +860,171 @@ class FolderMerge(BaseInterface):
             if sub_name is not None:
                 if not os.path.isdir(os.path.join(out_dir, sub_name)):
                     os.makedirs(os.path.join(out_dir, sub_name))
+                existing = self.existing_sessions(sub_name)
+                existing_rt = [[os.path.join(self.inputs.sorted_dir, sub_name, x),
+                                dt.strptime(x.split('_RT')[0], '%Y%m%d')]
+                               for x in existing if x.endswith('_RT')]
+                new_rt = [[x, dt.strptime(x.split('/')[-1].split('_RT')[0], '%Y%m%d')]
+                          for x in rt_tocopy if x.endswith('_RT')
+                          and x.split('/')[-1] not in existing]
+                if self.rt_timepoints(new_rt, reference_rt=existing_rt)[0]:
+                    # a new RT timepoint changes the labels of the sessions around
+                    # it, so the existing sessions are labelled again together with
+                    # the new ones. The old ones are removed once they are ready
+                    for session in [x for x in existing if not x.endswith('_RT')
+                                    and re.match(r'\d{8}(_|$)', x)]:
+                        for path, kind in self.unlabel_session(sub_name, session, out_dir):
+                            if path not in [x[0] for x in session_dict[kind]]:
+                                session_dict[kind].append([path, dt.strptime(
+                                    path.split('/')[-1].split('_')[0], '%Y%m%d')])
+                        replaced.append(os.path.join(self.inputs.sorted_dir, sub_name,
+                                                     session))
+                        relabelled.append(replaced[-1])
+                    existing = [x for x in existing if x.endswith('_RT')
+                                or not re.match(r'\d{8}(_|$)', x)]
                 for folder in mr_tocopy+rt_tocopy:
                     folder_name = folder.split('/')[-1]
-                    shutil.copytree(folder, os.path.join(
-                        out_dir, sub_name, folder_name))
+                    if folder_name.endswith('_RT') and folder_name in existing:
+                        # the whole RT timepoint has been sorted again. The old
+                        # one is removed only once the new one is ready
+                        replaced.append(os.path.join(self.inputs.sorted_dir, sub_name,
+                                                     folder_name))
+                        existing.remove(folder_name)
+                        existing_rt = [x for x in existing_rt
+                                       if x[0].split('/')[-1] != folder_name]
+                    elif not folder_name.endswith('_RT'):
+                        same_date = [x for x in existing if not x.endswith('_RT')
+                                     and x.split('_')[0] == folder_name.split('_')[0]]
+                        if same_date:
+                            # new scans of a session that has already been labelled
+                            merge_tree(folder, os.path.join(out_dir, sub_name, same_date[0]))
+                            continue
+                    out_folder = os.path.join(out_dir, sub_name, folder_name)
+                    if os.path.isdir(out_folder):
+                        # new scans of an existing session being labelled again
+                        merge_tree(folder, out_folder)
+                        continue
+                    materialise_tree(folder, out_folder)
                     if folder in mr_tocopy:
-                        session_dict['MR'].append([os.path.join(
-                            out_dir, sub_name, folder_name),
+                        session_dict['MR'].append([out_folder,
                             dt.strptime(folder_name, '%Y%m%d')])
                     else:
                         if '_CT' in folder:
-                            session_dict['CT'].append([os.path.join(
-                            out_dir, sub_name,folder_name),
+                            session_dict['CT'].append([out_folder,
                             dt.strptime(folder_name.split('_CT')[0], '%Y%m%d')])
                         elif '_RT' in folder:
-                            session_dict['RT'].append([os.path.join(
-                            out_dir, sub_name,folder_name),
+                            session_dict['RT'].append([out_folder,
                             dt.strptime(folder_name.split('_RT')[0], '%Y%m%d')])
+                reference_rt += existing_rt
 
-        self.session_labelling(session_dict)
+        self.session_labelling(session_dict, reference_rt=reference_rt)
+        if isdefined(self.inputs.manifest_file):
+            self.update_manifest(out_dir, replaced=replaced, relabelled=relabelled)
+        for session in replaced:
+            shutil.rmtree(session)
 
         return runtime
 
-    def session_labelling(self, session_dict):
+    def existing_sessions(self, sub_name):
+        """Return the sessions of sub_name already in the sorted folder."""
+        if not isdefined(self.inputs.sorted_dir):
+            return []
+        sub_dir = os.path.join(self.inputs.sorted_dir, sub_name)
+        if not os.path.isdir(sub_dir):
+            return []
+        return sorted(x for x in os.listdir(sub_dir)
+                      if os.path.isdir(os.path.join(sub_dir, x)))
+
+    def unlabel_session(self, sub_name, session, out_dir):
+        """Copy an existing session of sub_name into out_dir with the names
+        it had before the labelling: the date for the MR part and date_CT for
+        the CT part (CT_SESSION_FOLDERS). Returns the list of (path, kind) of
+        the copied sessions, where kind is "MR" or "CT".
+        """
+        src = os.path.join(self.inputs.sorted_dir, sub_name, session)
+        date = session.split('_')[0]
+        copied = []
+        for name in sorted(os.listdir(src)):
+            kind = 'CT' if name in CT_SESSION_FOLDERS else 'MR'
+            dst = os.path.join(out_dir, sub_name, (date+'_CT') if kind == 'CT' else date)
+            if os.path.isdir(os.path.join(src, name)):
+                merge_tree(os.path.join(src, name), os.path.join(dst, name))
+            else:
+                os.makedirs(dst, exist_ok=True)
+                materialise(os.path.join(src, name), dst)
+            if (dst, kind) not in copied:
+                copied.append((dst, kind))
+
+        return copied
+
+    def update_manifest(self, out_dir, replaced=[], relabelled=[]):
+        """Record the files sorted in this run, together with the session
+        they have been sorted into, in the manifest. The files already in the
+        manifest whose session has been labelled again (relabelled) are
+        recorded with their new session. The sessions in replaced are not
+        considered, since they are going to be removed.
+        """
+        with open(self.inputs.new_files, 'r') as f:
+            new_files = json.load(f)
+        manifest = SortingManifest(self.inputs.manifest_file)
+        if relabelled:
+            new_files += [list(x[:8]) for x in manifest.sorted_into(relabelled)]
+        if isdefined(self.inputs.sorted_dir):
+            sorted_dir = self.inputs.sorted_dir
+        else:
+            sorted_dir = out_dir
+        sessions = {}
+        for sub_dir in [out_dir, sorted_dir]:
+            for sub_name in (os.listdir(sub_dir) if os.path.isdir(sub_dir) else []):
+                if os.path.isdir(os.path.join(sub_dir, sub_name)):
+                    sessions.setdefault(sub_name, set()).update(
+                        x for x in os.listdir(os.path.join(sub_dir, sub_name))
+                        if os.path.join(sub_dir, sub_name, x) not in replaced)
+        entries = []
+        for uid, path, mtime, size, key, modality, patient, date in new_files:
+            candidates = sorted(x for x in sessions.get(patient, [])
+                                if x.split('_')[0] == date)
+            rt = [x for x in candidates if x.endswith('_RT')]
+            other = [x for x in candidates if not x.endswith('_RT')]
+            if modality in RT_MODALITIES and rt:
+                destination = os.path.join(sorted_dir, patient, rt[0])
+            elif other:
+                destination = os.path.join(sorted_dir, patient, other[0])
+            elif candidates:
+                destination = os.path.join(sorted_dir, patient, candidates[0])
+            else:
+                destination = None
+            entries.append((uid, path, mtime, size, key, modality, patient, date,
+                            destination))
+        manifest.update(entries)
+        iflogger.info('{} DICOM files recorded in the sorting manifest.'.format(len(entries)))
+
+    def rt_timepoints(self, rt_sessions, reference_rt=[]):
+        """Split rt_sessions, a list of [path, date], into RT timepoints and
+        RT sessions within 42 days of a previous timepoint, which are labelled
+        as CT sessions. The RT sessions sorted in previous runs (reference_rt)
+        are always timepoints, so a new RT session within 42 days of one of
+        them, before or after it, is not a timepoint.
+        """
+        timepoints = []
+        others = []
+        for rt_session in sorted(rt_sessions, key=lambda x: x[1]):
+            if [x for x in timepoints+reference_rt
+                    if abs((rt_session[1]-x[1]).days) <= 42]:
+                others.append(rt_session)
+            else:
+                timepoints.append(rt_session)
+
+        return timepoints, others
+
+    def session_labelling(self, session_dict, reference_rt=[]):
         
-        rt_sessions = sorted(session_dict['RT'])
-        ct_sessions = sorted(session_dict['CT'])
-        mr_sessions = sorted(session_dict['MR'])
-        toremove = []
-        if len(rt_sessions) > 1:
-            rt_ref = rt_sessions[0]
-            for i, rt_session in enumerate(rt_sessions[1:]):
-                diff = (rt_session[1]-rt_ref[1]).days
-                if diff <= 42:
-                    toremove.append(rt_session)
-                    ct_sessions.append(rt_session)
-                else:
-                    rt_ref = rt_session
-        for f in toremove:
-            rt_sessions.remove(f)
+        rt_sessions, others = self.rt_timepoints(session_dict['RT'], reference_rt)
+        ct_sessions = sorted(session_dict['CT'], key=lambda x: x[1])+others
+        mr_sessions = sorted(session_dict['MR'], key=lambda x: x[1])
+        # RT sessions sorted in previous runs, only used as reference for the
+        # labelling. They are in another folder, so they are sorted by date
+        rt_sessions = sorted(rt_sessions+reference_rt, key=lambda x: x[1])
         
         mr_sessions_groups = []
         ct_sessions_groups = []
@@ -829,6 +1114,12 @@ class MHA2NIIConverterInputSpec(BaseInterfaceInputSpec):
     input_folder = Directory(help='Input directory to convert.')
     out_folder = Directory('Nifti_Data', usedefault=True,
                            desc='Folder with converted data.')
+    compression = traits.Range(low=0, high=9, value=6, usedefault=True, desc=(
+        'Gzip compression level. 0 saves uncompressed .nii files.'))
+    skip_empty = traits.Bool(True, usedefault=True, desc=(
+        'Whether or not to skip the empty masks.'))
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of threads used for the conversion.')
 
 
 class MHA2NIIConverterOutputSpec(TraitedSpec):
@@ -846,17 +1137,37 @@ class MHA2NIIConverter(BaseInterface):
         
         toconvert = sorted(glob.glob(
             os.path.join(self.inputs.input_folder, '*.mha')))
-        self.converted_files = []
-        if toconvert:
-            for mha in toconvert:
-                filename = mha.split('/')[-1].split('.mha')[0]
-                outfile = filename+'.nii.gz'
-                mha_file = sitk.ReadImage(mha)
-                sitk.WriteImage(mha_file, outfile)
-                self.converted_files.append(os.path.abspath(outfile))
+        converted = parallel_map(self.convert, toconvert,
+                                 self.inputs.num_workers, executor='thread')
+        self.converted_files = [x for x in converted if x is not None]
+        if len(self.converted_files) < len(toconvert):
+            print('{} empty masks were skipped'.format(
+                len(toconvert)-len(self.converted_files)))
 
         return runtime
 
+    def convert(self, mha):
+
+        filename = mha.split('/')[-1].split('.mha')[0]
+        mha_file = sitk.ReadImage(mha)
+        if self.inputs.skip_empty:
+            stats = sitk.MinimumMaximumImageFilter()
+            stats.Execute(mha_file)
+            if stats.GetMinimum() == 0 and stats.GetMaximum() == 0:
+                return None
+        outfile = os.path.abspath(filename+'.nii')
+        sitk.WriteImage(mha_file, outfile)
+        if self.inputs.compression > 0:
+            # SimpleITK does not allow to choose the compression level
+            with open(outfile, 'rb') as f_in:
+                with gzip.open(outfile+'.gz', 'wb',
+                               compresslevel=self.inputs.compression) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1024*1024)
+            os.remove(outfile)
+            outfile = outfile+'.gz'
+
+        return outfile
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         if isdefined(self.inputs.out_folder):
@@ -865,3 +1176,53 @@ class MHA2NIIConverter(BaseInterface):
         outputs['out_files'] = self.converted_files
 
         return outputs
+
+
+class RTStructureRasteriserInputSpec(BaseInterfaceInputSpec):
+    
+    input_ss = File(mandatory=True, exists=True,
+                    desc='Structure set DICOM file.')
+    reference_ct = File(mandatory=True, exists=True,
+                        desc='Reference CT image file.')
+    out_folder = Directory('rs_structures', usedefault=True,
+                           desc='Folder with the converted structures.')
+    multilabel = traits.Bool(False, usedefault=True, desc=(
+        'Whether or not to save all the structures in one bit-packed 4D '
+        'image (with a JSON file with the ROI names) instead of one mask '
+        'per structure.'))
+    compression = traits.Range(low=0, high=9, value=6, usedefault=True, desc=(
+        'Gzip compression level. 0 saves uncompressed .nii files.'))
+    num_workers = traits.Int(1, usedefault=True,
+                             desc='Number of threads used to rasterise the ROIs.')
+
+
+class RTStructureRasteriserOutputSpec(TraitedSpec):
+    
+    out_folder = Directory(help='Folder with the converted structures.')
+    out_files = traits.List(help='List of converted files.')
+
+
+class RTStructureRasteriser(BaseInterface):
+    """Native alternative to RTStructureCoverter + MHA2NIIConverter: the
+    contours are filled directly on the grid of the reference CT and saved as
+    NIfTI, without the intermediate .mha files.
+    """
+    input_spec = RTStructureRasteriserInputSpec
+    output_spec = RTStructureRasteriserOutputSpec
+    
+    def _run_interface(self, runtime):
+
+        self.converted_files = [os.path.abspath(x) for x in rasterise_rtstruct(
+            self.inputs.input_ss, self.inputs.reference_ct,
+            self.inputs.out_folder, multilabel=self.inputs.multilabel,
+            n_workers=self.inputs.num_workers,
+            compresslevel=self.inputs.compression)]
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_folder'] = os.path.abspath(self.inputs.out_folder)
+        outputs['out_files'] = self.converted_files
+
+        return outputs
@@ -0,0 +1,159 @@
+import os
+import time
+import uuid
+import hashlib
+import numpy as np
+from pycurt.utils.index import SQLiteStore
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pycurt',
+                                 'mrclass_cache')
+
+
+class FeatureCache(SQLiteStore):
+    """On-disk cache of preprocessed images. Each entry is keyed by the SHA1
+    of the content of the source image and by a signature of the
+    preprocessing, so it is still valid if the image is moved or renamed and
+    it is invalidated if the image or the preprocessing change. The arrays
+    are stored in .npy shards (one per call to put) that are memory mapped
+    when read, and the least recently used shards are deleted when the cache
+    grows bigger than max_size.
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+        'mtime INTEGER, size INTEGER, sha1 TEXT)',
+        'CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, '
+        'size INTEGER, last_used REAL)',
+        'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, '
+        'shard TEXT, position INTEGER)',
+        'CREATE INDEX IF NOT EXISTS entries_shard ON entries (shard)']
+
+    def __init__(self, cache_dir=None, max_size=2*1024**3):
+
+        if cache_dir is None:
+            cache_dir = os.environ.get('PYCURT_FEATURE_CACHE', DEFAULT_CACHE_DIR)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.shard_dir = os.path.join(self.cache_dir, 'shards')
+        self.max_size = max_size
+        os.makedirs(self.shard_dir, exist_ok=True)
+        super().__init__(os.path.join(self.cache_dir, 'cache.sqlite'))
+
+    def file_hashes(self, paths):
+        """Function to get the SHA1 of the content of a list of files. The
+        hashes are stored with the modification time and size of the files,
+        so a file is read again only if it changed.
+        """
+        paths = [os.path.abspath(x) for x in paths]
+        stats = {}
+        for path in paths:
+            st = os.stat(path)
+            stats[path] = (st.st_mtime_ns, st.st_size)
+        hashes = {}
+        for path, mtime, size, sha1 in self.select_in(
+                'SELECT path, mtime, size, sha1 FROM hashes WHERE path IN ({})',
+                set(paths)):
+            if stats[path] == (mtime, size):
+                hashes[path] = sha1
+        new = []
+        for path in paths:
+            if path not in hashes:
+                sha1 = hashlib.sha1()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024*1024), b''):
+                        sha1.update(chunk)
+                hashes[path] = sha1.hexdigest()
+                new.append((path, stats[path][0], stats[path][1], hashes[path]))
+        if new:
+            with self.connection() as conn:
+                conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                                 new)
+
+        return hashes
+
+    def keys(self, paths, signature):
+        """Return a dictionary with the cache key of each file in paths,
+        for the preprocessing identified by signature.
+        """
+        hashes = self.file_hashes(paths)
+
+        return {x: hashlib.sha1('{0}|{1}'.format(
+            hashes[os.path.abspath(x)], signature).encode()).hexdigest()
+                for x in paths}
+
+    def get(self, keys):
+        """Function to retrieve the cached arrays.
+        Parameters
+        ----------
+        keys : dict
+            dictionary with the cache key of each image (see keys)
+        Returns
+        -------
+        found : dict
+            dictionary with the array of each image found in the cache
+        """
+        rows = self.select_in('SELECT key, shard, position FROM entries '
+                              'WHERE key IN ({})', set(keys.values()))
+        by_shard = {}
+        for key, shard, position in rows:
+            by_shard.setdefault(shard, []).append((key, position))
+        arrays = {}
+        used = []
+        for shard, entries in by_shard.items():
+            try:
+                data = np.load(os.path.join(self.shard_dir, shard), mmap_mode='r')
+            except (OSError, ValueError):
+                # evicted by another process in the meantime
+                continue
+            for key, position in entries:
+                arrays[key] = np.array(data[position])
+            used.append(shard)
+        if used:
+            with self.connection() as conn:
+                conn.executemany('UPDATE shards SET last_used=? WHERE name=?',
+                                 [(time.time(), x) for x in used])
+
+        return {x: arrays[k] for x, k in keys.items() if k in arrays}
+
+    def put(self, entries):
+        """Function to store a list of (key, array) in a new shard. All the
+        arrays must have the same shape and type.
+        """
+        if not entries:
+            return
+        name = '{}.npy'.format(uuid.uuid4().hex)
+        path = os.path.join(self.shard_dir, name)
+        with open(path+'.tmp', 'wb') as f:
+            np.save(f, np.stack([x[1] for x in entries]))
+        os.replace(path+'.tmp', path)
+        with self.connection() as conn:
+            conn.execute('INSERT INTO shards VALUES (?, ?, ?)',
+                         (name, os.path.getsize(path), time.time()))
+            conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                             [(key, name, i) for i, (key, _) in enumerate(entries)])
+        self.evict()
+
+    def evict(self):
+        """Function to remove the shards that are not referenced anymore and
+        then the least recently used ones, until the cache is smaller than
+        max_size.
+        """
+        conn = self.connection()
+        to_remove = [x[0] for x in conn.execute(
+            'SELECT name FROM shards WHERE name NOT IN '
+            '(SELECT DISTINCT shard FROM entries)').fetchall()]
+        shards = conn.execute(
+            'SELECT name, size FROM shards ORDER BY last_used DESC').fetchall()
+        total = 0
+        for name, size in shards:
+            if name in to_remove:
+                continue
+            total += size
+            if total > self.max_size:
+                to_remove.append(name)
+        with conn:
+            for name in to_remove:
+                conn.execute('DELETE FROM entries WHERE shard=?', (name, ))
+                conn.execute('DELETE FROM shards WHERE name=?', (name, ))
+        for name in to_remove:
+            if os.path.isfile(os.path.join(self.shard_dir, name)):
+                os.remove(os.path.join(self.shard_dir, name))
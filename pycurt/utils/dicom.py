@@ -2,10 +2,15 @@ import pydicom
 import numpy as np
 from operator import itemgetter
 import collections
-from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
 import os
+import hashlib
 import subprocess as sp
+import time
+from functools import partial
 from pathlib import Path
+from pycurt.utils.parallel import parallel_map
+from pycurt.utils.filemanip import detach
 
 
 ExplicitVRLittleEndian = '1.2.840.10008.1.2.1'
@@ -15,6 +20,26 @@ ExplicitVRBigEndian = '1.2.840.10008.1.2.2'
 NotCompressedPixelTransferSyntaxes = [
     ExplicitVRLittleEndian, ImplicitVRLittleEndian,
     DeflatedExplicitVRLittleEndian, ExplicitVRBigEndian]
+FILE_CHECK_TAGS = ['SeriesDescription', 'Modality', 'StudyInstanceUID',
+                   'SeriesInstanceUID', 'PatientID', 'StudyDate']
+RT_REFERENCE_TAGS = ['ReferencedStructureSetSequence', 'ReferencedDoseSequence',
+                     'ReferencedFrameOfReferenceSequence', 'BeamSequence',
+                     'IonBeamSequence']
+INDEX_TAGS = FILE_CHECK_TAGS + [
+    'SOPInstanceUID', 'FrameOfReferenceUID', 'ImageType', 'SeriesNumber',
+    'InstanceNumber', 'DoseType', 'DoseSummationType', 'GridFrameOffsetVector',
+    'RTPlanDate', 'RTPlanTime', 'ApprovalStatus', 'PlanIntent'] + RT_REFERENCE_TAGS
+# geometry needed by the native DICOM to NIfTI converter
+INDEX_TAGS += ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing',
+               'SliceThickness', 'Rows', 'Columns', 'NumberOfFrames',
+               'SamplesPerPixel', 'RescaleSlope', 'RescaleIntercept']
+INDEX_TAGS += ['BitsAllocated']
+# tags used to check the RT doses. PixelData makes the reader go through the
+# pixel data element (its value is skipped, only its length is stored), which
+# for encapsulated data means scanning it up to the delimiter, so it is not
+# part of INDEX_TAGS
+DOSE_TAGS = INDEX_TAGS + ['PixelData']
+UNDEFINED_LENGTH = 0xFFFFFFFF
 
 
 class DicomInfo(object):
@@ -69,67 +94,196 @@ class DicomInfo(object):
         return toRemove
 
 
-def dcm_info(dcm_folder):
-    """Function to extract information from a list of DICOM files in one folder. It returns a list of
-    unique image types and scan numbers found in the input list of DICOMS.
+LOCALIZER_TYPES = ['LOCALIZER', 'PROJECTION IMAGE']
+
+
+class SeriesAnalysis(object):
+    """Result of analyse_series.
+    Attributes
+    ----------
+    dicoms : list
+        DICOM files of the target series, sorted by path
+    removed : dict
+        reason of the exclusion of each of the other files ('unreadable',
+        'missing fields', 'duplicated SOPInstanceUID', 'duplicated pixel data',
+        'duplicated instance number', 'localizer', 'image type' or
+        'series number')
+    image_types : list
+        unique image types, in order of appearance, of the readable files
+    series_nums : list
+        unique series numbers, in order of appearance, of the readable files
+    header_reads : int
+        number of headers actually parsed (the other ones came from the index)
+    """
+    def __init__(self, dicoms, removed, image_types, series_nums, header_reads):
+
+        self.dicoms = dicoms
+        self.removed = removed
+        self.image_types = image_types
+        self.series_nums = series_nums
+        self.header_reads = header_reads
+
+    def __repr__(self):
+
+        return ('SeriesAnalysis({0} DICOM files kept, {1} removed, {2} headers '
+                'parsed)'.format(len(self.dicoms), len(self.removed),
+                                 self.header_reads))
+
+
+def pixel_hash(dicom):
+    """Return the SHA1 of the (undecoded) pixel data of a DICOM file."""
+    ds = pydicom.dcmread(str(dicom), force=True, specific_tags=['PixelData'])
+
+    return hashlib.sha1(ds.PixelData).hexdigest() if 'PixelData' in ds else None
+
+
+def analyse_series(dcm_folder, n_workers=1, decompress=True):
+    """Function to analyse, in a single pass over the headers, a folder with
+    the DICOM files of one scan. Each header is read once (through the header
+    index) and the files are excluded if unreadable, duplicated (same
+    SOPInstanceUID or, for files with the same instance number and position,
+    same pixel data), localizers/projections (if there are other images, or
+    if they have different image types) or not in the target series. The
+    target series is the first image type that is not a localizer and, if
+    there are more series numbers, the highest one (assuming that it is the
+    one after the contrast agent injection).
+    Compressed DICOM files are decompressed in place.
     Parameters
     ----------
     dcm_folder : str
         path to an existing folder with DICOM files
+    n_workers : int
+        number of threads used to decompress the files
+    decompress : bool
+        whether or not to decompress the compressed files of the target series
     Returns
     -------
-    dicoms : list
-        list of DICOM files in the folder
-    image_types : list
-        list of unique image types extracted from the DICOMS
-    series_nums : list
-        list of unique series numbers extracted from the DICOMS
+    analysis : SeriesAnalysis
+        structured result (see SeriesAnalysis)
     """
-    dcm_folder = Path(dcm_folder)
+    from pycurt.utils.index import get_header_index
 
+    dcm_folder = Path(dcm_folder)
     dicoms = sorted(list(dcm_folder.glob('*.dcm')))
     if not dicoms:
         dicoms = sorted(list(dcm_folder.glob('*.IMA')))
         if not dicoms:
             raise Exception('No DICOM files found in {}'.format(dcm_folder))
 
-    ImageTypes = []
-    SeriesNums = []
-    toRemove = []
-    InstanceNums = []
+    index = get_header_index()
+    parsed = index.parsed
+    headers = dict(zip(dicoms, index.headers(dicoms)))
+    removed = {}
+    readable = []
+    sops = set()
     for dcm in dicoms:
-        #Check whether the dicom is compressed, if yes decompress
-        try:
-            if (pydicom.read_file(str(dcm)).file_meta.TransferSyntaxUID
-                    not in NotCompressedPixelTransferSyntaxes):
-                decompress_dicom(dcm)
-#         except InvalidDicomError:
-#             print ('{} seems to do not have a readable DICOM header and '
-#                    'will be removed from the folder'.format(dcm))
-#             toRemove.append(dcm)
-#         try:
-            header = pydicom.read_file(str(dcm))
-            ImageTypes.append(tuple(header.ImageType))
-            SeriesNums.append(header.SeriesNumber)
-            InstanceNums.append(header.InstanceNumber)
-        except AttributeError:
-            print ('{} seems to do not have the right DICOM fields and '
-                   'will be removed from the folder'.format(dcm))
-            toRemove.append(dcm)
-        except InvalidDicomError:
+        header = headers[dcm]
+        if header is None:
             print ('{} seems to do not have a readable DICOM header and '
                    'will be removed from the folder'.format(dcm))
-            toRemove.append(dcm)
-    # the following lines are to check whether or not there are 2 set of exactly the same DICOM files in the folder
-    if (len(InstanceNums) == 2*(len(set(InstanceNums)))) and len(set(SeriesNums)) == 1:
-        sortedInstanceNums = sorted(zip(dicoms, InstanceNums), key=itemgetter(1))
-        uniqueInstanceNums = [x[0] for x in sortedInstanceNums[:][0:-1:2]]
-        toRemove = toRemove+uniqueInstanceNums
-    if toRemove:
-        for f in toRemove:
-            dicoms.remove(f)
+            removed[dcm] = 'unreadable'
+        elif any(x not in header for x in ['ImageType', 'SeriesNumber', 'InstanceNumber']):
+            print ('{} seems to do not have the right DICOM fields and '
+                   'will be removed from the folder'.format(dcm))
+            removed[dcm] = 'missing fields'
+        elif header.get('SOPInstanceUID') in sops:
+            removed[dcm] = 'duplicated SOPInstanceUID'
+        else:
+            if 'SOPInstanceUID' in header:
+                sops.add(header['SOPInstanceUID'])
+            readable.append(dcm)
+    image_types = list(dict.fromkeys(tuple(headers[x]['ImageType']) for x in readable))
+    series_nums = list(dict.fromkeys(headers[x]['SeriesNumber'] for x in readable))
+
+    # only files with the same instance number and position can be duplicates
+    groups = collections.defaultdict(list)
+    for dcm in readable:
+        hd = headers[dcm]
+        groups[(hd['SeriesNumber'], hd['InstanceNumber'], tuple(hd['ImageType']),
+                hd.get('ImagePositionPatient'))].append(dcm)
+    for group in groups.values():
+        if len(group) > 1:
+            seen = set()
+            for dcm in group:
+                digest = pixel_hash(dcm)
+                if digest in seen:
+                    removed[dcm] = 'duplicated pixel data'
+                seen.add(digest)
+    readable = [x for x in readable if x not in removed]
+    # the same series saved twice with different pixel data (e.g. exported
+    # twice with different transfer syntaxes) has all instance numbers twice
+    instance_nums = [headers[x]['InstanceNumber'] for x in readable]
+    if (len(instance_nums) == 2*(len(set(instance_nums)))
+            and len(set(headers[x]['SeriesNumber'] for x in readable)) == 1):
+        sorted_instances = sorted(zip(readable, instance_nums), key=itemgetter(1))
+        for dcm, _ in sorted_instances[0:-1:2]:
+            removed[dcm] = 'duplicated instance number'
+        readable = [x for x in readable if x not in removed]
 
-    return dicoms, list(set(ImageTypes)), list(set(SeriesNums))
+    selected = readable
+    non_localizers = [x for x in selected if not [
+        t for t in LOCALIZER_TYPES if t in headers[x]['ImageType']]]
+    if non_localizers and len(non_localizers) < len(selected):
+        removed.update((x, 'localizer') for x in selected if x not in non_localizers)
+        selected = non_localizers
+    elif not non_localizers and len(set(tuple(headers[x]['ImageType'])
+                                        for x in selected)) > 1:
+        # only localizers/projections, of different types: nothing to convert
+        removed.update((x, 'localizer') for x in selected)
+        selected = []
+    types = list(dict.fromkeys(tuple(headers[x]['ImageType']) for x in selected))
+    if len(types) > 1:
+        removed.update((x, 'image type') for x in selected
+                       if tuple(headers[x]['ImageType']) != types[0])
+        selected = [x for x in selected if tuple(headers[x]['ImageType']) == types[0]]
+    numbers = set(headers[x]['SeriesNumber'] for x in selected)
+    if len(numbers) > 1:
+        series_num = max(numbers)
+        removed.update((x, 'series number') for x in selected
+                       if headers[x]['SeriesNumber'] != series_num)
+        selected = [x for x in selected if headers[x]['SeriesNumber'] == series_num]
+
+    # files without the file meta information are implicit VR little endian
+    compressed = [x for x in selected if headers[x].get(
+        'TransferSyntaxUID', ImplicitVRLittleEndian) not in NotCompressedPixelTransferSyntaxes]
+    if decompress and compressed:
+        # the whole series is decompressed at once
+        failed = decompress_dicoms(compressed, n_workers=n_workers)
+        if failed:
+            print('{0} DICOM files in {1} could not be decompressed'.format(
+                len(failed), dcm_folder))
+
+    return SeriesAnalysis([str(x) for x in selected],
+                          {str(x): y for x, y in removed.items()},
+                          image_types, series_nums, index.parsed-parsed)
+
+
+def dcm_info(dcm_folder, n_workers=1):
+    """Function to extract information from a list of DICOM files in one folder. It returns a list of
+    unique image types and scan numbers found in the input list of DICOMS.
+    Compressed DICOM files are decompressed in place. Kept for backward
+    compatibility, see analyse_series.
+    Parameters
+    ----------
+    dcm_folder : str
+        path to an existing folder with DICOM files
+    n_workers : int
+        number of threads used to decompress the files
+    Returns
+    -------
+    dicoms : list
+        list of DICOM files in the folder, without unreadable and duplicated files
+    image_types : list
+        list of unique image types extracted from the DICOMS
+    series_nums : list
+        list of unique series numbers extracted from the DICOMS
+    """
+    analysis = analyse_series(dcm_folder, n_workers=n_workers)
+    dicoms = sorted(analysis.dicoms+[
+        x for x, y in analysis.removed.items() if y in
+        ['localizer', 'image type', 'series number']])
+
+    return [Path(x) for x in dicoms], analysis.image_types, analysis.series_nums
 
 
 def dcm_check(dicoms, im_types, series_nums):
@@ -151,24 +305,267 @@ def dcm_check(dicoms, im_types, series_nums):
     dcms : list
         list of DICOMS files
     """
+    from pycurt.utils.index import dicom_headers
+
     if len(im_types) > 1:
         try:
             im_type = list([x for x in im_types if not 'PROJECTION IMAGE' in x
                             and 'LOCALIZER' not in x][0])
     
-            dcms = [x for x in dicoms if pydicom.read_file(str(x)).ImageType==im_type]
+            dcms = [x for x, hd in zip(dicoms, dicom_headers(dicoms))
+                    if hd is not None and list(hd.get('ImageType', []))==im_type]
         except IndexError:
             dcms = []
     elif len(series_nums) > 1:
         series_num = np.max(series_nums)
-        dcms = [x for x in dicoms if pydicom.read_file(str(x)).SeriesNumber==series_num]
+        dcms = [x for x, hd in zip(dicoms, dicom_headers(dicoms))
+                if hd is not None and hd.get('SeriesNumber')==series_num]
     else:
         dcms = dicoms
 
     return [str(x) for x in dcms]
 
 
+def clean_series(dcm_folder, n_workers=1):
+    """Function to remove, from a folder with one MR series, the DICOM files
+    that are not readable, duplicated or that belong to localizers or other
+    scans. It returns the SeriesAnalysis of the folder (see analyse_series).
+    """
+    analysis = analyse_series(dcm_folder, n_workers=n_workers)
+    [os.remove(f) for f in analysis.removed]
+
+    return analysis
+
+
 def decompress_dicom(dicom):
-    
-    cmd = ("gdcmconv --raw {0} {1} ".format(dicom, dicom))
-    sp.check_output(cmd, shell=True) 
+
+    if decompress_dicoms([dicom]):
+        raise Exception('{} could not be decompressed'.format(dicom))
+
+
+def decompress_dicoms(dicoms, tool='gdcmconv', n_workers=1):
+    """Function to decompress, in place, a list of DICOM files (usually all the
+    compressed files of one series). The files are decoded in this process
+    with pydicom, if a pixel data handler for their transfer syntax is
+    available, otherwise with the external tool.
+    Parameters
+    ----------
+    dicoms : list
+        list of compressed DICOM files
+    tool : str
+        external tool used when pydicom cannot decode a file, one of
+        EXTERNAL_DECOMPRESSORS
+    n_workers : int
+        number of threads used to decompress the files
+    Returns
+    -------
+    failed : list
+        list of the files that could not be decompressed
+    """
+    dicoms = [str(x) for x in dicoms]
+    decoded = parallel_map(_decompress_in_process, dicoms, n_workers=n_workers,
+                           executor='thread')
+    remaining = [x for x, ok in zip(dicoms, decoded) if not ok]
+    if remaining:
+        external = parallel_map(partial(_decompress_external, tool=tool),
+                                remaining, n_workers=n_workers, executor='thread')
+        return [x for x, ok in zip(remaining, external) if not ok]
+
+    return []
+
+
+def _decompress_in_process(dicom):
+
+    tmp = dicom+'.decompressing'
+    try:
+        ds = pydicom.dcmread(dicom, force=True)
+        ds.decompress()
+        ds.save_as(tmp)
+        # replacing the file gives it a new inode, so linked copies are not touched
+        os.replace(tmp, dicom)
+    except Exception:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return False
+
+    return True
+
+
+# external tools to decompress one DICOM file in place
+EXTERNAL_DECOMPRESSORS = {
+    'gdcmconv': ['gdcmconv', '--raw', '{0}', '{0}'],
+    'dcmdjpeg': ['dcmdjpeg', '{0}', '{0}']}
+
+
+def _decompress_external(dicom, tool='gdcmconv'):
+
+    # the tools rewrite the file in place, do not touch the linked copies
+    detach(dicom)
+    try:
+        sp.check_output([x.format(dicom) for x in EXTERNAL_DECOMPRESSORS[tool]],
+                        stderr=sp.STDOUT)
+    except (sp.CalledProcessError, OSError):
+        return False
+
+    return True
+
+
+def read_dicom_header(dicom, tags=None):
+    """Function to read a subset of the DICOM header without touching the pixel data.
+    Parameters
+    ----------
+    dicom : str
+        path to a DICOM file
+    tags : list
+        list of DICOM keywords to read. Default is FILE_CHECK_TAGS. The RT
+        sequences in RT_REFERENCE_TAGS are not returned as they are, but
+        summarised by the ReferencedStructureSetUID, ReferencedDoseUIDs,
+        ReferencedSeriesUID, ReferencedFrameOfReferenceUID and RadiationType
+        fields
+    Returns
+    -------
+    header : dict
+        dictionary with the value of every requested tag found in the header,
+        plus the TransferSyntaxUID (and the PixelDataLength if PixelData was
+        requested). Multi-valued elements are returned as tuples
+        of strings, integer elements as int. None is returned if the file cannot
+        be read
+    """
+    if tags is None:
+        tags = FILE_CHECK_TAGS
+    read_pixels = 'PixelData' in tags
+    try:
+        # with defer_size the value of the pixel data is skipped, not read
+        ds = pydicom.dcmread(str(dicom), force=True, stop_before_pixels=not read_pixels,
+                             defer_size=1024 if read_pixels else None,
+                             specific_tags=tags)
+    except Exception:
+        return None
+    header = {}
+    for t in tags:
+        if t in RT_REFERENCE_TAGS or t == 'PixelData':
+            continue
+        try:
+            val = ds.data_element(t).value
+        except (AttributeError, KeyError):
+            continue
+        if isinstance(val, (list, tuple, MultiValue)):
+            val = tuple(str(x) for x in val)
+        elif isinstance(val, int):
+            val = int(val)
+        else:
+            val = str(val)
+        header[t] = val
+    try:
+        header['TransferSyntaxUID'] = str(ds.file_meta.TransferSyntaxUID)
+    except AttributeError:
+        pass
+    if [t for t in tags if t in RT_REFERENCE_TAGS]:
+        header.update(rt_references(ds))
+    if read_pixels:
+        try:
+            elem = ds.get_item(0x7FE00010)
+        except KeyError:
+            elem = None
+        if elem is not None:
+            length = getattr(elem, 'length', None)
+            header['PixelDataLength'] = int(
+                length if length is not None else len(elem.value))
+
+    return header
+
+
+def check_pixel_data(header):
+    """Function to check, without decoding them, that a DICOM file has pixel
+    data and that their length is consistent with Rows x Columns x
+    NumberOfFrames x SamplesPerPixel x BitsAllocated. Encapsulated (compressed)
+    pixel data cannot be checked without decoding and are only required to be
+    present.
+    Parameters
+    ----------
+    header : dict
+        header returned by read_dicom_header with DOSE_TAGS (see dose_headers)
+    Returns
+    -------
+    valid : bool
+        whether the pixel data are present and consistent
+    """
+    if header is None or 'PixelDataLength' not in header:
+        return False
+    length = header['PixelDataLength']
+    if length == UNDEFINED_LENGTH:
+        return True
+    try:
+        bits = (int(header['Rows'])*int(header['Columns'])
+                *int(header.get('NumberOfFrames', 1) or 1)
+                *int(header.get('SamplesPerPixel', 1))*int(header['BitsAllocated']))
+    except (KeyError, TypeError, ValueError):
+        return False
+    expected = (bits+7)//8
+    # the value of the element is padded to an even length
+
+    return expected > 0 and expected <= length <= expected+1
+
+
+def dose_headers(dcms, n_workers=1):
+    """Function to read the headers of RT dose files with DOSE_TAGS, to be
+    checked with check_pixel_data. They are read directly, and not through the
+    header index, which does not store the pixel data length.
+    """
+    return scan_dicom_headers(dcms, tags=DOSE_TAGS, n_workers=n_workers)
+
+
+def rt_references(ds):
+    """Function to extract the UIDs referenced by a RT object (plan, structure set).
+    It returns a dictionary with the referenced structure set, dose cubes, CT
+    series and frame of reference, plus the radiation type of the first beam
+    (plans only).
+    """
+    references = {}
+    try:
+        references['ReferencedStructureSetUID'] = str(
+            ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
+    except (AttributeError, IndexError):
+        pass
+    try:
+        references['ReferencedDoseUIDs'] = tuple(
+            str(x.ReferencedSOPInstanceUID) for x in ds.ReferencedDoseSequence)
+    except AttributeError:
+        pass
+    try:
+        references['ReferencedSeriesUID'] = str(
+            ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0]
+            .RTReferencedSeriesSequence[0].SeriesInstanceUID)
+    except (AttributeError, IndexError):
+        pass
+    try:
+        references['ReferencedFrameOfReferenceUID'] = str(
+            ds.ReferencedFrameOfReferenceSequence[0].FrameOfReferenceUID)
+    except (AttributeError, IndexError):
+        pass
+    for beams in ['BeamSequence', 'IonBeamSequence']:
+        try:
+            references['RadiationType'] = str(getattr(ds, beams)[0].RadiationType)
+            break
+        except (AttributeError, IndexError):
+            continue
+
+    return references
+
+
+def scan_dicom_headers(dicoms, tags=None, n_workers=1):
+    """Function to read the headers of a list of DICOM files using a pool of
+    processes. See read_dicom_header for the meaning of the returned values.
+    The reading throughput is logged at the end.
+    """
+    dicoms = [str(x) for x in dicoms]
+    start = time.time()
+    headers = parallel_map(partial(read_dicom_header, tags=tags), dicoms,
+                           n_workers=n_workers, chunksize=256)
+    elapsed = time.time() - start
+    if dicoms:
+        print('Scanned {0} DICOM headers in {1:.1f}s ({2:.1f} files/sec, {3} worker(s))'
+              .format(len(dicoms), elapsed, len(dicoms)/max(elapsed, 1e-6),
+                      max(n_workers, 1)))
+
+    return headers
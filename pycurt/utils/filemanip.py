@@ -1,13 +1,23 @@
 import os
+import errno
 import pandas as pd
 import math
 import glob
 import shutil
+import gzip
+import threading
+from functools import partial
 from pathlib import Path
+from nibabel.fileholders import FileHolder
 
 
 ALLOWED_EXT = ['.xlsx', '.csv']
 ILLEGAL_CHARACTERS = ['/', '(', ')', '[', ']', '{', '}', ' ', '-']
+# linux/fs.h, ioctl to clone (reflink) a whole file
+FICLONE = 0x40049409
+# errors meaning that a strategy is not supported by the filesystem
+UNSUPPORTED_ERRORS = [errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY,
+                      errno.EOPNOTSUPP, errno.ENOSYS, errno.EMLINK]
 
 
 def split_filename(fname):
@@ -89,18 +99,26 @@ def mergedict(a, b):
 
 
 def extract_middleSlice(image):
-    
-    x, y, z = image.shape
+
+    return image[middle_slice(image.shape)].astype('float32')
+
+
+def middle_slice(shape):
+    """Function to get the index of the middle slice, along the smallest
+    dimension, of a 3D image with the given shape. The returned tuple can
+    be used to slice both numpy arrays and nibabel array proxies.
+    """
+    x, y, z = shape
     s = smallest(x,y,z)
     if s == z:
-        ms = math.ceil(image.shape[2]/2)-1
-        return image[:, :, ms].astype('float32')
+        ms = math.ceil(shape[2]/2)-1
+        return (slice(None), slice(None), ms)
     elif s == y:
-        ms = math.ceil(image.shape[1]/2)-1
-        return image[:, ms, :].astype('float32')
+        ms = math.ceil(shape[1]/2)-1
+        return (slice(None), ms, slice(None))
     else:
-        ms = math.ceil(image.shape[0]/2)-1
-        return image[ms, :, :].astype('float32')
+        ms = math.ceil(shape[0]/2)-1
+        return (ms, slice(None), slice(None))
 
 
 def smallest(num1, num2, num3):
@@ -114,8 +132,154 @@ def smallest(num1, num2, num3):
     return smallest_num
 
 
+def _reflink(src, dst):
+
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def _copy_file_range(src, dst):
+
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+    shutil.copystat(src, dst)
+
+
+def _hardlink(src, dst):
+
+    os.link(src, dst)
+
+
+def _symlink(src, dst):
+
+    os.symlink(os.path.realpath(src), dst)
+
+
+def _copy(src, dst):
+
+    shutil.copy2(src, dst)
+
+
+# Strategies to materialise a file in a new location. New ones can be registered
+# here, they must raise OSError if not supported.
+MATERIALISERS = {
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+    'copy_file_range': _copy_file_range,
+    'symlink': _symlink,
+    'copy': _copy}
+# Order in which the strategies are tried with "auto". Symlinks are never
+# chosen automatically since they break if the source is removed.
+AUTO_STRATEGIES = ['reflink', 'hardlink', 'copy_file_range', 'copy']
+_auto_choice = {}
+
+
+def materialise(src, dst, strategy=None):
+    """Function to make src available as dst without duplicating the bytes
+    on disk, if the filesystem allows it. It can be used as drop-in replacement
+    of shutil.copy2 (and as copy_function of shutil.copytree).
+    Parameters
+    ----------
+    src : str
+        file to materialise
+    dst : str
+        destination file (replaced if it exists) or existing directory
+    strategy : str
+        one of MATERIALISERS or "auto" (default, unless the PYCURT_MATERIALISATION
+        environment variable is set). With "auto" the first strategy of
+        AUTO_STRATEGIES that works is picked, and remembered, for every pair of
+        source and destination filesystems. Files linked with "hardlink" or
+        "symlink" must be detached (see detach) before being modified in place.
+    Returns
+    -------
+    dst : str
+        path to the materialised file
+    """
+    if strategy is None:
+        strategy = os.environ.get('PYCURT_MATERIALISATION', 'auto')
+    src = str(src)
+    dst = str(dst)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if strategy == 'auto':
+        devices = (os.stat(src).st_dev,
+                   os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+        if devices in _auto_choice:
+            strategies = [_auto_choice[devices], 'copy']
+        else:
+            strategies = AUTO_STRATEGIES
+    else:
+        devices = None
+        strategies = [strategy, 'copy']
+    # the file is materialised with a temporary name and then renamed, so an
+    # existing dst is replaced (as shutil.copy2 does) with any strategy
+    tmp = '{0}.{1}.{2}.materialising'.format(dst, os.getpid(), threading.get_ident())
+    try:
+        for s in strategies:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                MATERIALISERS[s](src, tmp)
+            except OSError as e:
+                if s == 'copy' or e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+                continue
+            if devices is not None:
+                _auto_choice[devices] = s
+            break
+        os.replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+    return dst
+
+
+def materialise_tree(src, dst, strategy=None):
+    """Same as shutil.copytree, but files are materialised with the given strategy
+    (see materialise).
+    """
+    return shutil.copytree(src, dst, copy_function=partial(materialise, strategy=strategy))
+
+
+def detach(path):
+    """Function to give path its own copy of the data before modifying it in place,
+    so that hardlinked (or symlinked) files in other folders are not affected.
+    """
+    path = str(path)
+    if os.path.islink(path) or os.stat(path).st_nlink > 1:
+        tmp = path+'.detaching'
+        shutil.copy2(os.path.realpath(path), tmp)
+        os.replace(tmp, path)
+
+
+def save_nifti(img, out_file, compresslevel=6):
+    """Function to save a nibabel image. Files ending with .gz are written
+    with the given gzip compression level (0-9), the other ones uncompressed.
+    """
+    if out_file.endswith('.gz'):
+        with gzip.GzipFile(out_file, 'wb', compresslevel=compresslevel) as f:
+            img.to_file_map({'image': FileHolder(filename=out_file, fileobj=f)})
+    else:
+        img.to_filename(out_file)
+
+    return out_file
+
+
 def label_move_image(image, modality, out_dir, renaming=True):
 
+    from pycurt.utils.index import get_header_index
+
+    index = get_header_index()
     sub_name, tp = image.split('/')[-3:-1]
     base_dir_path = os.path.join(out_dir, sub_name, tp)
     dir_name = os.path.join(base_dir_path, modality)
@@ -123,10 +287,12 @@ def label_move_image(image, modality, out_dir, renaming=True):
         os.makedirs(dir_name)
     if renaming:
         new_name = file_rename(image)
+        if new_name != image:
+            index.move_tree(image, new_name)
     else:
         new_name = image
     try:
-        shutil.copytree(new_name, os.path.join(dir_name, new_name.split('/')[-1]))
+        materialise_tree(new_name, os.path.join(dir_name, new_name.split('/')[-1]))
         outname = os.path.join(dir_name, new_name.split('/')[-1])
     except:
         files = [item for item in glob.glob(dir_name+'/*')
@@ -137,13 +303,31 @@ def label_move_image(image, modality, out_dir, renaming=True):
             new_name1 = new_name+'_'+ str(int(len(files)))
         # Renaming old directory
         shutil.move(new_name, new_name1)  
+        index.move_tree(new_name, new_name1)
         # Copy to the sorting location  
-        shutil.copytree(new_name1, os.path.join(dir_name, new_name1.split('/')[-1]))
+        materialise_tree(new_name1, os.path.join(dir_name, new_name1.split('/')[-1]))
         outname = os.path.join(dir_name, new_name1.split('/')[-1])
         new_name = new_name1
+    # the materialised files keep the modification times, so the indexed
+    # headers are still valid
+    index.alias_tree(new_name, outname)
     
     return outname, new_name
 
+def merge_tree(src, dst):
+    """Copy the content of the src folder into dst, which can already
+    exist. Files already in dst are overwritten.
+    """
+    for root, _, files in os.walk(src):
+        out_root = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(out_root):
+            os.makedirs(out_root)
+        for f in files:
+            if os.path.lexists(os.path.join(out_root, f)):
+                os.remove(os.path.join(out_root, f))
+            materialise(os.path.join(root, f), os.path.join(out_root, f))
+
+
 def file_rename(image):
 
     base_dir_path = os.path.split(image)[0]
@@ -214,7 +398,7 @@ def create_move_toDir(fileName, dirName, actRange):
                 newName=os.path.join(dirName[0:indices2[-1]],
                                      folderName.parts[-1]+'-'+str(actRange))
 #     shutil.move(fileName[0:-7],newName)
-    shutil.copytree(fileName[0:-7], newName)
+    materialise_tree(fileName[0:-7], newName)
     try:
         shutil.move(newName, dirName)
     except:
@@ -0,0 +1,303 @@
+import os
+import json
+import sqlite3
+import threading
+from pycurt.utils.dicom import INDEX_TAGS, scan_dicom_headers
+
+
+INDEX_VERSION = 4
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.pycurt',
+                                  'dicom_headers.sqlite')
+SQLITE_MAX_VARIABLES = 900
+
+
+class SQLiteStore(object):
+    """Base class for the SQLite files shared by several nipype nodes. One
+    connection is opened per process and thread (sqlite connections cannot
+    be shared across a fork) and the database is used in WAL mode, so that
+    concurrent readers do not block the writer.
+    """
+    schema = []
+
+    def __init__(self, db_path):
+
+        self.db_path = os.path.abspath(db_path)
+        if not os.path.isdir(os.path.dirname(self.db_path)):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._local = threading.local()
+        with self.connection() as conn:
+            for statement in self.schema:
+                conn.execute(statement)
+
+    def connection(self):
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=120)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def select_in(self, query, values, args=()):
+        """Run query, which has to contain one "{}" placeholder for the IN
+        clause, splitting values in chunks to respect the SQLite limit on the
+        number of variables. args are the values of the placeholders that
+        follow the IN clause in query.
+        """
+        values = list(values)
+        args = list(args)
+        rows = []
+        conn = self.connection()
+        step = SQLITE_MAX_VARIABLES-len(args)
+        for i in range(0, len(values), step):
+            chunk = values[i:i+step]
+            rows += conn.execute(query.format(','.join('?'*len(chunk))),
+                                 chunk+args).fetchall()
+        return rows
+
+
+class HeaderIndex(SQLiteStore):
+    """Persistent index of DICOM headers. Each file is stored with its
+    modification time and size, so a header is parsed again only if the file
+    has changed since it was indexed. The fields stored for each file are the
+    ones returned by read_dicom_header with INDEX_TAGS.
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, '
+        'mtime INTEGER, size INTEGER, sop_instance_uid TEXT, '
+        'series_instance_uid TEXT, header TEXT)',
+        'CREATE INDEX IF NOT EXISTS headers_sop ON headers (sop_instance_uid)',
+        'CREATE INDEX IF NOT EXISTS headers_series ON headers (series_instance_uid)']
+
+    def __init__(self, db_path=None):
+
+        if db_path is None:
+            db_path = os.environ.get('PYCURT_HEADER_INDEX', DEFAULT_INDEX_PATH)
+        super().__init__(db_path)
+        # number of headers parsed by this instance, the others came from the index
+        self.parsed = 0
+        with self.connection() as conn:
+            version = conn.execute(
+                "SELECT value FROM meta WHERE key='version'").fetchone()
+            if version is None or int(version[0]) != INDEX_VERSION:
+                conn.execute('DELETE FROM headers')
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                             (str(INDEX_VERSION),))
+
+    def headers(self, dicoms, n_workers=1):
+        """Function to get the headers of a list of DICOM files. Only the
+        files that are not in the index, or that changed since they were
+        indexed, are parsed (using n_workers processes).
+        Parameters
+        ----------
+        dicoms : list
+            list of DICOM files
+        n_workers : int
+            number of processes used to parse the missing headers
+        Returns
+        -------
+        headers : list
+            list of header dictionaries (None for unreadable files), in the
+            same order as dicoms
+        """
+        dicoms = [os.path.abspath(str(x)) for x in dicoms]
+        stats = {}
+        for dcm in dicoms:
+            try:
+                st = os.stat(dcm)
+                stats[dcm] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                stats[dcm] = None
+        found = {}
+        rows = self.select_in(
+            'SELECT path, mtime, size, header FROM headers WHERE path IN ({})',
+            set(dicoms))
+        for path, mtime, size, header in rows:
+            if stats.get(path) == (mtime, size):
+                found[path] = decode_header(header)
+
+        missing = [x for x in dicoms if x not in found and stats[x] is not None]
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            parsed = scan_dicom_headers(missing, tags=INDEX_TAGS,
+                                        n_workers=n_workers)
+            found.update(zip(missing, parsed))
+            self.parsed += len(missing)
+            self.store([(x, stats[x], hd) for x, hd in zip(missing, parsed)])
+
+        return [found.get(x) for x in dicoms]
+
+    def header(self, dicom):
+
+        return self.headers([dicom])[0]
+
+    def store(self, entries):
+
+        rows = []
+        for path, stat, header in entries:
+            if header is None:
+                sop, series = None, None
+            else:
+                sop = header.get('SOPInstanceUID')
+                series = header.get('SeriesInstanceUID')
+            rows.append((path, stat[0], stat[1], sop, series,
+                         json.dumps(header)))
+        with self.connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)',
+                             rows)
+
+    def alias(self, pairs):
+        """Function to register copies of already indexed files. pairs is a
+        list of (source, destination) paths. Since the copies keep the
+        modification time of the source (see filemanip.materialise), their
+        headers do not need to be parsed again.
+        """
+        pairs = [(os.path.abspath(str(x)), os.path.abspath(str(y))) for x, y in pairs]
+        rows = self.select_in(
+            'SELECT path, mtime, size, header FROM headers WHERE path IN ({})',
+            set(x for x, _ in pairs))
+        rows = {x[0]: x[1:] for x in rows}
+        entries = []
+        for src, dst in pairs:
+            if src in rows:
+                mtime, size, header = rows[src]
+                entries.append((dst, (mtime, size), decode_header(header)))
+        if entries:
+            self.store(entries)
+
+    def alias_tree(self, src_dir, dst_dir):
+        """Same as alias, for a directory copied with materialise_tree."""
+        src_dir = os.path.abspath(str(src_dir)).rstrip('/')
+        dst_dir = os.path.abspath(str(dst_dir)).rstrip('/')
+        # all the paths starting with src_dir/ ('0' is the character after '/')
+        rows = self.connection().execute(
+            'SELECT path FROM headers WHERE path >= ? AND path < ?',
+            (src_dir+'/', src_dir+'0')).fetchall()
+        self.alias([(x[0], dst_dir+x[0][len(src_dir):]) for x in rows])
+
+    def move_tree(self, src_dir, dst_dir):
+        """Same as alias_tree, for a directory moved (not copied) to dst_dir:
+        the entries of src_dir are removed.
+        """
+        self.alias_tree(src_dir, dst_dir)
+        src_dir = os.path.abspath(str(src_dir)).rstrip('/')
+        with self.connection() as conn:
+            conn.execute('DELETE FROM headers WHERE path >= ? AND path < ?',
+                         (src_dir+'/', src_dir+'0'))
+
+    def prune(self, prefix=None):
+        """Function to remove the entries of the files that do not exist
+        anymore (e.g. the aliases in nipype working directories that have been
+        deleted), only under the prefix directory if given.
+        Returns
+        -------
+        removed : int
+            number of entries removed
+        """
+        conn = self.connection()
+        if prefix is None:
+            rows = conn.execute('SELECT path FROM headers').fetchall()
+        else:
+            prefix = os.path.abspath(str(prefix)).rstrip('/')
+            rows = conn.execute('SELECT path FROM headers WHERE path >= ? AND path < ?',
+                                (prefix+'/', prefix+'0')).fetchall()
+        missing = [x for x in rows if not os.path.exists(x[0])]
+        with conn:
+            conn.executemany('DELETE FROM headers WHERE path=?', missing)
+        if missing:
+            print('{} missing files removed from the DICOM header index'.format(
+                len(missing)))
+
+        return len(missing)
+
+
+class SortingManifest(SQLiteStore):
+    """Manifest of the DICOM files already sorted by the sorting workflow.
+    Each file is identified by its SOPInstanceUID (or by its path, if the
+    UID is missing) and its path, since PACS exports often have copies of
+    the same instance in different files, and stored with its modification
+    time, size and the session folder it was sorted into.
+    """
+    schema = [
+        'CREATE TABLE IF NOT EXISTS sorted_files (uid TEXT, path TEXT, '
+        'mtime INTEGER, size INTEGER, series_key TEXT, modality TEXT, '
+        'patient TEXT, study_date TEXT, destination TEXT, '
+        'PRIMARY KEY (uid, path))',
+        'CREATE INDEX IF NOT EXISTS sorted_files_path ON sorted_files (path)']
+
+    def __init__(self, db_path):
+
+        super().__init__(db_path)
+        with self.connection() as conn:
+            # manifests written when the files were identified by uid only
+            if conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                            "AND name='sorted'").fetchone():
+                conn.execute('INSERT OR IGNORE INTO sorted_files SELECT * FROM sorted')
+                conn.execute('DROP TABLE sorted')
+
+    def known(self, entries):
+        """Return the set of paths, among the (uid, path, mtime, size)
+        entries, that have already been sorted and did not change since then.
+        """
+        rows = self.select_in('SELECT uid, path, mtime, size FROM sorted_files '
+                              'WHERE path IN ({})', set(x[1] for x in entries))
+        rows = {tuple(x[:2]): tuple(x[2:]) for x in rows}
+
+        return set(path for uid, path, mtime, size in entries
+                   if rows.get((uid, path)) == (mtime, size))
+
+    def sorted_into(self, destinations):
+        """Return the entries of the files sorted into one of the
+        destinations (session folders).
+        """
+        return self.select_in('SELECT * FROM sorted_files WHERE destination '
+                              'IN ({})', destinations)
+
+    def update(self, entries):
+        """Record entries, a list of (uid, path, mtime, size, series_key,
+        modality, patient, study_date, destination) tuples.
+        """
+        with self.connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO sorted_files VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+
+
+def decode_header(header):
+
+    header = json.loads(header)
+    if header is not None:
+        for key in header:
+            if type(header[key]) is list:
+                header[key] = tuple(header[key])
+
+    return header
+
+
+_INDEXES = {}
+
+
+def get_header_index(db_path=None):
+    """Return the HeaderIndex of the current process. The index file is taken
+    from the PYCURT_HEADER_INDEX environment variable, if set, otherwise it is
+    ~/.pycurt/dicom_headers.sqlite.
+    """
+    if db_path is None:
+        db_path = os.environ.get('PYCURT_HEADER_INDEX', DEFAULT_INDEX_PATH)
+    if db_path not in _INDEXES:
+        _INDEXES[db_path] = HeaderIndex(db_path)
+
+    return _INDEXES[db_path]
+
+
+def dicom_headers(dicoms, n_workers=1):
+    """Shortcut to get_header_index().headers."""
+    return get_header_index().headers(dicoms, n_workers=n_workers)
+
+
+def dicom_header(dicom):
+    """Shortcut to get_header_index().header."""
+    return get_header_index().header(dicom)
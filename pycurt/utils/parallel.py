@@ -0,0 +1,69 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# True in the processes started by parallel_map
+_IN_POOL = False
+
+
+class _InPool(object):
+    """Wrapper of the function run by the processes started by parallel_map,
+    which marks them as pool workers (ProcessPoolExecutor has an initializer
+    only from Python 3.7).
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, x):
+
+        global _IN_POOL
+        _IN_POOL = True
+        return self.func(x)
+
+
+def parallel_map(func, items, n_workers=1, executor='process', chunksize=1):
+    """Function to apply func to every element of items using a pool of
+    workers. The order of the results is the same as the order of the inputs.
+    Parameters
+    ----------
+    func : callable
+        function to apply. With executor='process' it has to be picklable
+        (i.e. defined at module level or a functools.partial of it)
+    items : iterable
+        elements to process
+    n_workers : int
+        number of workers. With 1 (or less) everything runs in the current
+        process
+    executor : str
+        'process' or 'thread'. Processes are only started by the top-level
+        call in a process: nested calls (i.e. from a process started by
+        parallel_map) and calls from daemonic processes (which cannot have
+        children, as the MultiProc workers of older nipype versions) use
+        threads instead. The current nipype MultiProc runs the nodes in
+        non-daemonic processes, so each node can start one pool of processes,
+        whose size the node has to declare with n_procs
+    chunksize : int
+        number of elements sent to each process at once
+    Returns
+    -------
+    results : list
+        list with the outputs of func, one per element of items
+    """
+    items = list(items)
+    if n_workers <= 1 or len(items) <= 1:
+        return [func(x) for x in items]
+
+    n_workers = min(n_workers, len(items))
+    if executor == 'process' and (_IN_POOL or multiprocessing.current_process().daemon):
+        executor = 'thread'
+    if executor == 'process':
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_InPool(func), items, chunksize=chunksize))
+    elif executor == 'thread':
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(func, items))
+    else:
+        raise Exception('Not recognized executor {}. Possible values are '
+                        '"process" or "thread".'.format(executor))
+
+    return results
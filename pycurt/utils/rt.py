@@ -0,0 +1,365 @@
+import os
+import re
+import glob
+import json
+import threading
+import numpy as np
+import nibabel as nib
+import pydicom
+from functools import partial
+from collections import defaultdict
+from pycurt.utils.index import dicom_headers
+from pycurt.utils.parallel import parallel_map
+from pycurt.utils.filemanip import save_nifti
+
+
+class TimepointGraph(object):
+    """UID graph of the DICOM objects of one RT timepoint, i.e. of a folder
+    organised as <timepoint>/<modality>/<series>/<file>.dcm. It is built once,
+    from the header index, and maps every SOPInstanceUID to its file, every
+    SeriesInstanceUID to its folder and every FrameOfReferenceUID to the series
+    that use it, so the references between RTPLAN, RTSTRUCT, CT and RTDOSE are
+    resolved with dictionary lookups. The references that cannot be resolved
+    are printed and collected in the unresolved attribute.
+    """
+    def __init__(self, tp_folder):
+
+        self.tp_folder = tp_folder
+        self.files = {}
+        self.headers = {}
+        self.series = {}
+        self.frames_of_reference = defaultdict(list)
+        self.unresolved = []
+
+        dcm_files = sorted(glob.glob(os.path.join(tp_folder, '*', '*', '*.dcm')))
+        for f, hd in zip(dcm_files, dicom_headers(dcm_files)):
+            if hd is None:
+                continue
+            self.headers[f] = hd
+            modality = f.split('/')[-3]
+            if 'SOPInstanceUID' in hd:
+                self.files.setdefault((modality, hd['SOPInstanceUID']), f)
+            if 'SeriesInstanceUID' in hd:
+                series = (modality, hd['SeriesInstanceUID'])
+                if series not in self.series:
+                    self.series[series] = os.path.dirname(f)
+                    if 'FrameOfReferenceUID' in hd:
+                        self.frames_of_reference[hd['FrameOfReferenceUID']].append(series)
+
+    def file(self, modality, sop_instance_uid, reference):
+        """Return the file of the given modality with the given SOPInstanceUID,
+        or None if it is not in this timepoint. reference is the description
+        of the reference, used to report it if not resolved.
+        """
+        f = self.files.get((modality, sop_instance_uid))
+        if f is None:
+            self.report(reference, sop_instance_uid)
+
+        return f
+
+    def folder(self, modality, series_instance_uid, reference,
+               frame_of_reference=None):
+        """Return the folder of the series of the given modality with the given
+        SeriesInstanceUID. If it is not found and frame_of_reference is given,
+        the only series of that modality with that FrameOfReferenceUID is
+        returned (if there is exactly one). None is returned otherwise.
+        """
+        folder = self.series.get((modality, series_instance_uid))
+        if folder is None and frame_of_reference is not None:
+            candidates = [x for x in self.frames_of_reference[frame_of_reference]
+                          if x[0] == modality]
+            if len(candidates) == 1:
+                folder = self.series[candidates[0]]
+                print('{0} {1} resolved through the frame of reference {2}'.format(
+                    reference, series_instance_uid, frame_of_reference))
+        if folder is None:
+            self.report(reference, series_instance_uid)
+
+        return folder
+
+    def report(self, reference, uid):
+
+        self.unresolved.append((reference, uid))
+        print('Unresolved reference in {0}: {1} {2} was not found'.format(
+            self.tp_folder, reference, uid))
+
+
+def dose_mask(dose_file, percentile=99):
+    """Function to threshold a dose NIfTI file at the given percentile of
+    its positive values. Returns the boolean mask and the affine.
+    """
+    dose_img = nib.load(dose_file)
+    dose = np.asanyarray(dose_img.dataobj)
+    while dose.ndim > 3:
+        dose = dose[..., 0]
+    dose_maxvalue = np.percentile(dose[dose > 0], percentile)
+
+    return dose >= dose_maxvalue, dose_img.affine
+
+
+def roi_overlap(roi_file, dose_bool, dose_affine):
+    """Function to compute the fraction of the voxels of a ROI that fall in
+    a thresholded dose. The ROI is cropped to its bounding box and only its
+    voxels are mapped, through the affines, to the dose grid (nearest
+    neighbour), so the ROI and the dose do not need to have the same grid.
+    Parameters
+    ----------
+    roi_file : str
+        path to the NIfTI mask of the ROI
+    dose_bool : numpy.ndarray
+        thresholded dose (see dose_mask)
+    dose_affine : numpy.ndarray
+        affine of the dose
+    Returns
+    -------
+    voxels : int
+        number of voxels in the ROI
+    overlap : int
+        number of voxels of the ROI inside the thresholded dose
+    """
+    roi_img = nib.load(roi_file)
+    roi = np.asanyarray(roi_img.dataobj) > 0
+    while roi.ndim > 3:
+        roi = roi.any(-1)
+    nonzero = np.nonzero(roi.any(axis=(1, 2)))[0]
+    if not nonzero.size:
+        return 0, 0
+    # the bounding box is found one axis at a time, without a full argwhere
+    lower = [nonzero[0]]
+    upper = [nonzero[-1]+1]
+    for axis in [(0, 2), (0, 1)]:
+        nonzero = np.nonzero(roi.any(axis=axis))[0]
+        lower.append(nonzero[0])
+        upper.append(nonzero[-1]+1)
+    crop = roi[tuple(slice(l, u) for l, u in zip(lower, upper))]
+    voxels = np.argwhere(crop) + np.array(lower)
+
+    roi_to_dose = np.linalg.inv(dose_affine).dot(roi_img.affine)
+    if np.allclose(roi_to_dose, np.eye(4)) and roi.shape == dose_bool.shape:
+        idx = voxels
+    else:
+        idx = np.rint(voxels.dot(roi_to_dose[:3, :3].T)
+                      + roi_to_dose[:3, 3]).astype(np.intp)
+    inside = np.all((idx >= 0) & (idx < np.array(dose_bool.shape)), axis=1)
+    overlap = np.count_nonzero(dose_bool[tuple(idx[inside].T)])
+
+    return len(voxels), int(overlap)
+
+
+def roi_dose_scores(rois, dose_file, percentile=99, n_workers=1):
+    """Function to score a list of ROIs by their overlap with the high dose
+    region (dose >= percentile of the positive dose values). The ROIs are
+    processed by n_workers threads.
+    Returns
+    -------
+    scores : list
+        list of (roi, voxels, overlap voxels, score) tuples, in the same order
+        as rois. The score is the fraction of the ROI in the high dose region
+    """
+    dose_bool, dose_affine = dose_mask(dose_file, percentile=percentile)
+    results = parallel_map(partial(roi_overlap, dose_bool=dose_bool,
+                                   dose_affine=dose_affine),
+                           rois, n_workers, executor='thread')
+
+    return [(roi, n, overlap, overlap/n if n else 0.0)
+            for roi, (n, overlap) in zip(rois, results)]
+
+
+def read_rtstruct(rtstruct):
+    """Function to read the closed planar contours of a RTSTRUCT.
+    Parameters
+    ----------
+    rtstruct : str
+        path to the RTSTRUCT DICOM file
+    Returns
+    -------
+    rois : list
+        list of (ROI number, ROI name, contours), where contours is a list of
+        Nx3 arrays with the contour points in patient coordinates (LPS, mm)
+    """
+    ds = pydicom.dcmread(str(rtstruct), force=True)
+    names = {int(x.ROINumber): str(x.ROIName)
+             for x in getattr(ds, 'StructureSetROISequence', [])}
+    rois = []
+    for roi in getattr(ds, 'ROIContourSequence', []):
+        number = int(roi.ReferencedROINumber)
+        contours = []
+        for contour in getattr(roi, 'ContourSequence', []):
+            if getattr(contour, 'ContourGeometricType', 'CLOSED_PLANAR') != 'CLOSED_PLANAR':
+                continue
+            points = np.asarray(contour.ContourData, dtype=float).reshape(-1, 3)
+            if len(points) >= 3:
+                contours.append(points)
+        rois.append((number, names.get(number, 'ROI_{}'.format(number)), contours))
+
+    return rois
+
+
+def fill_polygon(rows, cols, shape):
+    """Function to fill one polygon, given in voxel coordinates, on a 2D
+    grid. A voxel is filled if its centre is inside the polygon according to
+    the even-odd rule. Centres lying on the boundary are inside only on the
+    lower side of each axis, so a square with its corners on voxel centres
+    n voxels apart fills exactly n x n voxels.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    first = max(int(np.ceil(rows.min())), 0)
+    last = min(int(np.floor(rows.max())), shape[0]-1)
+    c_first = max(int(np.ceil(cols.min())), 0)
+    c_last = min(int(np.floor(cols.max())), shape[1]-1)
+    if first > last or c_first > c_last:
+        return mask
+    grid = np.arange(first, last+1)[:, None]
+    next_rows = np.roll(rows, -1)
+    next_cols = np.roll(cols, -1)
+    # for each row of voxel centres, the edges crossing it and where
+    crosses = (rows > grid) != (next_rows > grid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = cols+(grid-rows)*(next_cols-cols)/(next_rows-rows)
+    columns = np.arange(c_first, c_last+1)
+    for i, row_crosses, row_crossings in zip(grid[:, 0], crosses, crossings):
+        xs = np.sort(row_crossings[row_crosses])
+        if xs.size:
+            # a centre is inside if an odd number of crossings is after it
+            after = xs.size-np.searchsorted(xs, columns, side='right')
+            mask[i, c_first:c_last+1] = after % 2 == 1
+
+    return mask
+
+
+def rasterise_contours(contours, shape, affine):
+    """Function to fill the planar contours of one ROI on the grid of a
+    reference image, whose third axis has to be the slice axis of the
+    contours (as for the axial CT the structures are drawn on). Voxels are
+    filled if their centre is inside a contour (see fill_polygon), and
+    contours in the same slice are combined with XOR, so that inner contours
+    are holes (as done by plastimatch).
+    Parameters
+    ----------
+    contours : list
+        list of Nx3 arrays of points in patient coordinates (LPS, mm)
+    shape : tuple
+        shape of the reference image
+    affine : numpy.ndarray
+        affine of the reference image (RAS, as in NIfTI)
+    Returns
+    -------
+    mask : numpy.ndarray
+        boolean mask on the reference grid
+    """
+    mask = np.zeros(shape[:3], dtype=bool)
+    lps_to_voxel = np.linalg.inv(affine).dot(np.diag([-1, -1, 1, 1]))
+    for points in contours:
+        voxels = points.dot(lps_to_voxel[:3, :3].T) + lps_to_voxel[:3, 3]
+        k = int(np.rint(voxels[:, 2].mean()))
+        if k < 0 or k >= shape[2]:
+            continue
+        mask[:, :, k] ^= fill_polygon(voxels[:, 0], voxels[:, 1], shape[:2])
+
+    return mask
+
+
+def structure_file_names(rois):
+    """Return the output file name (without extension) of each ROI, with the
+    characters that are not allowed in file names replaced by '_'. ROIs with
+    the same name get their ROI number appended.
+    """
+    names = [re.sub(r'[^\w\-]+', '_', x[1]).strip('_') or 'ROI' for x in rois]
+    duplicated = set(x for x in names if names.count(x) > 1)
+
+    return ['{0}_{1}'.format(name, roi[0]) if name in duplicated else name
+            for name, roi in zip(names, rois)]
+
+
+def rasterise_rtstruct(rtstruct, reference, out_dir, multilabel=False,
+                       n_workers=1, compresslevel=6):
+    """Function to convert the structures of a RTSTRUCT into NIfTI masks on
+    the grid of a reference image (usually RTCT.nii.gz), without writing any
+    intermediate file. The ROIs are rasterised by n_workers threads.
+    Parameters
+    ----------
+    rtstruct : str
+        path to the RTSTRUCT DICOM file
+    reference : str
+        path to the reference NIfTI image
+    out_dir : str
+        folder where to save the masks
+    multilabel : bool
+        if True, instead of one file per ROI, a single bit-packed 4D image
+        (structures.nii.gz) is saved, where bit b of volume v is the mask of
+        the ROI number 8*v+b in the list saved in structures.json
+    n_workers : int
+        number of threads
+    compresslevel : int
+        gzip compression level (0 saves uncompressed .nii files)
+    Returns
+    -------
+    out_files : list
+        list of the saved files
+    """
+    ref = nib.load(reference)
+    shape = ref.shape[:3]
+    affine = ref.affine
+    rois = read_rtstruct(rtstruct)
+    names = structure_file_names(rois)
+    ext = '.nii.gz' if compresslevel > 0 else '.nii'
+    os.makedirs(out_dir, exist_ok=True)
+    if multilabel:
+        packed = np.zeros(shape+(max((len(rois)+7)//8, 1),), dtype=np.uint8)
+        # each mask is packed as soon as it is ready, so only n_workers full
+        # size masks are in memory at the same time
+        locks = [threading.Lock() for _ in range(packed.shape[3])]
+
+    def save_roi(i):
+        mask = rasterise_contours(rois[i][2], shape, affine)
+        if multilabel:
+            with locks[i//8]:
+                packed[..., i//8] |= mask.astype(np.uint8) << (i % 8)
+            return None
+        out_file = os.path.join(out_dir, names[i]+ext)
+        img = nib.Nifti1Image(mask.astype(np.uint8), affine)
+        img.header.set_xyzt_units('mm', 'sec')
+        return save_nifti(img, out_file, compresslevel=compresslevel)
+
+    results = parallel_map(save_roi, range(len(rois)), n_workers,
+                           executor='thread')
+    if not multilabel:
+        return results
+
+    img = nib.Nifti1Image(packed, affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    out_files = [save_nifti(img, os.path.join(out_dir, 'structures'+ext),
+                            compresslevel=compresslevel)]
+    out_files.append(os.path.join(out_dir, 'structures.json'))
+    with open(out_files[-1], 'w') as f:
+        json.dump([{'index': i, 'volume': i//8, 'bit': i % 8,
+                    'roi_number': roi[0], 'roi_name': roi[1], 'name': name}
+                   for i, (roi, name) in enumerate(zip(rois, names))], f, indent=2)
+
+    return out_files
+
+
+def compare_structures(out_files, reference_files, tolerance=0.95):
+    """Function to compare two sets of masks with the same file names (for
+    example the native ones with the ones converted by plastimatch), using
+    the Dice coefficient.
+    Returns
+    -------
+    dice : dict
+        Dice coefficient of each file name found in both sets
+    failed : list
+        file names with Dice lower than tolerance
+    """
+    references = {os.path.basename(x).split('.')[0]: x for x in reference_files}
+    dice = {}
+    for f in out_files:
+        name = os.path.basename(f).split('.')[0]
+        if name not in references:
+            continue
+        a = np.asanyarray(nib.load(f).dataobj) > 0
+        b = np.asanyarray(nib.load(references[name]).dataobj) > 0
+        total = np.count_nonzero(a)+np.count_nonzero(b)
+        dice[name] = 2.0*np.count_nonzero(a & b)/total if total else 1.0
+    failed = [x for x in dice if dice[x] < tolerance]
+
+    return dice, failed
@@ -1,9 +1,16 @@
+import os
+import zipfile
 import numpy as np
 import torch
 import cv2
-from pycurt.utils.filemanip import extract_middleSlice
+from pycurt.utils.filemanip import middle_slice
 from torch.utils.data import Dataset
 import nibabel as nib
+from nibabel.fileholders import FileHolder
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
 
     
 class ToTensor(object):
@@ -16,6 +23,9 @@ class ToTensor(object):
             return {'image': torch.from_numpy(np.float32(image)).unsqueeze(dim=0),
                     'name':name}
 
+    def __repr__(self):
+        return 'ToTensor()'
+
    
 class ZscoreNormalization(object):
     """ put data in range of 0 to 1 """
@@ -34,6 +44,9 @@ class ZscoreNormalization(object):
         else:
             return None
 
+    def __repr__(self):
+        return 'ZscoreNormalization()'
+
 
 class resize_2Dimage:
     """ Args: img_px_size slices resolution(cubic)
@@ -48,17 +61,58 @@ class resize_2Dimage:
                             interpolation=cv2.INTER_CUBIC)
         return {'image': image_n, 'name' : name}
 
+    def __repr__(self):
+        return 'resize_2Dimage({})'.format(self.img_px_size)
+
+
+_MODELS = {}
+
 
 def load_checkpoint(filepath):
+    """Function to load a MRClass checkpoint. Each checkpoint is loaded only
+    once per process (and reloaded only if the file changes), in eval mode
+    and without gradients. On CPU, checkpoints loaded in the main process
+    before the workflow starts are inherited by the MultiProc workers (see
+    preload_checkpoints).
+    Parameters
+    ----------
+    filepath : str
+        path to the checkpoint. It can be a checkpoint with the pickled model
+        and its state_dict, or a file created by export_checkpoint
+    Returns
+    -------
+    model : torch.nn.Module
+        the model, ready for inference
+    """
+    filepath = os.path.abspath(filepath)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    key = (filepath, os.stat(filepath).st_mtime_ns, device)
+    if key not in _MODELS:
+        _MODELS[key] = _load_checkpoint(filepath)
+
+    return _MODELS[key]
+
+
+def _load_checkpoint(filepath):
 
     if torch.cuda.is_available():
         map_location=lambda storage, loc: storage.cuda()
     else:
         map_location='cpu'
+    if zipfile.is_zipfile(filepath):
+        # TorchScript archive created by export_checkpoint
+        try:
+            model = torch.jit.load(filepath, map_location=torch.device(
+                'cuda' if torch.cuda.is_available() else 'cpu'))
+            model.eval()
+            return model
+        except RuntimeError:
+            pass
     checkpoint = torch.load(filepath, map_location=map_location)
     
     model = checkpoint['model']
-    model.load_state_dict(checkpoint['state_dict'])
+    if 'state_dict' in checkpoint:
+        model.load_state_dict(checkpoint['state_dict'])
     for parameter in model.parameters():
         parameter.requires_grad = False
 
@@ -66,6 +120,83 @@ def load_checkpoint(filepath):
     return model
 
 
+def preload_checkpoints(filepaths):
+    """Function to load the checkpoints in the current process, before
+    starting the workflow. On CPU the weights are moved to shared memory, so
+    the MultiProc workers (forked from this process) use them read-only
+    instead of loading their own copy. With CUDA nothing is preloaded, since
+    CUDA cannot be used in forked processes once it has been initialised in
+    the parent: each worker loads its own models on the GPU.
+    """
+    if torch.cuda.is_available():
+        return
+    for filepath in filepaths:
+        load_checkpoint(filepath).share_memory()
+
+
+def export_checkpoint(filepath, out_file, torchscript=True):
+    """Function to convert a MRClass checkpoint in a format that is faster
+    to load.
+    Parameters
+    ----------
+    filepath : str
+        path to the original checkpoint
+    out_file : str
+        path to the converted checkpoint
+    torchscript : bool
+        if True, the model is traced and saved as TorchScript archive, which
+        does not need the model classes to be loaded. Otherwise only the model,
+        with its weights already loaded, is saved (without the duplicated
+        state_dict)
+    """
+    model = _load_checkpoint(filepath).cpu()
+    if torchscript:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, torch.zeros(1, 1, 256, 256))
+        traced.save(out_file)
+    else:
+        torch.save({'model': model}, out_file)
+
+
+def read_middle_slice(img_name):
+    """Function to read the middle slice of a NIfTI image (of the first volume
+    for 4D images) without loading the whole volume. Only the bytes of the slice
+    are read through the nibabel array proxy. If indexed_gzip is installed,
+    it is used to seek within .nii.gz files, otherwise the file is decompressed
+    as a stream up to the slice.
+    Parameters
+    ----------
+    img_name : str
+        path to the NIfTI image
+    Returns
+    -------
+    image : numpy array
+        2D float32 array with the middle slice
+    """
+    fileobj = None
+    try:
+        if img_name.endswith('.gz') and indexed_gzip is not None:
+            fileobj = indexed_gzip.IndexedGzipFile(img_name)
+            img = nib.Nifti1Image.from_file_map(
+                {'image': FileHolder(filename=img_name, fileobj=fileobj)})
+        else:
+            img = nib.load(img_name)
+        shape = img.shape
+        if len(shape) not in [3, 4]:
+            raise ValueError('{0} has {1} dimensions, only 3D and 4D images '
+                             'are supported'.format(img_name, len(shape)))
+        slicer = middle_slice(shape[:3])
+        if len(shape) > 3:
+            #4D images, truncated to first volume
+            slicer = slicer + (0, )
+        image = np.asanyarray(img.dataobj[slicer]).astype('float32')
+    finally:
+        if fileobj is not None:
+            fileobj.close()
+
+    return image
+
+
 class MRClassifierDataset_test(Dataset):
 
     def __init__(self, images, dummy, transform=None):
@@ -87,22 +218,10 @@ class MRClassifierDataset_test(Dataset):
         
         img_name = self.list_images[idx]
         try:
-            image = nib.load(img_name).get_data()
+            image = read_middle_slice(img_name)
         except:
 #             il = self.parent_dir+'/mr_class/random.nii.gz'
-            image = nib.load(self.dummy).get_data()
-            print('{0} seems to be corrupted'.format(img_name))
-        
-
-        if len(image.shape) > 3:
-            #4D images, truncated to first volume
-            image = image[:, :, :, 0]
-        try:
-            image = extract_middleSlice(image)
-        except:
-#             il = self.parent_dir +'/mr_class/random.nii.gz'
-            image = nib.load(self.dummy).get_data()
-            image = extract_middleSlice(image)
+            image = read_middle_slice(self.dummy)
             print('{0} seems to be corrupted'.format(img_name))
         
         sample = {'image': image, 'name':img_name}
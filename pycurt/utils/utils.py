@@ -1,5 +1,4 @@
 import os
-import pydicom
 import glob
 import re
 import pydicom as pd
@@ -8,19 +7,18 @@ import tarfile
 import PySimpleGUI as sg
 import sys
 import pickle
+from pycurt.utils.dicom import check_pixel_data, dose_headers
 
 
 def check_dcm_dose(dcms):
 
+    # the pixel data are checked from the header, without decoding them
     right_dcm = []
-    for dcm in dcms:
-        hd = pydicom.read_file(dcm)
-        try:
-            hd.GridFrameOffsetVector
-            hd.pixel_array
-            right_dcm.append(dcm)
-        except:
+    for dcm, header in zip(dcms, dose_headers(dcms)):
+        if header is None or 'GridFrameOffsetVector' not in header:
             continue
+        if check_pixel_data(header):
+            right_dcm.append(dcm)
     return right_dcm
 
 
@@ -138,6 +136,11 @@ def create_pycurt_gui():
                      tooltip=('Whether or not to perform MR images classification into 6 possible \n'
                               'classes: T1, CT1, T2, FLAIR, ADC or SWI. All the images that cannot be\n'
                               'classified will be ignored.'))],
+        [sg.Checkbox('Native MR conversion', change_submits = True, enable_events=True, size=(25, 1),
+                     default=False, key='native_converter', disabled=data_sorting, font=("Courier 10 Pitch", 20),
+                     tooltip=('If "Data sorting" is selected, convert the MR images to NIFTI_GZ \n'
+                              'without calling dcm2niix, which is still used for the series that \n'
+                              'cannot be converted natively. Default is False.'))],
         [sg.Checkbox('Convert RT structure set', change_submits = True, enable_events=True, size=(20, 1),
                      default=True, key='extract_rts', disabled=False, font=("Courier 10 Pitch", 20),
                      tooltip=('Whether or not to extract all the contours from the RT \n'
@@ -214,8 +217,10 @@ def create_pycurt_gui():
             main_window['sn_pos'].Update(disabled = True)
             main_window['sn_pos'].Update(value = -3)
             main_window['renaming'].Update(disabled = True)
+            main_window['native_converter'].Update(disabled = True)
         else:
             main_window['renaming'].Update(disabled = False)
+            main_window['native_converter'].Update(disabled = False)
             if values['renaming']:
                 main_window['sn_pos'].Update(disabled = True)
             else:
@@ -16,14 +16,17 @@ class BaseWorkflow(BaseDatabase):
     def workflow_setup(self):
         return self.workflow()
 
-    def runner(self, workflow, cores=0):
+    def runner(self, workflow, cores=0, memory_gb=None):
 
         if cores == 0:
             print('Workflow will run linearly')
             workflow.run()
         else:
             print('Workflow will run in parallel using {} cores'.format(cores))
-            workflow.run(plugin='MultiProc', plugin_args={'n_procs' : cores})
+            plugin_args = {'n_procs' : cores}
+            if memory_gb:
+                plugin_args['memory_gb'] = memory_gb
+            workflow.run(plugin='MultiProc', plugin_args=plugin_args)
 
         if self.local_sink:
             self.local_datasink()
\ No newline at end of file
@@ -8,16 +8,22 @@ from pycurt.workflows.base import BaseWorkflow
 from pycurt.interfaces.utils import FolderPreparation, FolderSorting, CheckRTStructures
 from pycurt.interfaces.custom import RTDataSorting, MRClass
 from nipype.interfaces.utility import Merge
+from pycurt.utils.torch import preload_checkpoints
+from pycurt.utils.index import get_header_index
 
 
 class DataCuration(BaseWorkflow):
     
     def sorting_workflow(self, subject_name_position=-3, renaming=False,
                          mr_classiffication=True, checkpoints=None,
-                         sub_checkpoints=None):
+                         sub_checkpoints=None, num_workers=1, incremental=False,
+                         converter='dcm2niix', compression=6):
 
         nipype_cache = os.path.join(self.nipype_cache, 'data_sorting')
         result_dir = self.result_dir
+        # the headers of the files in nipype working directories that have
+        # been deleted since the last run are removed from the index
+        get_header_index().prune(self.nipype_cache)
 
         workflow = nipype.Workflow('sorting_workflow', base_dir=nipype_cache)
         datasink = nipype.Node(nipype.DataSink(base_directory=result_dir),
@@ -31,10 +37,18 @@ class DataCuration(BaseWorkflow):
         file_check.inputs.input_dir = self.base_dir
         file_check.inputs.subject_name_position = subject_name_position
         file_check.inputs.renaming = renaming
+        file_check.inputs.num_workers = num_workers
+        # the nodes running their own workers declare them, so that MultiProc
+        # does not run num_workers of them at the same time
+        file_check.n_procs = num_workers
         prep = nipype.MapNode(interface=FolderPreparation(), name='prep',
                               iterfield=['input_list'])
         sort = nipype.MapNode(interface=FolderSorting(), name='sort',
                               iterfield=['input_dir'])
+        sort.inputs.converter = converter
+        sort.inputs.compression = compression
+        sort.inputs.num_workers = num_workers
+        sort.n_procs = num_workers
         mr_rt_merge = nipype.MapNode(interface=Merge(2), name='mr_rt_merge',
                                     iterfield=['in1', 'in2'])
         mr_rt_merge.inputs.ravel_inputs = True
@@ -47,13 +61,37 @@ class DataCuration(BaseWorkflow):
                                      iterfield=['mr_images'])
             mrclass.inputs.checkpoints = checkpoints
             mrclass.inputs.sub_checkpoints = sub_checkpoints
+            mrclass.inputs.num_workers = num_workers
+            mrclass.n_procs = num_workers
+            # on CPU, loaded once here and inherited by all the MRClass iterations
+            preload_checkpoints(list(checkpoints.values())
+                                + list(sub_checkpoints.values()))
         else:
             mr_rt_merge.inputs.in1 = None
         rt_sorting = nipype.MapNode(interface=RTDataSorting(), name='rt_sorting',
                                     iterfield=['input_dir'])
+        rt_sorting.inputs.num_workers = num_workers
+        rt_sorting.n_procs = num_workers
 
 #         workflow.connect(create_list, 'file_list', file_check, 'input_file')
-        workflow.connect(file_check, 'out_list', prep, 'input_list')
+        if incremental:
+            # only the new series are sorted and then merged into the existing
+            # folder. FileCheck is run first, so that nothing else runs if
+            # there are no new series
+            sorted_dir = os.path.join(result_dir, 'Sorted_Data')
+            manifest = os.path.join(sorted_dir, '.sorting_manifest.sqlite')
+            file_check.inputs.manifest_file = manifest
+            file_check.base_dir = nipype_cache
+            checked = file_check.run().outputs
+            if not checked.out_list:
+                print('No new DICOM series to sort in {}'.format(self.base_dir))
+                return nipype.Workflow('sorting_workflow', base_dir=nipype_cache)
+            prep.inputs.input_list = checked.out_list
+            merging.inputs.new_files = checked.new_files
+            merging.inputs.manifest_file = manifest
+            merging.inputs.sorted_dir = sorted_dir
+        else:
+            workflow.connect(file_check, 'out_list', prep, 'input_list')
         workflow.connect(prep, 'out_folder', sort, 'input_dir')
         workflow.connect(sort, 'out_folder', rt_sorting, 'input_dir')
         if mr_classiffication:
@@ -63,6 +101,9 @@ class DataCuration(BaseWorkflow):
             workflow.connect(rt_sorting, 'out_folder', mr_rt_merge, 'in2')
             workflow.connect(mr_rt_merge, 'out', merging, 'input_list')
             workflow.connect(merging, 'out_folder', datasink, '@rt_sorted')
+        elif incremental:
+            workflow.connect(rt_sorting, 'out_folder', merging, 'input_list')
+            workflow.connect(merging, 'out_folder', datasink, '@rt_sorted')
         else:
             workflow.connect(rt_sorting, 'out_folder', datasink, '@rt_sorted')
             substitutions = [('_rt_sorting\d+/', '')]
@@ -128,6 +169,8 @@ class DataCuration(BaseWorkflow):
                 check = nipype.MapNode(interface=ConversionCheck(),
                                        iterfield=['in_file', 'file_name'],
                                        name='check_conversion{}'.format(seq))
+                check.inputs.manifest = os.path.join(nipype_cache,
+                                                     'conversion_check.jsonl')
     
                 workflow.connect(dc, 'outdir', converter, 'source_dir')
                 workflow.connect(dc, 'scan_name', converter, 'out_filename')
@@ -180,6 +223,8 @@ class DataCuration(BaseWorkflow):
                             check = nipype.MapNode(interface=ConversionCheck(),
                                                    iterfield=['in_file', 'file_name'],
                                                    name='check_conversion{}'.format(seq))
+                            check.inputs.manifest = os.path.join(
+                                nipype_cache, 'conversion_check.jsonl')
                 
                             workflow.connect(dc, 'outdir', converter, 'source_dir')
                             workflow.connect(dc, 'scan_name', converter, 'out_filename')
@@ -216,13 +261,16 @@ class DataCuration(BaseWorkflow):
 
     def workflow_setup(self, data_sorting=False, subject_name_position=-3,
                        renaming=False, mr_classiffication=True, checkpoints=None,
-                       sub_checkpoints=None):
+                       sub_checkpoints=None, num_workers=1, incremental=False,
+                       converter='dcm2niix', compression=6):
 
         if data_sorting:
             workflow = self.sorting_workflow(
                 subject_name_position=subject_name_position,
                 renaming=renaming, mr_classiffication=mr_classiffication,
-                checkpoints=checkpoints, sub_checkpoints=sub_checkpoints)
+                checkpoints=checkpoints, sub_checkpoints=sub_checkpoints,
+                num_workers=num_workers, incremental=incremental,
+                converter=converter, compression=compression)
 #             sorting_workflow.run()
         else:
             workflow = self.convertion_workflow()
@@ -1,17 +1,29 @@
 "File containing all the workflows related to RadioTherapy"
 import nipype
 from pycurt.interfaces.plastimatch import RTStructureCoverter
-from pycurt.interfaces.utils import CheckRTStructures, MHA2NIIConverter
+from pycurt.interfaces.utils import (
+    CheckRTStructures, MHA2NIIConverter, RTStructureRasteriser)
 from pycurt.workflows.base import BaseWorkflow
 
 
 class RadioTherapy(BaseWorkflow):
 
-    def __init__(self, regex=None, roi_selection=False, **kwargs):
+    def __init__(self, regex=None, roi_selection=False, rasteriser='plastimatch',
+                 multilabel=False, num_workers=1, **kwargs):
         
         super().__init__(**kwargs)
         self.regex = regex
         self.roi_selection = roi_selection
+        self.rasteriser = rasteriser
+        self.multilabel = multilabel
+        self.num_workers = num_workers
+        if multilabel and rasteriser != 'native':
+            raise Exception('The multi-label output is only available with the '
+                            'native rasteriser.')
+        if multilabel and roi_selection:
+            print('ROI selection needs one file per structure, so it will not '
+                  'be performed with the multi-label output.')
+            self.roi_selection = False
 
     def datasource(self, **kwargs):
 
@@ -76,12 +88,24 @@ class RadioTherapy(BaseWorkflow):
             substitutions = [('subid', sub_id)]
             substitutions += [('results/', '{}/'.format(self.workflow_name))]
     
-            ss_convert = nipype.MapNode(interface=RTStructureCoverter(),
-                                       iterfield=['reference_ct', 'input_ss'],
-                                       name='ss_convert')
-            mha_convert = nipype.MapNode(interface=MHA2NIIConverter(),
-                                         iterfield=['input_folder'],
-                                         name='mha_convert')
+            if self.rasteriser == 'native':
+                ss_convert = nipype.MapNode(interface=RTStructureRasteriser(),
+                                            iterfield=['reference_ct', 'input_ss'],
+                                            name='ss_convert')
+                ss_convert.inputs.multilabel = self.multilabel
+                ss_convert.inputs.num_workers = self.num_workers
+                ss_convert.n_procs = self.num_workers
+                # same outputs as the MHA conversion, so nothing else changes
+                mha_convert = ss_convert
+            else:
+                ss_convert = nipype.MapNode(interface=RTStructureCoverter(),
+                                           iterfield=['reference_ct', 'input_ss'],
+                                           name='ss_convert')
+                mha_convert = nipype.MapNode(interface=MHA2NIIConverter(),
+                                             iterfield=['input_folder'],
+                                             name='mha_convert')
+                mha_convert.inputs.num_workers = self.num_workers
+                mha_convert.n_procs = self.num_workers
             
             if roi_selection:
                 select = nipype.MapNode(interface=CheckRTStructures(),
@@ -99,12 +123,15 @@ class RadioTherapy(BaseWorkflow):
                 substitutions += [(('_select_gtv{}/'.format(i), session+'/'))]
                 substitutions += [(('_voxelizer{}/'.format(i), session+'/'))]
                 substitutions += [(('_mha_convert{}/'.format(i), session+'/'))]
+                substitutions += [(('_ss_convert{}/'.format(i), session+'/'))]
 
             datasink.inputs.substitutions =substitutions
         
             workflow.connect(datasource, 'rtct_nifti', ss_convert, 'reference_ct')
             workflow.connect(datasource, 'rts_dcm', ss_convert, 'input_ss')
-            workflow.connect(ss_convert, 'out_structures', mha_convert, 'input_folder')
+            if self.rasteriser != 'native':
+                workflow.connect(ss_convert, 'out_structures', mha_convert,
+                                 'input_folder')
     
             workflow = self.datasink(workflow, datasink)
         else:
@@ -1,8 +1,12 @@
 "Script to run the PyCURT from command line"
 import os
+import json
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pycurt.workflows.curation import DataCuration
 from pycurt.workflows.rt import RadioTherapy
+from pycurt.database.local import LocalDatabase
 from pycurt.utils.config import create_subject_list, download_mrclass_weights
 
 
@@ -18,9 +22,34 @@ def main():
                         help=('Number of cores to use to run the registration workflow '
                               'in parallel. Default is 0, which means the workflow '
                               'will run linearly.'))
+    PARSER.add_argument('--parallel-subjects', '-ps', type=int, default=1,
+                        help=('Number of subjects to curate at the same time, each in '
+                              'its own process. The cores given with --num-cores are '
+                              'split among them. Default is 1.'))
+    PARSER.add_argument('--memory-gb', type=float, default=0,
+                        help=('Total memory, in GB, that the workflows can use. It is '
+                              'split among the subjects running at the same time. '
+                              'Default is 0, which means no limit.'))
     PARSER.add_argument('--data_sorting', '-ds', action='store_true',
                         help=('Whether or not to sort the data before convertion. '
                               'Default is False'))
+    PARSER.add_argument('--incremental', action='store_true',
+                        help=('If data sorting is enabled, sort only the DICOM files '
+                              'that are new (or changed) since the last run, and merge '
+                              'them into the existing Sorted_Data folder in the working '
+                              'directory. Default is False.'))
+    PARSER.add_argument('--converter', type=str, default='dcm2niix',
+                        choices=['dcm2niix', 'native'],
+                        help=('Method used to convert the MR images to NIfTI during '
+                              'data sorting. "native" converts them without calling '
+                              'dcm2niix, which is still used for the series that '
+                              'cannot be converted natively. Default is dcm2niix.'))
+    PARSER.add_argument('--nifti-compression', type=int, default=6,
+                        choices=range(10), metavar='{0..9}',
+                        help=('Gzip compression level of the NIfTI files written by '
+                              'the native converter (--converter native). 0 stores '
+                              'the data without compressing it, 1 is the fastest '
+                              'compression. Default is 6.'))
     PARSER.add_argument('--no-data_curation', '-ndc', action='store_true',
                         help=('Whether or not to run data curation after sorting. '
                               'By default it will run.'))
@@ -49,6 +78,16 @@ def main():
                         help=('Whether or not to extract only the structure, within the RTStruct, '
                               'with the highest overlap with the dose distribution.'
                               ' Default is False.'))
+    PARSER.add_argument('--rts-rasteriser', type=str, default='plastimatch',
+                        choices=['plastimatch', 'native'],
+                        help=('Method used to extract the structures from the RT structure '
+                              'set. "native" fills the contours directly on the RTCT grid, '
+                              'without calling plastimatch. Default is plastimatch.'))
+    PARSER.add_argument('--rts-multilabel', action='store_true',
+                        help=('With --rts-rasteriser native, save all the structures of a '
+                              'structure set in one bit-packed 4D image instead of one file '
+                              'per structure. Not compatible with --select-rts. '
+                              'Default is False.'))
     PARSER.add_argument('--local-sink', action='store_true', 
                         help=('Whether or not to save all the results in a common database. '
                               'If you enable this, the outputs from all the different workflows '
@@ -82,34 +121,98 @@ def main():
         wf = workflow.workflow_setup(
             data_sorting=True, subject_name_position=ARGS.subject_name_position,
             renaming=ARGS.renaming, mr_classiffication=not ARGS.no_mrclass,
-            checkpoints=checkpoints, sub_checkpoints=sub_checkpoints)
-        workflow.runner(wf, cores=ARGS.num_cores)
+            checkpoints=checkpoints, sub_checkpoints=sub_checkpoints,
+            num_workers=max(ARGS.num_cores, 1), incremental=ARGS.incremental,
+            converter=ARGS.converter, compression=ARGS.nifti_compression)
+        if wf.list_node_names():
+            workflow.runner(wf, cores=ARGS.num_cores)
         BASE_DIR = os.path.join(ARGS.work_dir, 'workflows_output', 'Sorted_Data')
-        sub_list = os.listdir(BASE_DIR)
+        sub_list, BASE_DIR = create_subject_list(BASE_DIR)
 
     if not ARGS.no_data_curation:
-        for sub_id in sub_list:
-            print('Processing subject {}'.format(sub_id))
-    
-            workflow = DataCuration(
-                sub_id=sub_id, input_dir=BASE_DIR, work_dir=ARGS.work_dir,
-                process_rt=True, local_basedir=ARGS.local_basedir,
-                local_project_id=ARGS.local_project_id, local_sink=ARGS.local_sink)
-            wf = workflow.workflow_setup()
-            if wf.list_node_names():
-                workflow.runner(wf, cores=ARGS.num_cores)
-            if ARGS.extract_rts:
-                wd = os.path.join(ARGS.work_dir, 'workflows_output', 'DataCuration')
-                workflow = RadioTherapy(
-                    sub_id=sub_id, input_dir=wd, work_dir=ARGS.work_dir,
-                    process_rt=True, roi_selection=ARGS.select_rts,
-                    local_basedir=ARGS.local_basedir,
-                    local_project_id=ARGS.local_project_id, local_sink=ARGS.local_sink)
-                wf = workflow.workflow_setup()
-                if wf.list_node_names():
-                    workflow.runner(wf, cores=ARGS.num_cores)
+        if ARGS.local_sink:
+            # projects created by a previous version are imported once here,
+            # before the subjects start
+            LocalDatabase(project_id=ARGS.local_project_id,
+                          local_basedir=ARGS.local_basedir).import_pickle()
+        run_cohort(sub_list, BASE_DIR, ARGS)
 
     print('Done!')
 
+
+def curate_subject(sub_id, base_dir, args, cores=0, memory_gb=None):
+    "Function to run the data curation (and RT extraction) of one subject"
+    start = time.time()
+    print('Processing subject {}'.format(sub_id))
+
+    workflow = DataCuration(
+        sub_id=sub_id, input_dir=base_dir, work_dir=args.work_dir,
+        process_rt=True, local_basedir=args.local_basedir,
+        local_project_id=args.local_project_id, local_sink=args.local_sink)
+    wf = workflow.workflow_setup()
+    if wf.list_node_names():
+        workflow.runner(wf, cores=cores, memory_gb=memory_gb)
+    if args.extract_rts:
+        wd = os.path.join(args.work_dir, 'workflows_output', 'DataCuration')
+        workflow = RadioTherapy(
+            sub_id=sub_id, input_dir=wd, work_dir=args.work_dir,
+            process_rt=True, roi_selection=args.select_rts,
+            rasteriser=args.rts_rasteriser, multilabel=args.rts_multilabel,
+            num_workers=max(cores, 1),
+            local_basedir=args.local_basedir,
+            local_project_id=args.local_project_id, local_sink=args.local_sink)
+        wf = workflow.workflow_setup()
+        if wf.list_node_names():
+            workflow.runner(wf, cores=cores, memory_gb=memory_gb)
+
+    return time.time()-start
+
+
+def run_cohort(sub_list, base_dir, args):
+    """Function to curate all the subjects in sub_list, running
+    args.parallel_subjects of them at the same time in separate processes.
+    The cores (args.num_cores) and memory (args.memory_gb) are split among the
+    subjects running at the same time. The status of each subject is printed
+    as soon as it is finished and appended to cohort_status.jsonl in the
+    working directory. A failed subject does not stop the others.
+    """
+    n_parallel = max(min(args.parallel_subjects, len(sub_list)), 1)
+    cores = args.num_cores//n_parallel if args.num_cores else 0
+    if args.num_cores and not cores:
+        cores = 1
+    memory_gb = args.memory_gb/n_parallel if args.memory_gb else None
+    status_file = os.path.join(args.work_dir, 'cohort_status.jsonl')
+    os.makedirs(args.work_dir, exist_ok=True)
+    print('{0} subjects to process, {1} at a time with {2} cores{3} each'.format(
+        len(sub_list), n_parallel, cores, ' and {:.1f} GB'.format(memory_gb)
+        if memory_gb else ''))
+
+    def report(n, sub_id, elapsed=None, error=None):
+        status = {'subject': sub_id, 'status': 'failed' if error else 'done',
+                  'seconds': elapsed, 'error': error}
+        print('[{0}/{1}] subject {2} {3}'.format(
+            n, len(sub_list), sub_id, 'failed: {}'.format(error) if error
+            else 'done in {:.1f} s'.format(elapsed)))
+        with open(status_file, 'a') as f:
+            f.write(json.dumps(status)+'\n')
+
+    if n_parallel == 1:
+        for n, sub_id in enumerate(sub_list, 1):
+            try:
+                report(n, sub_id, curate_subject(sub_id, base_dir, args,
+                                                 cores=cores, memory_gb=memory_gb))
+            except Exception as e:
+                report(n, sub_id, error=repr(e))
+        return
+
+    with ProcessPoolExecutor(max_workers=n_parallel) as pool:
+        futures = {pool.submit(curate_subject, sub_id, base_dir, args, cores,
+                               memory_gb): sub_id for sub_id in sub_list}
+        for n, future in enumerate(as_completed(futures), 1):
+            try:
+                report(n, futures[future], future.result())
+            except Exception as e:
+                report(n, futures[future], error=repr(e))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,6 +5,7 @@ from pycurt.workflows.curation import DataCuration
 from pycurt.utils.config import create_subject_list, download_mrclass_weights
 from pycurt.utils.utils import create_pycurt_gui
 from pycurt.workflows.rt import RadioTherapy
+from pycurt.database.local import LocalDatabase
 
 
 def main():
@@ -27,12 +28,18 @@ def main():
         wf = workflow.workflow_setup(
             data_sorting=True, subject_name_position=int(values['sn_pos']),
             renaming=values['renaming'], mr_classiffication=values['mrclass'],
-            checkpoints=checkpoints, sub_checkpoints=sub_checkpoints)
+            checkpoints=checkpoints, sub_checkpoints=sub_checkpoints,
+            num_workers=max(int(values['cores']), 1),
+            converter='native' if values.get('native_converter') else 'dcm2niix')
         workflow.runner(wf, cores=int(values['cores']))
         BASE_DIR = os.path.join(values['work_dir'], 'workflows_output', 'Sorted_Data')
-        sub_list = os.listdir(BASE_DIR)
+        sub_list, BASE_DIR = create_subject_list(BASE_DIR)
     
     if values['data_curation']:
+        if values['local_db']:
+            # projects created by a previous version are imported once here
+            LocalDatabase(project_id=values['db_pid'],
+                          local_basedir=values['db_path']).import_pickle()
         for sub_id in sub_list:
         
             print('Processing subject {}'.format(sub_id))
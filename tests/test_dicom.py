@@ -0,0 +1,42 @@
+import types
+import pytest
+from pycurt.utils import dicom, index
+
+
+@pytest.fixture
+def series(tmp_path, monkeypatch):
+    "Three DICOM files of one series, whose headers come from a fake index"
+    dicoms = [tmp_path/'{}.dcm'.format(i) for i in range(3)]
+    for dcm in dicoms:
+        dcm.write_bytes(b'')
+    headers = {dcm: {'ImageType': ('ORIGINAL', 'PRIMARY', 'AXIAL'),
+                     'SeriesNumber': 2, 'InstanceNumber': i+1,
+                     'SOPInstanceUID': '1.2.3.{}'.format(i),
+                     'ImagePositionPatient': ('0', '0', str(i))}
+               for i, dcm in enumerate(dicoms)}
+    monkeypatch.setattr(index, 'get_header_index', lambda: types.SimpleNamespace(
+        parsed=0, headers=lambda files: [headers[x] for x in files]))
+    decompressed = []
+    monkeypatch.setattr(dicom, 'decompress_dicoms', lambda files, n_workers=1: (
+        decompressed.extend(files) or []))
+
+    return tmp_path, headers, decompressed
+
+
+def test_missing_transfer_syntax_is_not_compressed(series):
+    folder, _, decompressed = series
+    analysis = dicom.analyse_series(folder)
+
+    assert len(analysis.dicoms) == 3
+    assert decompressed == []
+
+
+def test_compressed_files_are_decompressed(series):
+    folder, headers, decompressed = series
+    jpeg = sorted(headers)[0]
+    headers[jpeg]['TransferSyntaxUID'] = '1.2.840.10008.1.2.4.70'
+    for dcm in sorted(headers)[1:]:
+        headers[dcm]['TransferSyntaxUID'] = dicom.ExplicitVRLittleEndian
+    dicom.analyse_series(folder)
+
+    assert decompressed == [jpeg]
@@ -0,0 +1,49 @@
+import numpy as np
+import nibabel as nib
+from pycurt.utils import rt
+
+
+def square(first, last, k=0):
+    "Square contour with its corners on voxel centres (identity affine, LPS)"
+    corners = [(first, first), (first, last), (last, last), (last, first)]
+    return np.asarray([(-i, -j, k) for i, j in corners], dtype=float)
+
+
+def test_rasterise_square_voxel_count():
+    mask = rt.rasterise_contours([square(2, 6, k=3)], (10, 10, 5), np.eye(4))
+
+    assert np.count_nonzero(mask) == 16
+    assert mask[2:6, 2:6, 3].all()
+
+
+def test_rasterise_inner_contour_is_a_hole():
+    mask = rt.rasterise_contours([square(2, 6), square(3, 5)], (10, 10, 1),
+                                 np.eye(4))
+
+    assert np.count_nonzero(mask) == 12
+    assert not mask[3:5, 3:5, 0].any()
+
+
+def test_rasterise_rtstruct_matches_reference(tmp_path, monkeypatch):
+    shape = (64, 64, 3)
+    centre, radius = 31.5, 20.0
+    angles = np.linspace(0, 2*np.pi, 720, endpoint=False)
+    contours = [np.stack([-(centre+radius*np.cos(angles)),
+                          -(centre+radius*np.sin(angles)),
+                          np.full(angles.shape, k)], axis=1) for k in range(3)]
+    monkeypatch.setattr(rt, 'read_rtstruct', lambda x: [(1, 'Disc', contours)])
+    i, j = np.mgrid[:shape[0], :shape[1]]
+    disc = (i-centre)**2+(j-centre)**2 < radius**2
+    reference_file = str(tmp_path/'Disc.nii.gz')
+    nib.save(nib.Nifti1Image(np.repeat(disc[..., None], 3, axis=2).astype(np.uint8),
+                             np.eye(4)), reference_file)
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.uint8), np.eye(4)),
+             str(tmp_path/'RTCT.nii.gz'))
+
+    out_files = rt.rasterise_rtstruct('RTSTRUCT.dcm', str(tmp_path/'RTCT.nii.gz'),
+                                      str(tmp_path/'native'))
+    dice, failed = rt.compare_structures(out_files, [reference_file],
+                                         tolerance=0.99)
+
+    assert list(dice) == ['Disc']
+    assert not failed
@@ -0,0 +1,78 @@
+import os
+import json
+import pytest
+pytest.importorskip('nipype')
+from pycurt.interfaces.utils import FolderMerge
+from pycurt.utils.index import SortingManifest
+
+
+def make_session(base_dir, *parts):
+    "Create base_dir/parts with one empty file inside"
+    path = os.path.join(base_dir, *parts)
+    os.makedirs(path)
+    with open(os.path.join(path, 'image.nii.gz'), 'w'):
+        pass
+
+
+def sessions(path):
+
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+@pytest.fixture
+def sorted_dir(tmp_path):
+    "Subject sorted in a previous run, with one RT timepoint"
+    sorted_dir = str(tmp_path/'results'/'Sorted_Data')
+    make_session(sorted_dir, 'sub1', '20191215_MR-RT', 'T1')
+    make_session(sorted_dir, 'sub1', '20200101_RT', 'RTPLAN')
+    make_session(sorted_dir, 'sub1', '20200601_FU', 'T1')
+    manifest = os.path.join(sorted_dir, '.sorting_manifest.sqlite')
+    SortingManifest(manifest).update([
+        ('1.1', '/dicoms/mr.dcm', 1, 1, 'T1', 'MR', 'sub1', '20200601',
+         os.path.join(sorted_dir, 'sub1', '20200601_FU'))])
+
+    return sorted_dir
+
+
+def merge(tmp_path, sorted_dir, new_sessions, monkeypatch):
+
+    monkeypatch.chdir(str(tmp_path))
+    mr_dir = str(tmp_path/'mr')
+    rt_dir = str(tmp_path/'rt')
+    for session, scan in new_sessions:
+        make_session(rt_dir if session.endswith('_RT') else mr_dir, 'sub1',
+                     session, scan)
+    new_files = str(tmp_path/'new_files.json')
+    with open(new_files, 'w') as f:
+        json.dump([], f)
+    merging = FolderMerge()
+    merging.inputs.input_list = [[mr_dir, rt_dir]]
+    merging.inputs.sorted_dir = sorted_dir
+    merging.inputs.new_files = new_files
+    merging.inputs.manifest_file = os.path.join(sorted_dir, '.sorting_manifest.sqlite')
+    merging.run()
+
+    return str(tmp_path/'Sorted_Data'/'sub1')
+
+
+def test_new_rt_timepoint_relabels_existing_sessions(tmp_path, sorted_dir, monkeypatch):
+    out_dir = merge(tmp_path, sorted_dir, [('20200615_RT', 'RTPLAN'),
+                                           ('20200620', 'T1')], monkeypatch)
+
+    assert sessions(out_dir) == ['20191215_MR-RT', '20200601_MR-RT', '20200615_RT',
+                                 '20200620_post-RT']
+    # only the RT timepoint sorted in the previous run is left in place
+    assert sessions(os.path.join(sorted_dir, 'sub1')) == ['20200101_RT']
+    manifest = SortingManifest(os.path.join(sorted_dir, '.sorting_manifest.sqlite'))
+    assert [x[8] for x in manifest.connection().execute(
+        'SELECT * FROM sorted_files')] == [os.path.join(sorted_dir, 'sub1',
+                                                        '20200601_MR-RT')]
+
+
+def test_rt_close_to_an_existing_timepoint_is_not_a_timepoint(tmp_path, sorted_dir,
+                                                              monkeypatch):
+    out_dir = merge(tmp_path, sorted_dir, [('20200120_RT', 'RTPLAN')], monkeypatch)
+
+    assert '20200120_RT' not in sessions(out_dir)
+    assert sessions(os.path.join(sorted_dir, 'sub1')) == [
+        '20191215_MR-RT', '20200101_RT', '20200601_FU']